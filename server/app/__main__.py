@@ -1,19 +1,43 @@
+import sys
 import asyncio
 import app.logger as logger
 
 from app.settings import SETTINGS
 from app.api.server import start_server
 from app.utils.mongo import MongoDB
+from app.utils.auth_cache import AuthCache
+from app.utils.jobs import Jobs
+from app.utils.report_jobs import ReportJobs
+from app.utils.anomalies import run_detector
+from app.utils.event_hub import EventHub
+from app.objects import MODELS, Event
 
 async def main():
     # Логирование
     logger.setup()
     # Подключаем БД
     MongoDB.setup(SETTINGS.MONGODB_URL.get_secret_value(), SETTINGS.MONGODB_DB.get_secret_value())
+    # Создаем индексы
+    await MongoDB.setup_indexes(MODELS)
+    await Jobs.setup()
+    await ReportJobs.setup()
+    # Сбрасываем продления сессий пачками
+    asyncio.get_running_loop().create_task(AuthCache.run_flusher())
+    # Доставка событий из других воркеров
+    if SETTINGS.EVENTS_CHANGE_STREAM:
+        asyncio.get_running_loop().create_task(EventHub.run_feeder(Event))
+    # Поиск аномалий в показаниях по расписанию
+    if SETTINGS.ANOMALY_SCAN_INTERVAL > 0:
+        asyncio.get_running_loop().create_task(run_detector())
     # ЗАпускаем REST API
     server = start_server()
     
 if __name__ == '__main__':
     loop = asyncio.new_event_loop() 
+    # python -m app <command>
+    if len(sys.argv) > 1:
+        from app.commands import run
+        logger.setup()
+        sys.exit(loop.run_until_complete(run(sys.argv[1], sys.argv[2:])))
     loop.create_task(main())
-    loop.run_forever()
\ No newline at end of file
+    loop.run_forever()
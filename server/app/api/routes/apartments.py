@@ -2,10 +2,13 @@ import asyncio
 import traceback
 import hashlib
 import secrets
+import re
 
 from bson import ObjectId
+from pymongo.errors import BulkWriteError
 from typing import Annotated
 from datetime import datetime, timedelta
+from collections import Counter as Tally
 from uvicorn import Config, Server
 from starlette.responses import JSONResponse
 from starlette.middleware.base import BaseHTTPMiddleware
@@ -18,33 +21,57 @@ from app.settings import SETTINGS
 from app.utils.security import verify_password, hash_password
 from app.objects.user import User
 from app.objects.session import Session
-from app.api.routes.auth import get_current_user
+from app.api.routes.auth import get_current_user, get_access
+from app.api.schemas import ReadingsSubmit
 
 from app.objects import *
 from app.utils.mongo import MongoDB
+from app.utils.loader import load_many
+from app.utils.pagination import page_response
+from app.utils.streaming import csv_rows
+from app.utils.jobs import Jobs
+from app.utils.reports import previous_month
+from app.utils.access import Access, AccessCache
 
 router = APIRouter()
 
+IMPORT_MAX_ROWS = 5000
+IMPORT_CHUNK_SIZE = 200
+IMPORT_COLUMNS = ["entrance", "floor", "number", "owner_email", "resident_emails", "counters"]
+COUNTER_TYPES = ["electricity", "hot_water", "cold_water", "gas"]
+# Lists inside a cell: emails and counters are separated by spaces, "|" or ";"
+LIST_SEPARATOR = re.compile(r"[\s;|]+")
+
 @router.get("/list", tags=["Apartments"], name="Get apartments list")
 async def get_apartments(
-    current_user: Annotated[User, Depends(get_current_user)],
-    house_id: str = None
+    access: Annotated[Access, Depends(get_access)],
+    house_id: str = None,
+    skip: int = 0,
+    limit: int = 20,
+    cursor: str = None,
+    paged: bool = False
 ) -> JSONResponse:
-    ''' Get apartments list '''
+    ''' Get apartments list
+    paged=true returns {items, next_cursor}, pass next_cursor as cursor to get the next page
+    '''
     # Get house
     house = await House.get_by_id(ObjectId(house_id))
     if house is None:
         return JSONResponse({"error": "House not found"}, status_code=404)
     # Check user role
-    if current_user.role not in ["admin"] and current_user._id not in house.managers:
+    if not access.can_manage(house._id):
         return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
     # Get apartments
-    apartments = await Apartment.get_list(house_id=ObjectId(house_id))
-    return JSONResponse([a.to_json() for a in apartments], status_code=200)
+    try:
+        apartments = await Apartment.get_list(house_id=ObjectId(house_id), skip=skip, limit=limit, cursor=cursor)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return page_response(apartments, Apartment.order, limit, paged, cursor)
 
 @router.get("/add", tags=["Apartments"], name="Add apartment")
 async def add_apartment(
     current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     house_id: str,
     owner_email: str,
     entrance: str,
@@ -57,7 +84,7 @@ async def add_apartment(
     if house is None:
         return JSONResponse({"error": "Дом не найден"}, status_code=200)
     # Check user role
-    if current_user.role not in ["admin"] and current_user._id not in house.managers:
+    if not access.can_manage(house._id):
         return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
     # Check if apartment already exists
     apartment_exists = await Apartment.get_list(
@@ -80,11 +107,12 @@ async def add_apartment(
         residents=[owner._id]
     )
     await apartment.save()
+    AccessCache.invalidate(owner._id)
     return JSONResponse(apartment.to_json(), status_code=200)
 
 @router.get("/remove", tags=["Apartments"], name="Remove Apartment")
 async def remove_apartment(
-    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     apartment_id: str
 ) -> JSONResponse:
     ''' Remove apartment '''
@@ -92,12 +120,15 @@ async def remove_apartment(
     apartment = await Apartment.get_by_id(ObjectId(apartment_id))
     if apartment is None:
         return JSONResponse({"error": "Apartment not found"}, status_code=404)
-    house = await House.get_by_id(ObjectId(apartment.house_id))
     # Check user role
-    if current_user.role not in ["admin"] and current_user._id not in house.managers:
+    if not access.can_manage(apartment.house_id):
         return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
-    # Remove apartment
+    # Remove apartment, its counters are no longer expected to submit
+    counters = await Counter.get_list(apartment._id, fields=['active', 'type'])
     await MongoDB.db.apartments.delete_one({'_id': ObjectId(apartment_id)})
+    await SubmissionStats.remove_counters(apartment.house_id, counters)
+    AccessCache.forget_apartment(apartment._id)
+    AccessCache.invalidate(apartment.owner_id, *apartment.residents)
     return JSONResponse({"message": "Apartment removed"}, status_code=200)
 
 @router.get("/my", tags=["Apartments"], name="Get my apartments")
@@ -111,7 +142,7 @@ async def get_my_apartments(
 
 @router.get("/residents/add", tags=["Apartments"], name="Add resident to apartment")
 async def add_resident_to_apartment(
-    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     apartment_id: str,
     email: str
 ) -> JSONResponse:
@@ -120,9 +151,8 @@ async def add_resident_to_apartment(
     apartment = await Apartment.get_by_id(ObjectId(apartment_id))
     if apartment is None:
         return JSONResponse({"error": "Квартира не найдена"}, status_code=200)
-    house = await House.get_by_id(ObjectId(apartment.house_id))
     # Check user role
-    if current_user.role not in ["admin"] and current_user._id not in house.managers and current_user._id != apartment.owner_id:
+    if not access.can_own(apartment._id, apartment.house_id):
         return JSONResponse({"error": "You are not admin, manager of this house or apartment owner"}, status_code=403)
     # Check if resident already exists
     resident = await User.get_by_email(email)
@@ -131,11 +161,12 @@ async def add_resident_to_apartment(
     # Add resident and return it
     apartment.residents.append(resident._id)
     await apartment.save()
+    AccessCache.invalidate(resident._id)
     return JSONResponse(apartment.to_json(), status_code=200)
 
 @router.get("/residents/change_owner", tags=["Apartments"], name="Change apartment owner")
 async def add_resident_to_apartment(
-    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     apartment_id: str,
     email: str
 ) -> JSONResponse:
@@ -144,9 +175,8 @@ async def add_resident_to_apartment(
     apartment = await Apartment.get_by_id(ObjectId(apartment_id))
     if apartment is None:
         return JSONResponse({"error": "Квартира не найдена"}, status_code=200)
-    house = await House.get_by_id(ObjectId(apartment.house_id))
     # Check user role
-    if current_user.role not in ["admin"] and current_user._id not in house.managers:
+    if not access.can_manage(apartment.house_id):
         return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
     # Check if resident already exists
     owner = await User.get_by_email(email)
@@ -154,13 +184,15 @@ async def add_resident_to_apartment(
         return JSONResponse({"error": "Пользователь с таким адресом электронной почты не найден"}, status_code=200)
     if owner._id not in apartment.residents:
         apartment.residents.append(owner._id)
+    previous_owner_id = apartment.owner_id
     apartment.owner_id = owner._id
     await apartment.save()
+    AccessCache.invalidate(previous_owner_id, owner._id)
     return JSONResponse(apartment.to_json(), status_code=200)
 
 @router.get("/residents/list", tags=["Apartments"], name="Get residents info")
 async def add_resident_to_apartment(
-    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     apartment_id: str
 ) -> JSONResponse:
     ''' Add resident to apartment '''
@@ -168,20 +200,15 @@ async def add_resident_to_apartment(
     apartment = await Apartment.get_by_id(ObjectId(apartment_id))
     if apartment is None:
         return JSONResponse({"error": "Apartment not found"}, status_code=404)
-    house = await House.get_by_id(ObjectId(apartment.house_id))
     # Check user role
-    if current_user.role not in ["admin"] and current_user._id not in house.managers and current_user._id != apartment.owner_id:
+    if not access.can_own(apartment._id, apartment.house_id):
         return JSONResponse({"error": "You are not admin, manager of this house or apartment owner"}, status_code=403)
-    residents_info = []
-    for resident_id in apartment.residents:
-        print(resident_id)
-        residents_info.append(await User.get_by_id(resident_id))
-    print(residents_info)
-    return JSONResponse([x.to_json() for x in residents_info], status_code=200)
+    residents_info = await load_many(User, apartment.residents)
+    return JSONResponse([x.to_json() for x in residents_info if x is not None], status_code=200)
 
 @router.get("/residents/remove", tags=["Apartments"], name="Remove resident from apartment")
 async def remove_resident_from_apartment(
-    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     apartment_id: str,
     resident_id: str
 ) -> JSONResponse:
@@ -190,9 +217,8 @@ async def remove_resident_from_apartment(
     apartment = await Apartment.get_by_id(ObjectId(apartment_id))
     if apartment is None:
         return JSONResponse({"error": "Квартира не найдена"}, status_code=200)
-    house = await House.get_by_id(ObjectId(apartment.house_id))
     # Check user role
-    if current_user.role not in ["admin"] and current_user._id not in house.managers and current_user._id != apartment.owner_id:
+    if not access.can_own(apartment._id, apartment.house_id):
         return JSONResponse({"error": "You are not admin, manager of this house or apartment owner"}, status_code=403)
     # Check if resident not exists
     if resident_id not in [str(x) for x in apartment.residents]:
@@ -200,4 +226,244 @@ async def remove_resident_from_apartment(
     # Remove resident and return it
     apartment.residents.remove(ObjectId(resident_id))
     await apartment.save()
-    return JSONResponse(apartment.to_json(), status_code=200)
\ No newline at end of file
+    AccessCache.invalidate(ObjectId(resident_id))
+    return JSONResponse(apartment.to_json(), status_code=200)
+
+@router.post("/readings/submit", tags=["Apartments"], name="Submit readings of apartment")
+async def submit_readings(
+    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
+    data: ReadingsSubmit
+) -> JSONResponse:
+    ''' Readings of several counters of one apartment for the current month,
+    either all of them are saved or none '''
+    apartment_id = ObjectId(data.apartment_id)
+    house_id, counters = await asyncio.gather(
+        AccessCache.house_of(apartment_id),
+        Counter.get_list(apartment_id=apartment_id)
+    )
+    if house_id is None:
+        return JSONResponse({"error": "Apartment not found"}, status_code=404)
+    # Check user role
+    if not access.can_use(apartment_id, house_id):
+        return JSONResponse({"error": "You are not admin, manager of this house or resident of this apartment"}, status_code=403)
+    if not data.readings:
+        return JSONResponse({"error": "Нет показаний"}, status_code=400)
+
+    # Latest readings of all counters in one query, then every check in memory
+    counters = {str(counter._id): counter for counter in counters}
+    latest = await Reading.get_latest([counter._id for counter in counters.values()])
+    now = datetime.now()
+    errors = []
+    entries = []
+    for item in data.readings:
+        counter = counters.get(item.counter_id)
+        if counter is None:
+            errors.append({"counter_id": item.counter_id, "error": "Счетчик не найден в этой квартире"})
+            continue
+        if any(entry[0] is counter for entry in entries):
+            errors.append({"counter_id": item.counter_id, "error": "Счетчик указан дважды"})
+            continue
+        reading = Reading(
+            value=round(item.value, 1),
+            user_id=current_user._id,
+            counter_id=counter._id,
+            year=now.year,
+            month=now.month,
+            created_at=now
+        )
+        previous = latest.get(counter._id)
+        if previous is not None and (previous.year, previous.month) == (reading.year, reading.month):
+            errors.append({"counter_id": item.counter_id, "error": "В этом месяце вы уже вносили показания"})
+            continue
+        if previous is not None and previous.value > reading.value:
+            errors.append({"counter_id": item.counter_id, "error": "Показания не могут быть меньше предыдущих"})
+            continue
+        entries.append((counter, reading, previous))
+    if errors:
+        return JSONResponse({"error": "Показания не сохранены", "errors": errors}, status_code=400)
+
+    # Readings, their rollup and submission progress in one transaction
+    async def write(session):
+        await Reading.insert_many([reading for _, reading, _ in entries], session=session)
+        await Consumption.add_latest(house_id, entries, session=session)
+        await SubmissionStats.add_readings(house_id, [(counter, reading) for counter, reading, _ in entries], session=session)
+    try:
+        await MongoDB.transaction(write)
+    except BulkWriteError:
+        return JSONResponse({"error": "В этом месяце вы уже вносили показания"}, status_code=409)
+    return JSONResponse([reading.to_json() for _, reading, _ in entries], status_code=200)
+
+def parse_counters(cell: str) -> list:
+    ''' "type:serial_number[:initial value]" items, raises ValueError '''
+    result = []
+    for item in LIST_SEPARATOR.split(cell.strip()):
+        if not item:
+            continue
+        parts = item.split(":")
+        if len(parts) not in (2, 3) or not parts[1]:
+            raise ValueError(f"Счетчик {item}: ожидается тип:серийный_номер[:показания]")
+        if parts[0] not in COUNTER_TYPES:
+            raise ValueError(f"Счетчик {item}: неверный тип")
+        try:
+            value = round(float(parts[2].replace(",", ".")), 1) if len(parts) == 3 and parts[2] else None
+        except ValueError:
+            raise ValueError(f"Счетчик {item}: некорректные показания")
+        result.append((parts[0], parts[1], value))
+    return result
+
+def import_report(results: dict) -> dict:
+    created = sum(1 for result in results.values() if result["status"] == "created")
+    failed = sum(1 for result in results.values() if result["status"] == "error")
+    return {"created": created, "failed": failed, "rows": list(results.values())}
+
+async def import_apartments_job(job: Job, house: House, user_id: ObjectId, rows: list):
+    ''' Validate rows against the database with a fixed number of queries, then create
+    apartments, counters and initial readings chunk by chunk. Per-row results are stored with
+    every chunk, a job stopped halfway still tells which rows were created '''
+    await job.progress(total=len(rows))
+    results = {line: {"row": line, "number": row[2], "status": "error"} for line, row in rows}
+    # Every email, every number and every serial of the file at once
+    emails = set()
+    serials = set()
+    parsed = []
+    for line, row in rows:
+        entrance, floor, number, owner_email, resident_emails, counters = row
+        try:
+            counters = parse_counters(counters)
+        except ValueError as e:
+            results[line]["error"] = str(e)
+            continue
+        resident_emails = [email for email in LIST_SEPARATOR.split(resident_emails.strip()) if email]
+        emails.update([owner_email, *resident_emails])
+        serials.update(serial for _, serial, _ in counters)
+        parsed.append((line, entrance, floor, number, owner_email, resident_emails, counters))
+    users, numbers, existing = await asyncio.gather(
+        User.get_by_emails(emails, fields=['email']),
+        MongoDB.db.apartments.distinct('number', {'house_id': house._id}),
+        MongoDB.db.counters.distinct('serial_number', {'serial_number': {'$in': list(serials)}})
+    )
+    numbers, existing = set(numbers), set(existing)
+
+    valid = []
+    for line, entrance, floor, number, owner_email, resident_emails, counters in parsed:
+        unknown = [email for email in [owner_email, *resident_emails] if email not in users]
+        repeated = [serial for _, serial, _ in counters if serial in existing]
+        if not number:
+            results[line]["error"] = "Не указан номер квартиры"
+        elif number in numbers:
+            results[line]["error"] = "Квартира с таким номером уже существует"
+        elif not owner_email:
+            results[line]["error"] = "Не указан email владельца"
+        elif unknown:
+            results[line]["error"] = f"Пользователи не найдены: {', '.join(unknown)}"
+        elif repeated:
+            results[line]["error"] = f"Счетчики уже существуют: {', '.join(repeated)}"
+        else:
+            numbers.add(number)
+            existing.update(serial for _, serial, _ in counters)
+            valid.append((line, entrance, floor, number, owner_email, resident_emails, counters))
+            results[line]["status"] = "pending"
+    await job.progress(done=len(rows) - len(valid), result=import_report(results))
+
+    now = datetime.now()
+    year, month = previous_month(now.year, now.month)
+    for i in range(0, len(valid), IMPORT_CHUNK_SIZE):
+        apartments = []
+        counters = []
+        readings = []
+        for line, entrance, floor, number, owner_email, resident_emails, items in valid[i:i + IMPORT_CHUNK_SIZE]:
+            owner_id = users[owner_email]._id
+            # Owner is a resident too, as in /apartments/add
+            residents = list(dict.fromkeys([owner_id] + [users[email]._id for email in resident_emails]))
+            apartment = Apartment(
+                house_id=house._id,
+                owner_id=owner_id,
+                entrance=entrance,
+                floor=floor,
+                number=number,
+                residents=residents,
+                _id=ObjectId()
+            )
+            apartments.append(apartment)
+            for counter_type, serial_number, value in items:
+                counter = Counter(
+                    apartment_id=apartment._id,
+                    active=True,
+                    name=counter_type,
+                    type=counter_type,
+                    serial_number=serial_number,
+                    _id=ObjectId()
+                )
+                counters.append((line, counter))
+                if value is not None:
+                    readings.append((counter, Reading(
+                        value=value,
+                        user_id=user_id,
+                        counter_id=counter._id,
+                        year=year,
+                        month=month,
+                        created_at=now
+                    )))
+            results[line].update(status="created", id=str(apartment._id), counters=len(items))
+        await MongoDB.db.apartments.insert_many([{'_id': a._id, **a.__dict__()} for a in apartments], ordered=False)
+        AccessCache.invalidate(*{user_id for a in apartments for user_id in a.residents})
+        lost = set()
+        if counters:
+            try:
+                await MongoDB.db.counters.insert_many([{'_id': c._id, **c.__dict__()} for _, c in counters], ordered=False)
+            except BulkWriteError as e:
+                # Serials taken since validation, the apartment is created without them
+                for error in e.details['writeErrors']:
+                    line, counter = counters[error['index']]
+                    lost.add(counter._id)
+                    results[line]["counters"] -= 1
+                    results[line].setdefault("warnings", []).append(f"Счетчик {counter.serial_number} уже существует")
+                readings = [(counter, reading) for counter, reading in readings if counter._id not in lost]
+        active = Tally(counter.type for _, counter in counters if counter._id not in lost)
+        await SubmissionStats.add(house._id, now.year, now.month, expected=active)
+        if readings:
+            await Reading.insert_many([reading for _, reading in readings])
+            await Consumption.add_latest(house._id, [(counter, reading, None) for counter, reading in readings])
+            # New counters were not expected in the previous month yet, they are now along with their reading
+            previous = Tally(counter.type for counter, _ in readings)
+            await SubmissionStats.add(house._id, year, month, submitted=previous, expected=previous)
+        await job.progress(done=job.done + len(apartments), result=import_report(results))
+    return import_report(results)
+
+@router.post("/import", tags=["Apartments"], name="Import apartments")
+async def import_apartments(
+    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
+    request: Request,
+    house_id: str,
+    delimiter: str = ","
+) -> JSONResponse:
+    ''' Import apartments of house from CSV request body:
+    entrance,floor,number,owner_email,resident_emails,counters per line, an optional header line is skipped.
+    resident_emails and counters are lists separated by spaces, "|" or ";",
+    a counter is type:serial_number or type:serial_number:initial_value.
+    Rows are checked and written in background, progress and per-row results are kept
+    for a day at /api/v1/jobs/get, answered by any worker
+    '''
+    house = await House.get_by_id(ObjectId(house_id))
+    if house is None:
+        return JSONResponse({"error": "Дом не найден"}, status_code=404)
+    if not access.can_manage(house._id):
+        return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
+    if len(delimiter) != 1 or delimiter in '"\r\n':
+        return JSONResponse({"error": "Invalid delimiter"}, status_code=400)
+    rows = []
+    async for line, row in csv_rows(request.stream(), delimiter):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        if line == 1 and row[0].strip().lower() == IMPORT_COLUMNS[0]:
+            continue
+        if len(rows) >= IMPORT_MAX_ROWS:
+            return JSONResponse({"error": f"Не больше {IMPORT_MAX_ROWS} строк за раз"}, status_code=400)
+        row = [cell.strip() for cell in row] + [""] * (len(IMPORT_COLUMNS) - len(row))
+        rows.append((line, row[:len(IMPORT_COLUMNS)]))
+    if not rows:
+        return JSONResponse({"error": "Файл пуст"}, status_code=400)
+    job = await Jobs.start("apartments_import", current_user._id, import_apartments_job, house, current_user._id, rows)
+    return JSONResponse({"message": f"Importing {len(rows)} apartments", "job_id": str(job._id)}, status_code=200)
@@ -15,6 +15,8 @@ from pydantic import BaseModel
 
 from app.settings import SETTINGS
 from app.utils.security import verify_password, hash_password
+from app.utils.auth_cache import AuthCache
+from app.utils.access import Access, AccessCache
 from app.objects.user import User
 from app.objects.session import Session
 from app.api.schemas import RegisterData
@@ -23,23 +25,35 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 router = APIRouter()
 
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> User:
-    session: Session = await Session.get_by_token(token)
-    if not session:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid authentication credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    user: User = await User.get_by_id(session.user_id)
-    if user is None:
-        raise HTTPException(status_code=404, detail="User not found")
+    cached = AuthCache.get(token)
+    if cached is None:
+        session: Session = await Session.get_by_token(token)
+        if not session:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid authentication credentials",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        user: User = await User.get_by_id(session.user_id)
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+    else:
+        session, user = cached
     if session.expires_at < datetime.now():
+        AuthCache.drop(token)
         raise HTTPException(status_code=401, detail="Session expired")
+    # Sliding expiry is written in batches by AuthCache.flush()
     session.updated_at = datetime.now()
     session.expires_at = datetime.now() + timedelta(days=3)
-    await session.save()
+    AuthCache.touch(session)
+    if cached is None:
+        AuthCache.put(session, user)
     return user
 
+async def get_access(current_user: Annotated[User, Depends(get_current_user)]) -> Access:
+    ''' Houses and apartments of current user, no queries once loaded '''
+    return await AccessCache.get(current_user)
+
 @router.post("/token")
 async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], request: Request):
     user: User = await User.get_by_email(form_data.username)
@@ -74,6 +88,7 @@ async def read_users_me(
     if (name != None): current_user.name = name
     if (surname != None): current_user.surname = surname
     await current_user.save()
+    AuthCache.invalidate_user(current_user._id)
     return JSONResponse(status_code=200, content={"message": "User updated"})
 
 @router.post("/register")
@@ -4,6 +4,7 @@ import hashlib
 import secrets
 
 from bson import ObjectId
+from pymongo.errors import BulkWriteError
 from typing import Annotated
 from datetime import datetime, timedelta
 from uvicorn import Config, Server
@@ -18,34 +19,41 @@ from app.settings import SETTINGS
 from app.utils.security import verify_password, hash_password
 from app.objects.user import User
 from app.objects.session import Session
-from app.api.routes.auth import get_current_user
+from app.api.routes.auth import get_current_user, get_access
+from app.utils.access import Access, AccessCache
 
 from app.objects import *
 from app.utils.mongo import MongoDB
+from app.utils.pagination import page_response
+from app.utils.streaming import stream_response, csv_rows, FORMATS
 
 router = APIRouter()
 
+IMPORT_MAX_ROWS = 10000
+
 @router.get("/list", tags=["Counters"], name="Get counters list")
 async def get_counters(
-    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     apartment_id: str = None
 ) -> JSONResponse:
     ''' Get counters list '''
-    # Get house
-    apartment = await Apartment.get_by_id(ObjectId(apartment_id))
-    if apartment is None:
+    apartment_id = ObjectId(apartment_id)
+    house_id = await AccessCache.house_of(apartment_id)
+    if house_id is None:
         return JSONResponse({"error": "Apartment not found"}, status_code=404)
-    house = await House.get_by_id(ObjectId(apartment.house_id))
     # Check user role
-    if current_user.role not in ["admin"] and current_user._id not in house.managers and current_user._id not in apartment.residents:
+    if not access.can_use(apartment_id, house_id):
         return JSONResponse({"error": "You are not admin, manager of this house or resident of this apartment"}, status_code=403)
-    # Get counters
-    counters = await Counter.get_list(apartment_id=ObjectId(apartment_id))
+    counters = await Counter.get_list(apartment_id=apartment_id)
+    # Latest reading of every counter in one query
+    latest = await Reading.get_latest([counter._id for counter in counters])
     now = datetime.now().date()
     _counters = []
     for counter in counters:
         c = counter.to_json()
-        c['has_reading'] = await MongoDB.db.readings.find_one({'year': now.year, 'month': now.month, 'counter_id': counter._id}) is not None
+        reading = latest.get(counter._id)
+        c['has_reading'] = reading is not None and reading.year == now.year and reading.month == now.month
+        c['last_reading'] = reading.to_json() if reading is not None else None
         _counters.append(c)
 
     return JSONResponse(_counters, status_code=200)
@@ -73,15 +81,22 @@ async def add_counter(
         await event.save()
         counter = await Counter.get_by_id(request['counter_id'])
         if (request['type'] == 'delete'):
+            was_active = counter.active
             counter.active = True
             await counter.save()
+            if not was_active:
+                await SubmissionStats.set_active(counter, request['house_id'], True)
         else:
             await MongoDB.db.counters.delete_one({"_id": counter._id})
+            await Consumption.remove_counter(counter._id)
+            AccessCache.forget_counter(counter._id)
         await MongoDB.db.requests.delete_one({"_id": request["_id"]})
         return
 
     if request['type'] == 'delete':
         await MongoDB.db.counters.delete_one({"_id": ObjectId(request['counter_id'])})
+        await Consumption.remove_counter(ObjectId(request['counter_id']))
+        AccessCache.forget_counter(ObjectId(request['counter_id']))
         event = Event(
             request['user_id'],
             "notification",
@@ -95,8 +110,11 @@ async def add_counter(
         await event.save()
     else:
         counter = await Counter.get_by_id(request['counter_id'])
+        was_active = counter.active
         counter.active = True
         await counter.save()
+        if not was_active:
+            await SubmissionStats.set_active(counter, request['house_id'], True)
         event = Event(
             request['user_id'],
             "notification",
@@ -114,6 +132,7 @@ async def add_counter(
 @router.get("/add", tags=["Counters"], name="Add counter")
 async def add_counter(
     current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     apartment_id: str,
     serial_number: str,
     type: str,
@@ -130,8 +149,9 @@ async def add_counter(
     apartment = await Apartment.get_by_id(ObjectId(apartment_id))
     if apartment is None:
         return JSONResponse({"error": "Квартира не найдена"}, status_code=200)
-    house = await House.get_by_id(ObjectId(apartment.house_id))    # Check user role
-    if current_user.role not in ["admin"] and current_user._id not in house.managers and current_user._id != apartment.owner_id:
+    AccessCache.remember(apartment=apartment)
+    # Check user role
+    if not access.can_own(apartment._id, apartment.house_id):
         return JSONResponse({"error": "You are not admin, manager of this house or apartment owner"}, status_code=403)
     # Check if counter already exists
     counter = await MongoDB.db.counters.find_one({'serial_number': serial_number})
@@ -156,7 +176,8 @@ async def add_counter(
         month=1,
         created_at=datetime.now() - timedelta(days=60)
     )
-    inserted = await MongoDB.db.readings.insert_one(reading.__dict__())
+    await reading.save()
+    await Consumption.refresh(counter, apartment.house_id, [(reading.year, reading.month)])
 
     request = {
         "counter_id": counter._id,
@@ -165,7 +186,7 @@ async def add_counter(
         "counter_type": counter.type,
         "counter_serial_number": counter.serial_number,
         "apartment_number": apartment.number,
-        "house_id": house._id,
+        "house_id": apartment.house_id,
         "user_id": current_user._id,
         "reviewed": False,
         "positive": False
@@ -179,41 +200,49 @@ async def add_counter(
         False,
         ObjectId("65fca4b12b86fff7e3b1a5a3"),
         datetime.now(),
-        house._id
+        apartment.house_id
     )
     await event.save()
 
     return JSONResponse(counter.to_json(), status_code=200)
 
+def request_to_json(request: dict) -> dict:
+    request['_id'] = str(request['_id'])
+    request['house_id'] = str(request['house_id'])
+    request['user_id'] = str(request['user_id'])
+    request['counter_id'] = str(request['counter_id'])
+    return request
+
 @router.get("/requests/list", tags=["Counters"], name="Remove counter")
 async def remove_counter(
-    current_user: Annotated[User, Depends(get_current_user)],
-    house_id: str
+    access: Annotated[Access, Depends(get_access)],
+    house_id: str,
+    format: str = "json"
 ) -> JSONResponse:
-    ''' Remove counter '''
+    ''' Remove counter 
+    format: ["json", "ndjson", "stream"]
+    '''
+    if format not in FORMATS:
+        return JSONResponse({"error": "Invalid format"}, status_code=400)
     # Get counter
     house = await House.get_by_id(ObjectId(house_id))
     if house is None:
         return JSONResponse({"error": "Дом не найден"}, status_code=200)
     # Check user role
-    if current_user.role not in ["admin"] and current_user._id not in house.managers:
+    if not access.can_manage(house._id):
         return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=200)
     # Parse all requests
     cursor = MongoDB.db.requests.find({"house_id": ObjectId(house_id)})
-    requests = []
-    async for request in cursor:
-        request['counter_id'] = str(request['counter_id'])
-        request['_id'] = str(request['_id'])
-        request['house_id'] = str(request['house_id'])
-        request['user_id'] = str(request['user_id'])
-        request['counter_id'] = str(request['counter_id'])
-        requests.append(request)
+    if format != "json":
+        return stream_response(cursor, request_to_json, format)
+    requests = [request_to_json(request) async for request in cursor]
     return JSONResponse(requests, status_code=200)
     
 
 @router.get("/remove", tags=["Counters"], name="Remove counter")
 async def remove_counter(
     current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     counter_id: str,
     reason: str = ""
 ) -> JSONResponse:
@@ -223,16 +252,15 @@ async def remove_counter(
     if counter is None:
         return JSONResponse({"error": "Счетчик не найден"}, status_code=200)
     apartment = await Apartment.get_by_id(ObjectId(counter.apartment_id))
-    house = await House.get_by_id(ObjectId(apartment.house_id))
     # Check user role
-    if current_user.role not in ["admin"] and current_user._id not in house.managers and current_user._id != apartment.owner_id:
+    if not access.can_own(apartment._id, apartment.house_id):
         return JSONResponse({"error": "You are not admin, manager of this house or apartment owner"}, status_code=403)
     # Remove counter
     request = {
         "counter_id": counter._id,
         "type": "delete",
         "reason": reason,
-        "house_id": house._id,
+        "house_id": apartment.house_id,
         "counter_type": counter.type,
         "counter_serial_number": counter.serial_number,
         "apartment_number": apartment.number,
@@ -250,75 +278,78 @@ async def remove_counter(
         False,
         ObjectId("65fca4b12b86fff7e3b1a5a3"),
         datetime.now(),
-        house._id
+        apartment.house_id
     )
     await event.save()
 
+    was_active = counter.active
     counter.active = False
     await counter.save()
+    if was_active:
+        await SubmissionStats.set_active(counter, apartment.house_id, False)
     # await MongoDB.db.counters.delete_one({'_id': ObjectId(counter_id)})
     return JSONResponse({"message": "Counter removed"}, status_code=200)
 
 @router.get("/readings/list", tags=["Counters"], name="Get readings list")
 async def get_readings(
-    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     counter_id: str = None,
     start_date: str = None,
     end_date: str = None,
     limit: int = 20,
-    skip: int = 0
+    skip: int = 0,
+    cursor: str = None,
+    paged: bool = False,
+    format: str = "json"
 ) -> JSONResponse:
-    ''' Get readings list '''
-    # Get counter
-    counter: Counter = await Counter.get_by_id(ObjectId(counter_id))
-    if counter is None:
+    ''' Get readings list
+    paged=true returns {items, next_cursor}, pass next_cursor as cursor to get the next page
+    format: ["json", "ndjson", "stream"], streamed formats are never paged, limit=0 streams everything
+    '''
+    if format not in FORMATS:
+        return JSONResponse({"error": "Invalid format"}, status_code=400)
+    # Counter -> apartment -> house, cached after the first request
+    counter_id = ObjectId(counter_id)
+    apartment_id = await AccessCache.apartment_of(counter_id)
+    if apartment_id is None:
         return JSONResponse({"error": "Счетчик не найден"}, status_code=200)
-    apartment = await Apartment.get_by_id(ObjectId(counter.apartment_id))
-    house = await House.get_by_id(ObjectId(apartment.house_id))
+    house_id = await AccessCache.house_of(apartment_id)
     # Check user role
-    if current_user.role not in ["admin"] and \
-        current_user._id not in house.managers and \
-        current_user._id not in apartment.residents:
+    if house_id is None or not access.can_use(apartment_id, house_id):
         return JSONResponse({"error": "You are not admin, manager of this house or resident of this apartment"}, status_code=403)
     # Get readings
     start_date = datetime.strptime(start_date, '%Y-%m-%d') if start_date else datetime.strptime("2000-01-01", '%Y-%m-%d')
     end_date = datetime.strptime(end_date, '%Y-%m-%d') if end_date else datetime.strptime("2100-12-01", '%Y-%m-%d')
 
-    print(start_date.year, start_date.month)
-    print(end_date.year, end_date.month)
-
-    cursor = MongoDB.db.readings.find({
-        'counter_id': ObjectId(counter_id),
-        'year': {
-            '$gte': start_date.year,
-            '$lte': end_date.year
-        },
-        'month': {
-            '$gte': start_date.month,
-            '$lte': end_date.month
-        }
-    }).skip(skip).limit(limit).sort([("year", -1), ("month", -1)])
-    
-    result = [Reading(**data) async for data in cursor]
-    return JSONResponse([x.to_json() for x in result], status_code=200)
+    try:
+        if format != "json":
+            return stream_response(
+                Reading.find_history(counter_id, start_date, end_date, skip=skip, limit=limit, cursor=cursor),
+                lambda reading: reading.to_json(),
+                format
+            )
+        result = await Reading.get_history(counter_id, start_date, end_date, skip=skip, limit=limit, cursor=cursor)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return page_response(result, Reading.order, limit, paged, cursor)
 
 @router.get("/readings/add", tags=["Counters"], name="Add reading")
 async def add_reading(
     current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     counter_id: str,
     value: float
 ) -> JSONResponse:
     ''' Add reading '''
-    # Get counter
-    counter = await Counter.get_by_id(ObjectId(counter_id))
+    # Get counter and its latest reading together
+    counter_id = ObjectId(counter_id)
+    counter, latest = await asyncio.gather(Counter.get_by_id(counter_id), Reading.get_latest([counter_id]))
     if counter is None:
         return JSONResponse({"error": "Счетчик не найден"}, status_code=200)
-    apartment = await Apartment.get_by_id(ObjectId(counter.apartment_id))
-    house = await House.get_by_id(ObjectId(apartment.house_id))
+    AccessCache.remember(counter=counter)
+    house_id = await AccessCache.house_of(counter.apartment_id)
     # Check user role
-    if current_user.role not in ["admin"] and \
-        current_user._id not in house.managers and \
-        current_user._id not in apartment.residents:
+    if house_id is None or not access.can_use(counter.apartment_id, house_id):
         return JSONResponse({"error": "You are not admin, manager of this house or resident of this apartment"}, status_code=403)
     # Add reading
     reading = Reading(
@@ -327,38 +358,177 @@ async def add_reading(
         counter_id=counter._id
     )
 
-    if await MongoDB.db.readings.find_one({"value": {'counter_id': reading.counter_id,'$gte': value}}) is not None:
+    latest = latest.get(counter._id)
+    if latest is not None and latest.value > reading.value:
         return JSONResponse({"error": "Показания не могут быть меньше предыдущих"}, status_code=200)
-    # current_reading = await MongoDB.db.readings.find_one({"year": reading.year, "month": reading.month, "counter_id": reading.counter_id})
-    # if current_reading is not None:
-    #     await MongoDB.db.readings.delete_one({"_id": current_reading._id})
-    if await MongoDB.db.readings.find_one({"year": reading.year, "month": reading.month, "counter_id": reading.counter_id}) is not None:
+    if latest is not None and (latest.year, latest.month) == (reading.year, reading.month):
         return JSONResponse({"error": "В этом месяце вы уже вносили показания"}, status_code=200)
 
-    inserted = await MongoDB.db.readings.insert_one(reading.__dict__())
-    reading._id = inserted.inserted_id
+    # Reading, its rollup and submission progress in one transaction
+    async def write(session):
+        await Reading.insert_many([reading], session=session)
+        await Consumption.refresh(counter, house_id, [(reading.year, reading.month)], session=session)
+        await SubmissionStats.add_readings(house_id, [(counter, reading)], session=session)
+    try:
+        await MongoDB.transaction(write)
+    except BulkWriteError:
+        return JSONResponse({"error": "В этом месяце вы уже вносили показания"}, status_code=200)
 
     return JSONResponse(reading.to_json(), status_code=200)
 
 @router.get("/readings/remove", tags=["Counters"], name="Remove reading")
 async def remove_reading(
-    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     reading_id: str,
 ) -> JSONResponse:
     ''' Remove reading '''
-    reading = await MongoDB.db.readings.find_one({"_id": ObjectId(reading_id)})
+    reading = await Reading.get_by_id(ObjectId(reading_id))
     if reading is None:
         return JSONResponse({"error": "Reading not found"}, status_code=404)
-    counter = await Counter.get_by_id(ObjectId(reading['counter_id']))
+    counter = await Counter.get_by_id(reading.counter_id)
     if counter is None:
         return JSONResponse({"error": "Counter not found"}, status_code=404)
-    apartment = await Apartment.get_by_id(ObjectId(counter.apartment_id))
-    house = await House.get_by_id(ObjectId(apartment.house_id))
+    house_id = await AccessCache.house_of(counter.apartment_id)
     # Check user role
-    if current_user.role not in ["admin"] and \
-        current_user._id not in house.managers and \
-        current_user._id not in apartment.residents:
+    if house_id is None or not access.can_use(counter.apartment_id, house_id):
         return JSONResponse({"error": "You are not admin, manager of this house or resident of this apartment"}, status_code=403)
     
-    await MongoDB.db.readings.delete_one({"_id": ObjectId(reading_id)})
-    return JSONResponse({"message": "Reading removed"}, status_code=200)
\ No newline at end of file
+    async def write(session):
+        await reading.delete(session=session)
+        await Consumption.refresh(counter, house_id, [(reading.year, reading.month)], session=session)
+        await SubmissionStats.add_readings(house_id, [(counter, reading)], sign=-1, session=session)
+    await MongoDB.transaction(write)
+    return JSONResponse({"message": "Reading removed"}, status_code=200)
+
+@router.post("/readings/import", tags=["Counters"], name="Import readings")
+async def import_readings(
+    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
+    request: Request,
+    house_id: str,
+    year: int,
+    month: int,
+    delimiter: str = ","
+) -> JSONResponse:
+    ''' Import readings of house for a month from CSV request body: serial_number,value per line,
+    an optional header line is skipped. Valid rows are written, invalid ones are returned in errors.
+    Past months are back-filled, future months are rejected
+    '''
+    house = await House.get_by_id(ObjectId(house_id))
+    if house is None:
+        return JSONResponse({"error": "House not found"}, status_code=404)
+    if not access.can_manage(house._id):
+        return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
+    if month < 1 or month > 12:
+        return JSONResponse({"error": "Invalid month"}, status_code=400)
+    if year < 2020:
+        return JSONResponse({"error": "Invalid year"}, status_code=400)
+    now = datetime.now()
+    if (year, month) > (now.year, now.month):
+        return JSONResponse({"error": "Readings of a future month are not accepted"}, status_code=400)
+    if len(delimiter) != 1 or delimiter in '"\r\n':
+        return JSONResponse({"error": "Invalid delimiter"}, status_code=400)
+
+    # Parse the body as it arrives
+    errors = []
+    rows = []
+    seen = set()
+    async for line, row in csv_rows(request.stream(), delimiter):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        if line == 1 and row[0].strip().lower() == "serial_number":
+            continue
+        if len(rows) + len(errors) >= IMPORT_MAX_ROWS:
+            return JSONResponse({"error": f"Не больше {IMPORT_MAX_ROWS} строк за раз"}, status_code=400)
+        if len(row) < 2:
+            errors.append({"row": line, "error": "Ожидается serial_number и value"})
+            continue
+        serial_number = row[0].strip()
+        try:
+            value = round(float(row[1].strip().replace(",", ".")), 1)
+        except ValueError:
+            errors.append({"row": line, "serial_number": serial_number, "error": "Некорректное значение"})
+            continue
+        if value < 0:
+            errors.append({"row": line, "serial_number": serial_number, "error": "Показания не могут быть отрицательными"})
+            continue
+        if serial_number in seen:
+            errors.append({"row": line, "serial_number": serial_number, "error": "Счетчик повторяется в файле"})
+            continue
+        seen.add(serial_number)
+        rows.append((line, serial_number, value))
+
+    # Counters of all rows, their apartments in this house and their readings, all at once
+    cursor = MongoDB.db.counters.find({"serial_number": {"$in": [serial for _, serial, _ in rows]}})
+    counters = {data["serial_number"]: Counter.from_bson(data) async for data in cursor}
+    counter_ids = [counter._id for counter in counters.values()]
+    apartment_ids, latest, previous = await asyncio.gather(
+        MongoDB.db.apartments.distinct("_id", {
+            "_id": {"$in": list({counter.apartment_id for counter in counters.values()})},
+            "house_id": house._id
+        }),
+        Reading.get_latest(counter_ids),
+        Reading.get_latest(counter_ids, until=(year, month))
+    )
+    apartment_ids = set(apartment_ids)
+
+    # Validate in memory
+    created_at = datetime.now()
+    readings = []
+    for line, serial_number, value in rows:
+        counter = counters.get(serial_number)
+        if counter is None:
+            errors.append({"row": line, "serial_number": serial_number, "error": "Счетчик не найден"})
+            continue
+        if counter.apartment_id not in apartment_ids:
+            errors.append({"row": line, "serial_number": serial_number, "error": "Счетчик не из этого дома"})
+            continue
+        last = previous.get(counter._id)
+        if last is not None and (last.year, last.month) == (year, month):
+            errors.append({"row": line, "serial_number": serial_number, "error": "Показания за этот месяц уже внесены"})
+            continue
+        if last is not None and last.value > value:
+            errors.append({"row": line, "serial_number": serial_number, "error": "Показания не могут быть меньше предыдущих"})
+            continue
+        newest = latest.get(counter._id)
+        if newest is not None and (newest.year, newest.month) > (year, month) and newest.value < value:
+            errors.append({"row": line, "serial_number": serial_number, "error": "Показания больше внесенных позже"})
+            continue
+        reading = Reading(
+            value=value,
+            user_id=current_user._id,
+            counter_id=counter._id,
+            year=year,
+            month=month,
+            created_at=created_at
+        )
+        readings.append((line, counter, reading))
+
+    # One unordered write, rows lost to concurrent inserts are reported
+    failed = set()
+    if readings:
+        try:
+            await Reading.insert_many([reading for _, _, reading in readings])
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                line, counter, _ = readings[error["index"]]
+                failed.add(line)
+                message = "Показания за этот месяц уже внесены" if error["code"] == 11000 else error["errmsg"]
+                errors.append({"row": line, "serial_number": counter.serial_number, "error": message})
+    written = [(line, counter, reading) for line, counter, reading in readings if line not in failed]
+
+    # Rollup of every written month in one write, a back-filled month also becomes
+    # the previous reading of the month after it, found for all counters at once
+    entries = [(counter, reading, previous.get(counter._id)) for _, counter, reading in written]
+    backfilled = {
+        counter._id: (counter, reading) for _, counter, reading in written
+        if latest.get(counter._id) is not None and (latest[counter._id].year, latest[counter._id].month) > (year, month)
+    }
+    if backfilled:
+        following = await Reading.get_next(list(backfilled), after=(year, month))
+        entries += [(counter, following[counter_id], reading) for counter_id, (counter, reading) in backfilled.items() if counter_id in following]
+    await Consumption.add_latest(house._id, entries)
+    await SubmissionStats.add_readings(house._id, [(counter, reading) for _, counter, reading in written])
+
+    errors.sort(key=lambda error: error["row"])
+    return JSONResponse({"imported": len(written), "errors": errors}, status_code=200)
@@ -2,12 +2,13 @@ import asyncio
 import traceback
 import hashlib
 import secrets
+import json
 
 from bson import ObjectId
 from typing import Annotated
 from datetime import datetime, timedelta
 from uvicorn import Config, Server
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from fastapi import Depends, FastAPI, HTTPException, status, Request, APIRouter
@@ -18,28 +19,93 @@ from app.settings import SETTINGS
 from app.utils.security import verify_password, hash_password
 from app.objects.user import User
 from app.objects.session import Session
-from app.api.routes.auth import get_current_user
+from app.api.routes.auth import get_current_user, get_access
+from app.utils.access import Access
 
 from app.objects import *
 from app.utils.mongo import MongoDB
+from app.utils.jobs import Jobs
+from app.utils.pagination import page_response
+from app.utils.event_hub import EventHub
 
 router = APIRouter()
 
+BROADCAST_CHUNK_SIZE = 500
+CATCH_UP_PAGE_SIZE = 100
+
 @router.get("/my", tags=["Events"], name="Get my events")
 async def get_my_events(
     current_user: Annotated[User, Depends(get_current_user)],
     read: bool = None,
     limit: int = 20,
-    skip: int = 0
+    skip: int = 0,
+    cursor: str = None,
+    paged: bool = False
 ) -> JSONResponse:
-    ''' Get my events '''
-    result = await Event.get_user_events(
-        user_id=current_user._id,
-        read=read,
-        limit=limit,
-        skip=skip
+    ''' Get my events
+    paged=true returns {items, next_cursor}, pass next_cursor as cursor to get the next page
+    '''
+    try:
+        result = await Event.get_user_events(
+            user_id=current_user._id,
+            read=read,
+            limit=limit,
+            skip=skip,
+            cursor=cursor
+        )
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return page_response(result, Event.order, limit, paged, cursor)
+
+def sse_message(payload: dict) -> str:
+    return f"id: {payload['id']}\nevent: event\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+async def event_stream(user_id: ObjectId, queue: asyncio.Queue, last_event_id: ObjectId = None):
+    try:
+        sent = set()
+        # Catch up page by page until nothing is left, events created meanwhile are
+        # either found here or come through the queue and are skipped as sent
+        while last_event_id is not None:
+            # Everything queued so far is also found by the next page, a long catch-up
+            # must not fill the queue and drop what arrives after it
+            while not queue.empty():
+                queue.get_nowait()
+            missed = await Event.get_since(user_id, last_event_id, limit=CATCH_UP_PAGE_SIZE)
+            for event in missed:
+                sent.add(str(event._id))
+                yield sse_message(event.to_json())
+            last_event_id = missed[-1]._id if len(missed) == CATCH_UP_PAGE_SIZE else None
+        while True:
+            try:
+                payload = await asyncio.wait_for(queue.get(), SETTINGS.EVENTS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing an idle connection
+                yield ": ping\n\n"
+                continue
+            if payload['id'] in sent:
+                continue
+            yield sse_message(payload)
+    finally:
+        EventHub.unsubscribe(user_id, queue)
+
+@router.get("/stream", tags=["Events"], name="Stream my events")
+async def stream_my_events(
+    current_user: Annotated[User, Depends(get_current_user)],
+    request: Request
+) -> StreamingResponse:
+    ''' New events as Server-Sent Events, replaces polling /events/my.
+    On reconnect the Last-Event-ID header replays events missed since that id
+    '''
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and not ObjectId.is_valid(last_event_id):
+        return JSONResponse({"error": "Invalid Last-Event-ID"}, status_code=400)
+    # Subscribe first so nothing created during the catch-up is lost
+    queue = EventHub.subscribe(current_user._id)
+    return StreamingResponse(
+        event_stream(current_user._id, queue, ObjectId(last_event_id) if last_event_id else None),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
-    return JSONResponse([n.to_json() for n in result], status_code=200)
 
 @router.get("/mark", tags=["Events"], name="Get all events")
 async def mark_events(
@@ -53,13 +119,49 @@ async def mark_events(
         return JSONResponse(content={"error": "Notification not found"}, status_code=404)
     if event.user_id != current_user._id:
         return JSONResponse(content={"error": "Permission denied"}, status_code=403)
-    event.readed = read
-    await event.save()
+    await event.mark(read)
     return JSONResponse(event.to_json(), status_code=200)
 
+@router.get("/mark_all", tags=["Events"], name="Mark all my events as read")
+async def mark_all_events(
+    current_user: Annotated[User, Depends(get_current_user)]
+) -> JSONResponse:
+    ''' Mark all my events as read '''
+    marked = await Event.mark_all_read(current_user._id)
+    return JSONResponse({"marked": marked}, status_code=200)
+
+@router.get("/unread_count", tags=["Events"], name="Count my unread events")
+async def get_unread_count(
+    current_user: Annotated[User, Depends(get_current_user)]
+) -> JSONResponse:
+    ''' Number of my unread events, for the badge '''
+    unread = await EventCounter.get_unread(current_user._id)
+    return JSONResponse({"unread": unread}, status_code=200)
+
+async def broadcast_event(job: Job, user_ids: list, manager_id: ObjectId, house_id: ObjectId, type: str, title: str, details: str):
+    await job.progress(total=len(user_ids))
+    created_at = datetime.now()
+    for i in range(0, len(user_ids), BROADCAST_CHUNK_SIZE):
+        events = [
+            Event(
+                user_id=user_id,
+                type=type,
+                title=title,
+                details=details,
+                house_id=house_id,
+                manager_id=manager_id,
+                created_at=created_at
+            )
+            for user_id in user_ids[i:i + BROADCAST_CHUNK_SIZE]
+        ]
+        await Event.insert_many(events)
+        await job.progress(done=job.done + len(events))
+    return {"users": len(user_ids)}
+
 @router.get("/add", tags=["Events"], name="Add event")
 async def add_event(
     current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     type: str,
     title: str,
     details: str,
@@ -68,32 +170,17 @@ async def add_event(
     ''' Add event 
     type: ["notification", "news", "system"]
     '''
+    if not access.can_manage(ObjectId(house_id)):
+        return JSONResponse({"error": "You are not manager of this house"}, status_code=403)
     house = await House.get_by_id(house_id)
     if house is None:
         return JSONResponse({"error": "House not found"}, status_code=404)
-    if current_user._id not in house.managers and current_user.role != "admin":
-        return JSONResponse({"error": "You are not manager of this house"}, status_code=403)
     if type not in ["notification", "news", "system"]:
         return JSONResponse({"error": "Invalid event type"}, status_code=400)
-    apartments = await Apartment.get_list(house_id=ObjectId(house_id))
-    if len(apartments) == 0:
-        return JSONResponse({"error": "House has no apartments"}, status_code=400)
-    users = set()
-    for apartment in apartments:
-        for resident_id in apartment.residents:
-            user = await User.get_by_id(resident_id)
-            if user is not None:
-                users.add(user._id)
-    if len(users) == 0:
+    # All residents of the house in one query
+    user_ids = await MongoDB.db.apartments.distinct('residents', {'house_id': house._id})
+    if len(user_ids) == 0:
         return JSONResponse({"error": "No users found"}, status_code=400)
-    for user_id in users:
-        event = Event(
-            user_id=user_id,
-            type=type,
-            title=title,
-            details=details,
-            house_id=house_id,
-            manager_id=current_user._id
-        )
-        await event.save()
-    return JSONResponse({"message": f"Event added to {len(users)} users"}, status_code=200)
\ No newline at end of file
+    # Events are inserted in background, progress is available at /api/v1/jobs/get
+    job = await Jobs.start("broadcast", current_user._id, broadcast_event, user_ids, current_user._id, house._id, type, title, details)
+    return JSONResponse({"message": f"Event is being added to {len(user_ids)} users", "job_id": str(job._id)}, status_code=200)
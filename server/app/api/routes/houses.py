@@ -8,7 +8,8 @@ from bson import ObjectId
 from typing import Annotated
 from datetime import datetime, timedelta
 from uvicorn import Config, Server
-from starlette.responses import JSONResponse
+from urllib.parse import quote
+from starlette.responses import JSONResponse, StreamingResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from fastapi import Depends, FastAPI, HTTPException, status, Request, APIRouter
@@ -17,13 +18,19 @@ from pydantic import BaseModel
 
 from app.settings import SETTINGS
 from app.utils.security import verify_password, hash_password
-from app.utils.tables import *
 from app.objects.user import User
 from app.objects.session import Session
-from app.api.routes.auth import get_current_user
+from app.api.routes.auth import get_current_user, get_access
 
 from app.objects import *
 from app.utils.mongo import MongoDB
+from app.utils.pagination import page_response
+from app.utils.report_jobs import ReportJobs
+from app.utils.reports import build_report
+from app.utils.analytics import build_analytics
+from app.utils.tables import SINKS, StreamSink
+from app.utils.access import Access, AccessCache
+from app.utils.dashboard import build_dashboard, DASHBOARD_MAX_LIMIT
 
 router = APIRouter()
 
@@ -44,16 +51,24 @@ async def get_houses(
     address: str = None,
     manager: str = None,
     skip: int = 0,
-    limit: int = 20
+    limit: int = 20,
+    cursor: str = None,
+    paged: bool = False
 ) -> JSONResponse:
-    ''' Get houses list '''
-    houses = await House.get_list(
-        address=address,
-        manager=manager,
-        skip=skip,
-        limit=limit
-    )
-    return JSONResponse([h.to_json() for h in houses], status_code=200)
+    ''' Get houses list
+    paged=true returns {items, next_cursor}, pass next_cursor as cursor to get the next page
+    '''
+    try:
+        houses = await House.get_list(
+            address=address,
+            manager=manager,
+            skip=skip,
+            limit=limit,
+            cursor=cursor
+        )
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return page_response(houses, House.order, limit, paged, cursor)
 
 @router.get("/add", tags=["Houses"], name="Add house")
 async def add_house(
@@ -93,6 +108,7 @@ async def remove_house(
         return JSONResponse({"error": "House not found"}, status_code=404)
     # Remove house and return it
     await MongoDB.db.houses.delete_one({'_id': ObjectId(house_id)})
+    AccessCache.invalidate(*house.managers)
     return JSONResponse({"message": f"House {house_id} removed"}, status_code=200)
 
 @router.get("/managers/add", tags=["Houses"], name="Add manager to house")
@@ -119,6 +135,7 @@ async def add_manager_to_house(
     # Add manager and return it
     house.managers.append(ObjectId(manager_id))
     await house.save()
+    AccessCache.invalidate(user._id)
     return JSONResponse(house.to_json(), status_code=200)
 
 @router.get("/managers/remove", tags=["Houses"], name="Remove manager from house")
@@ -145,24 +162,25 @@ async def remove_manager_from_house(
     # Remove manager and return it
     house.managers.remove(ObjectId(manager_id))
     await house.save()
+    AccessCache.invalidate(user._id)
     return JSONResponse(house.to_json(), status_code=200)
 
 @router.get("/info/update", tags=["Houses"], name="Update house info")
 async def set_info_house(
-    current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     house_id: str,
     info: str = "",
     start_readings_day: int = 0,
     end_readings_day: int = 0
 ) -> JSONResponse:
     ''' Set house info '''
+    # Check user role
+    if not access.can_manage(ObjectId(house_id)):
+        return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
     # Check if house exists
     house = await House.get_by_id(ObjectId(house_id))
     if house is None:
         return JSONResponse({"error": "House not found"}, status_code=404)
-    # Check user role
-    if current_user.role != "admin" and current_user._id not in house.managers:
-        return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
     # Set info and return it
     if (info != ""): house.info = info
     if (start_readings_day != ""): house.start_readings_day = start_readings_day
@@ -170,131 +188,125 @@ async def set_info_house(
     await house.save()
     return JSONResponse(house.to_json(), status_code=200)
 
-
-async def get_table(house_id, counter_type, year, month):
+@router.get("/analytics", tags=["Houses"], name="House consumption analytics")
+async def get_analytics(
+    access: Annotated[Access, Depends(get_access)],
+    house_id: str,
+    year: int = None,
+    years: int = 5
+) -> JSONResponse:
+    ''' Consumption of house for year (current by default): per apartment monthly,
+    per type, per entrance and floor totals, and comparison with previous years '''
+    if not access.can_manage(ObjectId(house_id)):
+        return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
     house = await House.get_by_id(ObjectId(house_id))
+    if house is None:
+        return JSONResponse({"error": "House not found"}, status_code=404)
+    if years < 1 or years > 20:
+        return JSONResponse({"error": "Years must be between 1 and 20"}, status_code=400)
+    year = year if year is not None else datetime.now().year
+    result = await build_analytics(house, year, years)
+    return JSONResponse(result, status_code=200)
 
-    i = 1
-    table = []
-
-    # Get all apartments of the house
-    apartments = await Apartment.get_list(house_id=ObjectId(house_id))
-    # Form apartments ids list for query
-    apartment_ids = [apartment._id for apartment in apartments]
-    logging.info(f"Found {len(apartment_ids)} apartments")
-    # Get counters
-    cursor = MongoDB.db.counters.find({"apartment_id": {"$in": apartment_ids}, "type": counter_type})
-    counters = [Counter(**data) async for data in cursor]
-    logging.info(f"Found {len(counters)} counters")
-    # Get new readings
-    cursor = MongoDB.db.readings.find(
-        {
-            "year": year,
-            "month": month,
-            "counter_id": {"$in": [counter._id for counter in counters]}
-        }
-    )
-    readings = [Reading(**data) async for data in cursor]
-    logging.info(f"Found {len(readings)} readings this month")
-
-    # Get prev readings
-    prev_month = month - 1
-    prev_year = year
-    if prev_month == 0:
-        prev_month = 12
-        prev_year -= 1
-    cursor = MongoDB.db.readings.find(
-        {
-            "year": prev_year,
-            "month": prev_month,
-            "counter_id": {"$in": [counter._id for counter in counters]}
-        }
-    )
-    old_readings = [Reading(**data) async for data in cursor]
-    logging.info(f"Found {len(old_readings)} readings previous month")
-    
-    # Prepare dicts for fast search
-    apartment_to_counters = {}
-    for counter in counters:
-        if counter.apartment_id not in apartment_to_counters:
-            apartment_to_counters[counter.apartment_id] = [counter]
-        else:
-            apartment_to_counters[counter.apartment_id].append(counter)
-    counters_to_readings = {}
-    for reading in readings:
-        counters_to_readings[reading.counter_id] = reading
-    counters_to_old_readings = {}
-    for reading in old_readings:
-        counters_to_old_readings[reading.counter_id] = reading
-
-    # Form table
-    i = 1
-    for apartment in apartments:
-        apartment_name = f"{house.address}, кв. {apartment.number}"
-        # if apartment doesn't have counters
-        if apartment._id not in apartment_to_counters:
-            table.append([str(i), apartment_name, "нет приборов учета", "", "", "огульно"])
-            i += 1
-            continue
-        # if apartment has counters
-        firstRow = True
-        for counter in apartment_to_counters[apartment._id]:
-            prev_value = None
-            new_value = None
+@router.get("/dashboard", tags=["Houses"], name="House readings dashboard")
+async def get_dashboard(
+    access: Annotated[Access, Depends(get_access)],
+    house_id: str,
+    year: int = None,
+    month: int = None,
+    limit: int = 1000,
+    cursor: str = None
+) -> JSONResponse:
+    ''' Apartments of house with their counters and reading status for month (current by default),
+    pages follow apartment order, pass next_cursor to get the next one '''
+    if not access.can_manage(ObjectId(house_id)):
+        return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
+    now = datetime.now()
+    year = year if year is not None else now.year
+    month = month if month is not None else now.month
+    if month < 1 or month > 12:
+        return JSONResponse({"error": "Invalid month"}, status_code=400)
+    if limit < 1 or limit > DASHBOARD_MAX_LIMIT:
+        return JSONResponse({"error": f"Limit must be between 1 and {DASHBOARD_MAX_LIMIT}"}, status_code=400)
+    try:
+        result = await build_dashboard(ObjectId(house_id), year, month, limit, cursor)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(result, status_code=200)
 
-            if counter._id in counters_to_old_readings:
-                prev_value = counters_to_old_readings[counter._id].value
-            if counter._id in counters_to_readings:
-                new_value = counters_to_readings[counter._id].value
-            
-            if prev_value is not None and new_value is not None:
-                table.append([str(i) if firstRow else "", apartment_name, counter.serial_number, prev_value, new_value, new_value - prev_value])
-            elif prev_value is None and new_value is None:
-                table.append([str(i) if firstRow else "", apartment_name, counter.serial_number, "", "", 0])
-            elif prev_value is None:
-                table.append([str(i) if firstRow else "", apartment_name, counter.serial_number, "", new_value, new_value])
-            elif new_value is None:
-                table.append([str(i) if firstRow else "", apartment_name, counter.serial_number, prev_value, "", 0])
-            if firstRow: i += 1
-            firstRow = False
-        
-    return table
+@router.get("/submissions", tags=["Houses"], name="Readings submission progress")
+async def get_submissions(
+    access: Annotated[Access, Depends(get_access)],
+    house_id: str,
+    year: int = None,
+    month: int = None
+) -> JSONResponse:
+    ''' How many active counters of house have readings for month (current by default), per type,
+    along with the house readings window '''
+    if not access.can_manage(ObjectId(house_id)):
+        return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
+    house = await House.get_by_id(ObjectId(house_id))
+    if house is None:
+        return JSONResponse({"error": "House not found"}, status_code=404)
+    now = datetime.now()
+    year = year if year is not None else now.year
+    month = month if month is not None else now.month
+    if month < 1 or month > 12:
+        return JSONResponse({"error": "Invalid month"}, status_code=400)
+    stats = await SubmissionStats.get(house._id, year, month)
+    result = stats.to_json()
+    result["start_readings_day"] = house.start_readings_day
+    result["end_readings_day"] = house.end_readings_day
+    result["window_open"] = (year, month) == (now.year, now.month) and \
+        house.start_readings_day <= now.day <= house.end_readings_day
+    return JSONResponse(result, status_code=200)
 
 @router.get("/form_table", tags=["Houses"], name="Form reading table")
 async def form_table(
     current_user: Annotated[User, Depends(get_current_user)],
+    access: Annotated[Access, Depends(get_access)],
     house_id: str,
     year: int,
-    month: int
+    month: int,
+    format: str = "sheets"
 ) -> JSONResponse:
-    house = await House.get_by_id(ObjectId(house_id))
-    if current_user.role != "admin" and current_user._id not in house.managers:
+    ''' Form reading table
+    format: ["sheets", "xlsx", "csv"], sheets starts a job (poll /form_table/status for its result),
+    xlsx and csv files are generated in process and returned right away
+    '''
+    if not access.can_manage(ObjectId(house_id)):
         return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
+    house = await House.get_by_id(ObjectId(house_id))
+    if house is None:
+        return JSONResponse({"error": "House not found"}, status_code=404)
     if month < 1 or month > 12:
         return JSONResponse({"error": "Invalid month"}, status_code=400)
     if year < 2020 or year > 2100:
         return JSONResponse({"error": "Invalid year"}, status_code=400)
-    
-    loop = asyncio.get_running_loop()
-
-    # run tasks
-    tasks = [
-        loop.create_task(get_table(house_id, "electricity", year, month)),
-        loop.create_task(get_table(house_id, "hot_water", year, month)),
-        loop.create_task(get_table(house_id, "cold_water", year, month)),
-    ]
+    if format not in SINKS:
+        return JSONResponse({"error": "Invalid format"}, status_code=400)
 
-    await asyncio.gather(*tasks)
-    electricity_table = tasks[0].result()
-    hot_water_table = tasks[1].result()
-    cold_water_table = tasks[2].result()
-    
-    sa = get_service_account()
-    sh = create_spreadsheet(house.address, year, month)
-    print(sh.url)
-    write_table(sh, house.address, "electricity", electricity_table)
-    write_table(sh, house.address, "hot_water", hot_water_table)
-    write_table(sh, house.address, "cold_water", cold_water_table)
-    sh.del_worksheet(sh.worksheets()[0])
+    sink = SINKS[format]
+    if isinstance(sink, StreamSink):
+        report = await build_report(house, year, month)
+        filename = quote(sink.filename(house.address, year, month))
+        return StreamingResponse(
+            sink.stream(house.address, report["tables"]),
+            media_type=sink.media_type,
+            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
+        )
+    job = await ReportJobs.submit(house, year, month, current_user._id)
+    return JSONResponse({"job_id": str(job._id), "status": job.status}, status_code=200)
 
-    return JSONResponse({"result": sh.url}, status_code=200)
\ No newline at end of file
+@router.get("/form_table/status", tags=["Houses"], name="Get reading table job")
+async def form_table_status(
+    access: Annotated[Access, Depends(get_access)],
+    job_id: str
+) -> JSONResponse:
+    ''' Report job status, result is the spreadsheet url '''
+    job = await ReportJob.get_by_id(ObjectId(job_id))
+    if job is None:
+        return JSONResponse({"error": "Job not found"}, status_code=404)
+    if not access.can_manage(job.house_id):
+        return JSONResponse({"error": "You are not admin or manager of this house"}, status_code=403)
+    return JSONResponse(job.to_json(), status_code=200)
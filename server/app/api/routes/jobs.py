@@ -0,0 +1,23 @@
+from typing import Annotated
+from starlette.responses import JSONResponse
+
+from fastapi import Depends, APIRouter
+
+from app.objects.user import User
+from app.api.routes.auth import get_current_user
+from app.utils.jobs import Jobs
+
+router = APIRouter()
+
+@router.get("/get", tags=["Jobs"], name="Get background job")
+async def get_job(
+    current_user: Annotated[User, Depends(get_current_user)],
+    job_id: str
+) -> JSONResponse:
+    ''' Get background job status and progress '''
+    job = await Jobs.get(job_id)
+    if job is None:
+        return JSONResponse({"error": "Job not found"}, status_code=404)
+    if current_user.role != "admin" and job.user_id != current_user._id:
+        return JSONResponse({"error": "Permission denied"}, status_code=403)
+    return JSONResponse(job.to_json(), status_code=200)
@@ -10,4 +10,12 @@ class RegisterData(BaseModel):
     email: str
     password: str
     name: str
-    surname: str
\ No newline at end of file
+    surname: str
+
+class CounterValue(BaseModel):
+    counter_id: str
+    value: float
+
+class ReadingsSubmit(BaseModel):
+    apartment_id: str
+    readings: List[CounterValue]
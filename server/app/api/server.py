@@ -5,12 +5,14 @@ from uvicorn import Config, Server
 from starlette.responses import JSONResponse
 
 from app.settings import SETTINGS
+from app.utils.loader import start_request
 
 from app.api.routes.auth import router as auth_router
 from app.api.routes.houses import router as houses_router
 from app.api.routes.counters import router as counters_router
 from app.api.routes.apartments import router as apartments_router
 from app.api.routes.events import router as events_router
+from app.api.routes.jobs import router as jobs_router
 
 app = FastAPI()
 app.include_router(auth_router)
@@ -18,6 +20,13 @@ app.include_router(houses_router, prefix="/api/v1/houses")
 app.include_router(counters_router, prefix="/api/v1/counters")
 app.include_router(apartments_router, prefix="/api/v1/apartments")
 app.include_router(events_router, prefix="/api/v1/events")
+app.include_router(jobs_router, prefix="/api/v1/jobs")
+
+@app.middleware("http")
+async def request_loaders(request, call_next):
+    # Batching loaders live as long as one request
+    start_request()
+    return await call_next(request)
 
 @app.get("/")
 async def homepage_get(self):
@@ -0,0 +1,119 @@
+import sys
+import logging
+
+from typing import List
+
+from app.settings import SETTINGS
+from app.utils.mongo import MongoDB
+from app.objects import MODELS, User, Counter, ReadingBucket, Consumption, EventCounter, SubmissionStats
+from app.objects.reading_store import STORES, migrate, backfill_periods
+from app.utils.anomalies import detect_anomalies
+
+async def check_indexes(*args) -> int:
+    ''' Fail if a declared index is missing or any known query shape scans a whole collection '''
+    missing = await MongoDB.setup_indexes(MODELS)
+    for name in missing:
+        logging.error(f'Missing index: {name}')
+    failed = await MongoDB.check_indexes(MODELS)
+    for query in failed:
+        logging.error(f'COLLSCAN: {query}')
+    if not failed:
+        logging.info('All query shapes use indexes')
+    return 1 if failed or missing else 0
+
+async def find_duplicates(action: str = None, *args) -> int:
+    ''' List documents breaking unique indexes: find-duplicates [remove].
+    remove keeps the newest document of every group. Users and counters are only listed because
+    other documents point to them, reading buckets because each holds different readings:
+    those have to be merged by hand '''
+    if action not in (None, 'remove'):
+        print("Usage: find-duplicates [remove]", file=sys.stderr)
+        return 2
+    found = 0
+    removed = 0
+    left = 0
+    for model in MODELS:
+        for index in model.indexes:
+            if not index.document.get('unique'):
+                continue
+            groups = await MongoDB.find_duplicates(model, index)
+            for group in groups:
+                logging.warning(f"Duplicates in {model.collection}.{index.document['name']} {group['key']}: {', '.join(map(str, group['ids']))}")
+            found += len(groups)
+            if action != 'remove' or not groups:
+                continue
+            if model in (User, Counter, ReadingBucket):
+                logging.error(f'Not removing duplicates of {model.collection}, merge them by hand')
+                left += len(groups)
+                continue
+            # _id grows with insertion time, the last one is the newest
+            stale = [_id for group in groups for _id in group['ids'][:-1]]
+            deleted = await MongoDB.db[model.collection].delete_many({'_id': {'$in': stale}})
+            removed += deleted.deleted_count
+    if not found:
+        logging.info('No duplicates')
+        return 0
+    if action != 'remove':
+        return 1
+    logging.info(f'Removed {removed} duplicates, run check-indexes, rebuild-consumption and rebuild-submissions')
+    return 1 if left else 0
+
+async def rebuild_consumption(*args) -> int:
+    ''' Regenerate consumption_monthly from readings in place, safe while the server writes readings:
+    months written meanwhile are newer and kept. Clocks of workers and this host must agree '''
+    await Consumption.rebuild()
+    return 0
+
+async def rebuild_unread(*args) -> int:
+    ''' Recount unread events of every user, required once after upgrading to unread counters '''
+    await EventCounter.rebuild()
+    return 0
+
+async def rebuild_submissions(*args) -> int:
+    ''' Recount submission_stats from counters and consumption_monthly '''
+    await SubmissionStats.rebuild()
+    return 0
+
+async def migrate_readings(target: str = None, *args) -> int:
+    ''' Copy readings into another layout: migrate-readings documents|buckets '''
+    if target not in STORES:
+        print(f"Usage: migrate-readings {'|'.join(STORES)}", file=sys.stderr)
+        return 2
+    source = SETTINGS.READINGS_STORAGE
+    if source == target:
+        logging.info(f'Readings are already stored as {target}')
+        return 0
+    count = await migrate(source, target)
+    logging.info(f'Migrated readings from {source} to {target}: {count} documents, set READINGS_STORAGE={target} to switch')
+    return 0
+
+async def backfill_readings_period(batch_size: str = '1000', *args) -> int:
+    ''' Add the period key to readings stored as documents, safe to interrupt and rerun '''
+    await MongoDB.setup_indexes(MODELS)
+    count = await backfill_periods(int(batch_size))
+    logging.info(f'Backfilled period of {count} readings')
+    return 0
+
+async def detect(*args) -> int:
+    ''' One anomaly detection run, for cron when the in-process schedule is off '''
+    await MongoDB.setup_indexes(MODELS)
+    await detect_anomalies()
+    return 0
+
+COMMANDS = {
+    'check-indexes': check_indexes,
+    'find-duplicates': find_duplicates,
+    'rebuild-consumption': rebuild_consumption,
+    'rebuild-unread': rebuild_unread,
+    'rebuild-submissions': rebuild_submissions,
+    'migrate-readings': migrate_readings,
+    'backfill-readings-period': backfill_readings_period,
+    'detect-anomalies': detect,
+}
+
+async def run(name: str, args: List[str] = []) -> int:
+    if name not in COMMANDS:
+        print(f"Unknown command {name}, available: {', '.join(COMMANDS)}", file=sys.stderr)
+        return 2
+    MongoDB.setup(SETTINGS.MONGODB_URL.get_secret_value(), SETTINGS.MONGODB_DB.get_secret_value())
+    return await COMMANDS[name](*args)
@@ -4,3 +4,13 @@ from app.objects.session import Session
 from app.objects.apartment import Apartment
 from app.objects.counter import Counter, Reading
 from app.objects.event import Event
+from app.objects.event_counter import EventCounter
+from app.objects.report_job import ReportJob
+from app.objects.job import Job
+from app.objects.consumption import Consumption
+from app.objects.reading_store import ReadingBucket
+from app.objects.anomaly import Anomaly
+from app.objects.submission_stats import SubmissionStats
+
+
+MODELS = [User, House, Session, Apartment, Counter, Reading, Event, ReportJob, Job, Consumption, ReadingBucket, Anomaly, EventCounter, SubmissionStats]
\ No newline at end of file
@@ -0,0 +1,101 @@
+from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+
+from typing import List
+from datetime import datetime
+from app.utils.mongo import MongoDB
+from app.objects.base import Model
+
+class Anomaly(Model):
+    ''' Suspicious consumption of a counter in a month, managers are alerted once per anomaly '''
+    collection = 'anomalies'
+    indexes = [
+        IndexModel(
+            [('counter_id', ASCENDING), ('year', DESCENDING), ('month', DESCENDING), ('kind', ASCENDING)],
+            name='counter_id_year_month_kind',
+            unique=True
+        ),
+        IndexModel([('house_id', ASCENDING), ('created_at', DESCENDING)], name='house_id_created_at'),
+    ]
+    queries = [
+        {'filter': {'counter_id': ObjectId(), 'year': 2024, 'month': 1}},
+        {'filter': {'house_id': ObjectId()}, 'sort': [('created_at', -1)]},
+    ]
+    fields = ('house_id', 'apartment_id', 'counter_id', 'type', 'year', 'month', 'kind', 'delta', 'expected', 'created_at')
+    __slots__ = ('_id',) + fields
+
+    _id: ObjectId
+    house_id: ObjectId
+    apartment_id: ObjectId
+    counter_id: ObjectId
+    type: str
+    year: int
+    month: int
+    # spike, zero, decrease
+    kind: str
+    # Consumption of the month
+    delta: float
+    # What the counter's own history or its peers suggest, None when not compared
+    expected: float | None
+    created_at: datetime
+
+    def __init__(
+        self,
+        house_id: ObjectId,
+        apartment_id: ObjectId,
+        counter_id: ObjectId,
+        type: str,
+        year: int,
+        month: int,
+        kind: str,
+        delta: float,
+        expected: float = None,
+        created_at: datetime = None,
+        _id: ObjectId = None
+    ) -> None:
+        self._id = _id
+        self.house_id = house_id
+        self.apartment_id = apartment_id
+        self.counter_id = counter_id
+        self.type = type
+        self.year = year
+        self.month = month
+        self.kind = kind
+        self.delta = delta
+        self.expected = expected
+        self.created_at = created_at if created_at is not None else datetime.now()
+
+    def to_json(self):
+        return {
+            'id': str(self._id),
+            'house_id': str(self.house_id),
+            'apartment_id': str(self.apartment_id),
+            'counter_id': str(self.counter_id),
+            'type': self.type,
+            'year': self.year,
+            'month': self.month,
+            'kind': self.kind,
+            'delta': self.delta,
+            'expected': self.expected,
+            'created_at': self.created_at.strftime('%Y-%m-%d')
+        }
+
+    @classmethod
+    async def insert_new(cls, anomalies: List) -> List:
+        ''' Insert anomalies, return only those not recorded before '''
+        if not anomalies:
+            return []
+        documents = [{'_id': ObjectId(), **anomaly.__dict__()} for anomaly in anomalies]
+        for anomaly, document in zip(anomalies, documents):
+            anomaly._id = document['_id']
+        try:
+            await MongoDB.db.anomalies.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Duplicates were already alerted, anything else is a real failure
+            errors = e.details['writeErrors']
+            if any(error['code'] != 11000 for error in errors):
+                raise
+            failed = {error['index'] for error in errors}
+            return [anomaly for i, anomaly in enumerate(anomalies) if i not in failed]
+        return anomalies
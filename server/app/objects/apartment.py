@@ -1,11 +1,32 @@
 from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
 
 from typing import List
 from datetime import datetime
 from app.utils.mongo import MongoDB
+from app.objects.base import Model
 from app.objects.user import User
+from app.utils.loader import load_many
+from app.utils.pagination import keyset_filter
+
+class Apartment(Model):
+    collection = 'apartments'
+    indexes = [
+        IndexModel([('house_id', ASCENDING), ('number', DESCENDING), ('_id', DESCENDING)], name='house_id_number'),
+        IndexModel([('residents', ASCENDING)], name='residents'),
+        IndexModel([('owner_id', ASCENDING)], name='owner_id'),
+    ]
+    queries = [
+        {'filter': {'house_id': ObjectId()}, 'sort': [('number', -1), ('_id', -1)]},
+        {'filter': {'house_id': ObjectId(), 'number': '1'}, 'sort': [('number', -1), ('_id', -1)]},
+        {'filter': {'residents': ObjectId()}, 'sort': [('number', -1), ('_id', -1)]},
+        {'filter': {'$or': [{'residents': ObjectId()}, {'owner_id': ObjectId()}]}},
+    ]
+    # Page order, cursors are built from these fields
+    order = [('number', -1), ('_id', -1)]
+    fields = ('house_id', 'owner_id', 'entrance', 'floor', 'number', 'residents')
+    __slots__ = ('_id',) + fields
 
-class Apartment:
     _id: ObjectId
     house_id: ObjectId
     owner_id: ObjectId
@@ -21,7 +42,7 @@ class Apartment:
         entrance: str,
         floor: str,
         number: str,
-        residents: List[ObjectId] = [],
+        residents: List[ObjectId] = None,
         _id: ObjectId = None
     ) -> None:
         self._id = _id
@@ -30,17 +51,7 @@ class Apartment:
         self.entrance = entrance
         self.floor = floor
         self.number = number
-        self.residents = residents
-
-    def __dict__(self):
-        return {
-            'house_id': self.house_id,
-            'owner_id': self.owner_id,
-            'entrance': self.entrance,
-            'floor': self.floor,
-            'number': self.number,
-            'residents': self.residents,
-        }
+        self.residents = residents if residents is not None else []
     
     def to_json(self):
         return {
@@ -50,7 +61,7 @@ class Apartment:
             'entrance': str(self.entrance),
             'floor': self.floor,
             'number': self.number,
-            'residents': list(map(str, self.residents)),
+            'residents': list(map(str, self.residents or [])),
         }
     
     async def to_extended_json(self):
@@ -61,26 +72,9 @@ class Apartment:
             'entrance': self.entrance,
             'floor': self.floor,
             'number': self.number,
-            'residents': [(await User.get_by_id(ObjectId(r))).to_json() for r in self.residents]
+            'residents': [u.to_json() for u in await load_many(User, self.residents) if u is not None]
         }
     
-    async def save(self):
-        if self._id is None:
-            inserted = await MongoDB.db.apartments.insert_one(self.__dict__())
-            self._id = inserted.inserted_id
-        else:
-            await MongoDB.db.apartments.update_one(
-                {'_id': self._id},
-                {'$set': self.__dict__()}
-            )
-    
-    @classmethod
-    async def get_by_id(cls, _id: ObjectId):
-        data = await MongoDB.db.apartments.find_one({'_id': _id})
-        if data is None:
-            return None
-        return cls(**data)
-    
     @classmethod
     async def get_list(
         cls, 
@@ -91,7 +85,9 @@ class Apartment:
         floor: str = None,
         number: str = None,
         skip: int = 0,
-        limit: int = 20
+        limit: int = 20,
+        fields: List[str] = None,
+        cursor: str = None
     ) -> List:
         filter = {}
         if house_id is not None: filter['house_id'] = house_id
@@ -100,8 +96,9 @@ class Apartment:
         if entrance is not None: filter['entrance'] = entrance
         if floor is not None: filter['floor'] = floor
         if number is not None: filter['number'] = number
-        cursor = MongoDB.db.apartments.find(filter, skip=skip, limit=limit, sort=[("number", -1)])
+        filter = keyset_filter(filter, cls.order, cursor)
+        cursor = MongoDB.db.apartments.find(filter, cls.projection(fields), skip=skip, limit=limit, sort=cls.order)
         result = []
         async for data in cursor:
-            result.append(cls(**data))
-        return result
\ No newline at end of file
+            result.append(cls.from_bson(data))
+        return result
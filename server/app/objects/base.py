@@ -0,0 +1,52 @@
+from bson import ObjectId
+
+from typing import List
+from app.utils.mongo import MongoDB
+
+class Model:
+    ''' Compact base of all objects, instances keep fields in __slots__ '''
+    __slots__ = ()
+    collection: str
+    indexes: List = []
+    queries: List = []
+    # Stored fields, in document order
+    fields: tuple = ()
+
+    def __dict__(self):
+        return {name: getattr(self, name) for name in self.fields}
+
+    @classmethod
+    def from_bson(cls, data: dict):
+        ''' Build object straight from a Mongo document, fields missing from projection are None '''
+        obj = cls.__new__(cls)
+        obj._id = data.get('_id')
+        for name in cls.fields:
+            setattr(obj, name, data.get(name))
+        return obj
+
+    @classmethod
+    def projection(cls, fields: List[str] | None) -> List[str] | None:
+        if fields is None:
+            return None
+        unknown = set(fields) - set(cls.fields) - {'_id'}
+        if unknown:
+            raise ValueError(f"Unknown fields of {cls.__name__}: {', '.join(sorted(unknown))}")
+        return list(fields)
+
+    async def save(self):
+        collection = MongoDB.db[self.collection]
+        if self._id is None:
+            inserted = await collection.insert_one(self.__dict__())
+            self._id = inserted.inserted_id
+        else:
+            await collection.update_one(
+                {'_id': self._id},
+                {'$set': self.__dict__()}
+            )
+
+    @classmethod
+    async def get_by_id(cls, _id: ObjectId):
+        data = await MongoDB.db[cls.collection].find_one({'_id': ObjectId(_id)})
+        if data is None:
+            return None
+        return cls.from_bson(data)
@@ -0,0 +1,219 @@
+import logging
+
+from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+
+from typing import List
+from datetime import datetime
+from app.utils.mongo import MongoDB
+from app.objects.base import Model
+from app.objects.counter import Counter, Reading
+from app.objects.reading_store import period_expression
+
+class Consumption(Model):
+    ''' Monthly consumption rollup: one document per counter reading month,
+    kept up to date whenever readings are added or removed '''
+    collection = 'consumption_monthly'
+    indexes = [
+        IndexModel(
+            [('counter_id', ASCENDING), ('year', DESCENDING), ('month', DESCENDING)],
+            name='counter_id_year_month',
+            unique=True
+        ),
+        IndexModel([('house_id', ASCENDING), ('year', ASCENDING), ('month', ASCENDING)], name='house_id_year_month'),
+    ]
+    queries = [
+        {'filter': {'house_id': ObjectId(), 'year': 2024, 'month': 1}},
+        {'filter': {'house_id': ObjectId(), 'year': {'$gte': 2020, '$lte': 2024}}},
+        {'filter': {'counter_id': ObjectId(), 'year': 2024, 'month': 1}},
+    ]
+    fields = (
+        'house_id', 'apartment_id', 'counter_id', 'type', 'year', 'month',
+        'prev_value', 'value', 'delta', 'created_at', 'updated_at'
+    )
+    __slots__ = ('_id',) + fields
+
+    _id: ObjectId
+    house_id: ObjectId
+    apartment_id: ObjectId
+    counter_id: ObjectId
+    type: str
+    year: int
+    month: int
+    # Value of the previous reading of the counter, None for the first one
+    prev_value: float | None
+    value: float
+    delta: float | None
+    # When the reading was made
+    created_at: datetime
+    updated_at: datetime
+
+    def to_json(self):
+        return {
+            'id': str(self._id),
+            'house_id': str(self.house_id),
+            'apartment_id': str(self.apartment_id),
+            'counter_id': str(self.counter_id),
+            'type': self.type,
+            'year': self.year,
+            'month': self.month,
+            'prev_value': self.prev_value,
+            'value': self.value,
+            'delta': self.delta,
+            'created_at': self.created_at.strftime('%Y-%m-%d') if self.created_at else None
+        }
+
+    @classmethod
+    def document(cls, house_id: ObjectId, apartment_id: ObjectId, counter_id: ObjectId, type: str, reading: Reading, previous: Reading | None) -> dict:
+        prev_value = previous.value if previous is not None else None
+        return {
+            'house_id': house_id,
+            'apartment_id': apartment_id,
+            'counter_id': counter_id,
+            'type': type,
+            'year': reading.year,
+            'month': reading.month,
+            'prev_value': prev_value,
+            'value': reading.value,
+            'delta': round(reading.value - prev_value, 3) if prev_value is not None else None,
+            'created_at': reading.created_at,
+            'updated_at': datetime.now()
+        }
+
+    @classmethod
+    async def refresh(cls, counter: Counter, house_id: ObjectId, months: List[tuple], session=None) -> None:
+        ''' Recompute rollup of counter for (year, month) whose readings changed,
+        the month after each of them changes its previous value too.
+        Reads the previous, the changed and the next reading of every month, nothing else '''
+        operations = []
+        for year, month in months:
+            previous, current, following = await Reading.get_around(counter._id, year, month, session=session)
+            filter = {'counter_id': counter._id, 'year': year, 'month': month}
+            if current is None:
+                operations.append(DeleteOne(filter))
+            else:
+                document = cls.document(house_id, counter.apartment_id, counter._id, counter.type, current, previous)
+                operations.append(UpdateOne(filter, {'$set': document}, upsert=True))
+            if following is not None:
+                document = cls.document(house_id, counter.apartment_id, counter._id, counter.type, following, current or previous)
+                operations.append(UpdateOne(
+                    {'counter_id': counter._id, 'year': following.year, 'month': following.month},
+                    {'$set': document},
+                    upsert=True
+                ))
+        if operations:
+            await MongoDB.db.consumption_monthly.bulk_write(operations, ordered=False, session=session)
+
+    @classmethod
+    async def add_latest(cls, house_id: ObjectId, entries: List[tuple], session=None) -> None:
+        ''' Rollup of readings whose previous reading is known in one write,
+        entries are (counter, reading, previous reading or None) '''
+        operations = [
+            UpdateOne(
+                {'counter_id': counter._id, 'year': reading.year, 'month': reading.month},
+                {'$set': cls.document(house_id, counter.apartment_id, counter._id, counter.type, reading, previous)},
+                upsert=True
+            )
+            for counter, reading, previous in entries
+        ]
+        if operations:
+            await MongoDB.db.consumption_monthly.bulk_write(operations, ordered=False, session=session)
+
+    @classmethod
+    async def remove_counter(cls, counter_id: ObjectId) -> None:
+        await MongoDB.db.consumption_monthly.delete_many({'counter_id': counter_id})
+
+    @classmethod
+    async def get_house_months(cls, house_id: ObjectId, months: List[tuple], fields: List[str] = None) -> List:
+        cursor = MongoDB.db.consumption_monthly.find(
+            {'house_id': house_id, '$or': [{'year': year, 'month': month} for year, month in months]},
+            cls.projection(fields)
+        )
+        return [cls.from_bson(data) async for data in cursor]
+
+    @classmethod
+    async def get_series(cls, start_year: int, end_year: int, house_id: ObjectId = None) -> List[dict]:
+        ''' Consumption of every counter (of house) over years, one document per counter:
+        {_id: counter_id, house_id, apartment_id, type, periods: [period_of(year, month)], deltas: [...]},
+        delta is None for months without a previous reading '''
+        match = {'year': {'$gte': start_year, '$lte': end_year}}
+        if house_id is not None: match['house_id'] = house_id
+        cursor = MongoDB.db.consumption_monthly.aggregate([
+            {'$match': match},
+            {'$group': {
+                '_id': '$counter_id',
+                'house_id': {'$first': '$house_id'},
+                'apartment_id': {'$first': '$apartment_id'},
+                'type': {'$first': '$type'},
+                'periods': {'$push': period_expression('$year', '$month')},
+                'deltas': {'$push': {'$ifNull': ['$delta', None]}},
+            }},
+        ], allowDiskUse=True)
+        return await cursor.to_list(None)
+
+    @classmethod
+    async def rebuild(cls, batch_size: int = 1000) -> int:
+        ''' Regenerate the whole rollup from readings in place, the server may keep writing meanwhile:
+        months written by reading changes since the start are newer than what was read here and
+        are kept, months of readings removed while their batch was written are dropped again,
+        months no reading backs are deleted at the end. Compares updated_at, so worker clocks must agree '''
+        started = datetime.now()
+        apartments = {}
+        async for data in MongoDB.db.apartments.find({}, {'house_id': 1}):
+            apartments[data['_id']] = data['house_id']
+        counters = {}
+        async for data in MongoDB.db.counters.find({}, {'apartment_id': 1, 'type': 1}):
+            counters[data['_id']] = Counter.from_bson(data)
+
+        count = 0
+        batch = []
+        previous = None
+        async for reading in Reading.store.iterate_all():
+            counter = counters.get(reading.counter_id)
+            if counter is None or counter.apartment_id not in apartments:
+                continue
+            if previous is not None and previous.counter_id != reading.counter_id:
+                previous = None
+            batch.append((reading, cls.document(apartments[counter.apartment_id], counter.apartment_id, counter._id, counter.type, reading, previous)))
+            previous = reading
+            if len(batch) >= batch_size:
+                count += await cls._rebuild_batch(batch, started)
+                batch = []
+        if batch:
+            count += await cls._rebuild_batch(batch, started)
+        # Neither rebuilt nor written since the start: counter, apartment or reading is gone
+        deleted = await MongoDB.db.consumption_monthly.delete_many({'updated_at': {'$lt': started}})
+        logging.info(f'Rebuilt {cls.collection}: {count} documents, {deleted.deleted_count} removed')
+        return count
+
+    @classmethod
+    async def _rebuild_batch(cls, batch: List[tuple], started: datetime) -> int:
+        ''' Write (reading, document) pairs unless the month was written since started '''
+        written_at = datetime.now()
+        operations = []
+        for _, document in batch:
+            filter = {'counter_id': document['counter_id'], 'year': document['year'], 'month': document['month']}
+            # A newer month does not match, its upsert fails on the unique index and is skipped
+            operations.append(UpdateOne(
+                {**filter, 'updated_at': {'$lt': started}},
+                {'$set': {**document, 'updated_at': written_at}},
+                upsert=True
+            ))
+        skipped = 0
+        try:
+            await MongoDB.db.consumption_monthly.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            if any(error['code'] != 11000 for error in errors):
+                raise
+            skipped = len(errors)
+        # Readings removed after they were read here: their month would come back to life
+        existing = await Reading.existing([reading._id for reading, _ in batch])
+        removed = [reading for reading, _ in batch if reading._id not in existing]
+        if removed:
+            await MongoDB.db.consumption_monthly.bulk_write([
+                DeleteOne({'counter_id': reading.counter_id, 'year': reading.year, 'month': reading.month, 'updated_at': written_at})
+                for reading in removed
+            ], ordered=False)
+        return len(batch) - skipped - len(removed)
@@ -1,10 +1,35 @@
 from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
 
 from typing import List
 from datetime import datetime
 from app.utils.mongo import MongoDB
+from app.objects.base import Model
+from app.settings import SETTINGS
+from app.objects.reading_store import make_store, period_of
+
+class Reading(Model):
+    collection = 'readings'
+    indexes = [
+        IndexModel(
+            [('counter_id', ASCENDING), ('year', DESCENDING), ('month', DESCENDING)],
+            name='counter_id_year_month',
+            unique=True
+        ),
+        IndexModel([('counter_id', ASCENDING), ('period', DESCENDING), ('_id', DESCENDING)], name='counter_id_period'),
+    ]
+    queries = [
+        {'filter': {'counter_id': ObjectId(), 'year': 2024, 'month': 1}},
+        {'filter': {'counter_id': {'$in': [ObjectId()]}, 'year': 2024, 'month': 1}},
+        {'filter': {'counter_id': ObjectId(), 'period': {'$gte': 24280, '$lte': 24289}}, 'sort': [('period', -1), ('_id', -1)]},
+        {'filter': {'counter_id': ObjectId()}, 'sort': [('period', -1), ('_id', -1)]},
+        {'filter': {'counter_id': {'$in': [ObjectId()]}, 'period': {'$lte': 24289}}, 'sort': [('counter_id', 1), ('period', -1)]},
+    ]
+    # Page order, cursors are built from these fields
+    order = [('period', -1), ('_id', -1)]
+    fields = ('user_id', 'value', 'created_at', 'counter_id', 'year', 'month', 'period')
+    __slots__ = ('_id',) + fields
 
-class Reading:
     _id: ObjectId
     user_id: ObjectId
     value: float
@@ -12,35 +37,37 @@ class Reading:
     counter_id: ObjectId
     year: int
     month: int
+    # period_of(year, month), history ranges are one range of it
+    period: int
 
     def __init__(
         self, 
         user_id: ObjectId,
         value: float,
-        created_at: datetime = datetime.now(),
+        created_at: datetime = None,
         counter_id: ObjectId | None = None,
-        year: int = datetime.now().year,
-        month: int = datetime.now().month,
+        year: int = None,
+        month: int = None,
         _id: ObjectId = None
     ) -> None:
-        self._id = ObjectId(_id)
+        now = datetime.now()
+        self._id = ObjectId(_id) if _id is not None else None
         self.value = value
         self.user_id = ObjectId(user_id)
-        self.created_at = created_at
+        self.created_at = created_at if created_at is not None else now
         self.counter_id = ObjectId(counter_id)
-        self.year = year
-        self.month = month
+        self.year = year if year is not None else now.year
+        self.month = month if month is not None else now.month
+        self.period = period_of(self.year, self.month)
+
+    @classmethod
+    def from_bson(cls, data: dict):
+        reading = super().from_bson(data)
+        # Documents from before the backfill
+        if reading.period is None and reading.year is not None and reading.month is not None:
+            reading.period = period_of(reading.year, reading.month)
+        return reading
 
-    def __dict__(self):
-        return {
-            'user_id': self.user_id,
-            'value': self.value,
-            'created_at': self.created_at,
-            'counter_id': self.counter_id,
-            'year': self.year,
-            'month': self.month
-        }
-    
     def to_json(self):
         return {
             'id': str(self._id),
@@ -51,8 +78,87 @@ class Reading:
             'year': self.year,
             'month': self.month
         }
-    
-class Counter:
+
+    @classmethod
+    def find_history(
+        cls,
+        counter_id: ObjectId,
+        start_date: datetime,
+        end_date: datetime,
+        skip: int = 0,
+        limit: int = 20,
+        cursor: str = None
+    ):
+        ''' Async iterator over readings of counter in page order '''
+        return cls.store.find_history(counter_id, start_date, end_date, skip=skip, limit=limit, cursor=cursor)
+
+    @classmethod
+    async def get_history(cls, *args, **kwargs) -> List:
+        return [reading async for reading in cls.find_history(*args, **kwargs)]
+
+    @classmethod
+    async def get_by_id(cls, _id: ObjectId):
+        return await cls.store.get_by_id(ObjectId(_id))
+
+    @classmethod
+    async def get(cls, counter_id: ObjectId, year: int, month: int):
+        return await cls.store.get(counter_id, year, month)
+
+    @classmethod
+    async def get_counter_readings(cls, counter_id: ObjectId, fields: List[str] = None) -> List:
+        ''' All readings of counter, oldest first '''
+        return await cls.store.get_counter_readings(counter_id, fields)
+
+    @classmethod
+    async def get_latest(cls, counter_ids: List[ObjectId], until: tuple = None) -> dict:
+        ''' Latest reading of every counter in one query: counter_id -> Reading,
+        until (year, month) leaves out later readings '''
+        return await cls.store.get_latest(counter_ids, until)
+
+    @classmethod
+    async def get_around(cls, counter_id: ObjectId, year: int, month: int, session=None) -> tuple:
+        ''' (previous, this month's, next) reading of counter around (year, month), each may be None '''
+        return await cls.store.get_around(counter_id, year, month, session=session)
+
+    @classmethod
+    async def existing(cls, ids: List[ObjectId]) -> set:
+        ''' Ids of readings that still exist '''
+        return await cls.store.existing(ids)
+
+    @classmethod
+    async def get_next(cls, counter_ids: List[ObjectId], after: tuple) -> dict:
+        ''' Earliest reading after (year, month) of every counter in one query: counter_id -> Reading '''
+        return await cls.store.get_next(counter_ids, after)
+
+    @classmethod
+    async def insert_many(cls, readings: List, session=None) -> None:
+        await cls.store.insert_many(readings, session=session)
+
+    async def save(self) -> None:
+        if self._id is not None:
+            raise ValueError('Readings are immutable, remove and add instead')
+        await self.store.insert(self)
+
+    async def delete(self, session=None) -> None:
+        await self.store.delete(self, session=session)
+
+Reading.store = make_store(SETTINGS.READINGS_STORAGE, Reading)
+
+class Counter(Model):
+    collection = 'counters'
+    indexes = [
+        IndexModel([('apartment_id', ASCENDING), ('type', ASCENDING)], name='apartment_id_type'),
+        IndexModel([('serial_number', ASCENDING)], name='serial_number', unique=True),
+    ]
+    queries = [
+        {'filter': {'apartment_id': ObjectId()}},
+        {'filter': {'apartment_id': ObjectId(), 'type': 'electricity'}},
+        {'filter': {'apartment_id': {'$in': [ObjectId()]}, 'type': 'electricity'}},
+        {'filter': {'serial_number': '1'}},
+    ]
+    fields = ('apartment_id', 'active', 'name', 'type', 'serial_number')
+    __slots__ = ('_id',) + fields
+
     _id: ObjectId
     apartment_id: ObjectId
     active: bool
@@ -76,15 +182,6 @@ class Counter:
         self.type = type
         self.serial_number = serial_number
 
-    def __dict__(self):
-        return {
-            'apartment_id': self.apartment_id,
-            'active': self.active,
-            'name': self.name,
-            'type': self.type,
-            'serial_number': self.serial_number,
-        }
-    
     def to_json(self):
         return {
             'id': str(self._id),
@@ -95,33 +192,17 @@ class Counter:
             'serial_number': self.serial_number
         }
     
-    async def save(self):
-        if self._id is None:
-            inserted = await MongoDB.db.counters.insert_one(self.__dict__())
-            self._id = inserted.inserted_id
-        else:
-            await MongoDB.db.counters.update_one(
-                {'_id': self._id},
-                {'$set': self.__dict__()}
-            )
-
-    @classmethod
-    async def get_by_id(cls, _id: ObjectId):
-        data = await MongoDB.db.counters.find_one({'_id': _id})
-        if data is None:
-            return None
-        return cls(**data)
-    
     @classmethod
     async def get_list(
         cls,
         apartment_id: ObjectId,
-        type: str = None
+        type: str = None,
+        fields: List[str] = None
     ) -> List:
         filter = {'apartment_id': apartment_id}
         if type is not None: filter['type'] = type
-        cursor = MongoDB.db.counters.find(filter)
+        cursor = MongoDB.db.counters.find(filter, cls.projection(fields))
         result = []
         async for data in cursor:
-            result.append(cls(**data))
+            result.append(cls.from_bson(data))
         return result
\ No newline at end of file
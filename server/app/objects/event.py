@@ -1,10 +1,33 @@
 from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
 
 from typing import List
 from datetime import datetime
 from app.utils.mongo import MongoDB
+from app.objects.base import Model
+from app.utils.pagination import keyset_filter
+from app.utils.event_hub import EventHub
+from app.objects.event_counter import EventCounter
+
+class Event(Model):
+    collection = 'events'
+    indexes = [
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)], name='user_id_created_at'),
+        IndexModel(
+            [('user_id', ASCENDING), ('readed', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+            name='user_id_readed_created_at'
+        ),
+    ]
+    queries = [
+        {'filter': {'user_id': ObjectId()}, 'sort': [('created_at', -1), ('_id', -1)]},
+        {'filter': {'user_id': ObjectId(), 'readed': False}, 'sort': [('created_at', -1), ('_id', -1)]},
+        {'filter': {'user_id': ObjectId(), '_id': {'$gt': ObjectId()}}, 'sort': [('_id', 1)]},
+    ]
+    # Page order, cursors are built from these fields
+    order = [('created_at', -1), ('_id', -1)]
+    fields = ('user_id', 'type', 'title', 'details', 'readed', 'manager_id', 'created_at', 'house_id')
+    __slots__ = ('_id',) + fields
 
-class Event:
     _id: ObjectId
     user_id: ObjectId
     type: str
@@ -23,7 +46,7 @@ class Event:
         details: str,
         readed: bool = False,
         manager_id: ObjectId = None,
-        created_at: datetime = datetime.now(),
+        created_at: datetime = None,
         house_id: ObjectId | None = None,
         _id: ObjectId = None
     ) -> None:
@@ -33,22 +56,10 @@ class Event:
         self.details = details
         self.readed = readed
         self.manager_id = manager_id
-        self.created_at = created_at
+        self.created_at = created_at if created_at is not None else datetime.now()
         self.house_id = house_id
         self.type = type
 
-    def __dict__(self):
-        return {
-            'user_id': self.user_id,
-            'type': self.type,
-            'title': self.title,
-            'details': self.details,
-            'readed': self.readed,
-            'manager_id': self.manager_id,
-            'created_at': self.created_at,
-            'house_id': self.house_id
-        }
-    
     def to_json(self):
         return {
             'id': str(self._id),
@@ -63,28 +74,60 @@ class Event:
         }
     
     async def save(self):
-        if self._id is None:
-            inserted = await MongoDB.db.events.insert_one(self.__dict__())
-            self._id = inserted.inserted_id
-        else:
-            await MongoDB.db.events.update_one(
-                {'_id': self._id},
-                {'$set': self.__dict__()}
-            )
-    
+        new = self._id is None
+        await super().save()
+        if new:
+            if not self.readed:
+                await EventCounter.add({self.user_id: 1})
+            EventHub.publish(self.user_id, self._id, self.to_json())
+
+    async def mark(self, read: bool) -> bool:
+        ''' Set read flag, the unread counter only moves if the flag really changed '''
+        updated = await MongoDB.db.events.update_one({'_id': self._id, 'readed': not read}, {'$set': {'readed': read}})
+        self.readed = read
+        if updated.modified_count:
+            await EventCounter.add({self.user_id: -1 if read else 1})
+        return bool(updated.modified_count)
+
     @classmethod
-    async def get_by_id(cls, _id: ObjectId):
-        data = await MongoDB.db.events.find_one({'_id': _id})
-        if data is None:
-            return None
-        return cls(**data)
-    
+    async def mark_all_read(cls, user_id: ObjectId) -> int:
+        updated = await MongoDB.db.events.update_many({'user_id': user_id, 'readed': False}, {'$set': {'readed': True}})
+        # Relative change, events arriving meanwhile keep their count
+        await EventCounter.add({user_id: -updated.modified_count})
+        return updated.modified_count
+
     @classmethod
-    async def get_user_events(cls, user_id: ObjectId, limit: int = 20, skip: int = 0, read: bool = None):
+    async def insert_many(cls, events: List) -> None:
+        if not events:
+            return
+        inserted = await MongoDB.db.events.insert_many([e.__dict__() for e in events], ordered=False)
+        for event, _id in zip(events, inserted.inserted_ids):
+            event._id = _id
+        await EventCounter.add_events(events)
+        for event in events:
+            EventHub.publish(event.user_id, event._id, event.to_json())
+
+    @classmethod
+    async def get_since(cls, user_id: ObjectId, after_id: ObjectId, limit: int = 100) -> List:
+        ''' Events of user created after after_id, oldest first, to catch up a reconnected stream '''
+        cursor = MongoDB.db.events.find({'user_id': user_id, '_id': {'$gt': after_id}}, limit=limit, sort=[('_id', 1)])
+        return [cls.from_bson(data) async for data in cursor]
+
+    @classmethod
+    async def get_user_events(
+        cls,
+        user_id: ObjectId,
+        limit: int = 20,
+        skip: int = 0,
+        read: bool = None,
+        fields: List[str] = None,
+        cursor: str = None
+    ):
         filter = {'user_id': user_id}
-        if read is not None: filter['read'] = read
-        cursor = MongoDB.db.events.find(filter, skip=skip, limit=limit, sort=[("created_at", -1)])
+        if read is not None: filter['readed'] = read
+        filter = keyset_filter(filter, cls.order, cursor)
+        cursor = MongoDB.db.events.find(filter, cls.projection(fields), skip=skip, limit=limit, sort=cls.order)
         result = []
         async for data in cursor:
-            result.append(cls(**data))
+            result.append(cls.from_bson(data))
         return result
\ No newline at end of file
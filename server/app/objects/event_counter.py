@@ -0,0 +1,56 @@
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from typing import List
+from collections import Counter as Tally
+from app.utils.mongo import MongoDB
+from app.objects.base import Model
+
+class EventCounter(Model):
+    ''' Unread events of a user, _id is the user id, kept in step with events writes.
+    Events from before the counters existed are counted by rebuild-unread, run it once on deploy '''
+    collection = 'event_counters'
+    fields = ('unread',)
+    __slots__ = ('_id',) + fields
+
+    _id: ObjectId
+    unread: int
+
+    def __init__(self, unread: int = 0, _id: ObjectId = None) -> None:
+        self._id = _id
+        self.unread = unread
+
+    @classmethod
+    async def add(cls, changes: dict) -> None:
+        ''' user_id -> change of unread count, one write for all users,
+        a missing counter starts at 0 and no counter goes below 0 '''
+        operations = [
+            UpdateOne(
+                {'_id': user_id},
+                [{'$set': {'unread': {'$max': [0, {'$add': [{'$ifNull': ['$unread', 0]}, change]}]}}}],
+                upsert=True
+            )
+            for user_id, change in changes.items()
+            if change
+        ]
+        if operations:
+            await MongoDB.db.event_counters.bulk_write(operations, ordered=False)
+
+    @classmethod
+    async def add_events(cls, events: List) -> None:
+        await cls.add(Tally(event.user_id for event in events if not event.readed))
+
+    @classmethod
+    async def get_unread(cls, user_id: ObjectId) -> int:
+        data = await MongoDB.db.event_counters.find_one({'_id': user_id})
+        return max(data['unread'], 0) if data is not None else 0
+
+    @classmethod
+    async def rebuild(cls) -> None:
+        ''' Recount every user from events '''
+        await MongoDB.db.event_counters.delete_many({})
+        await MongoDB.db.events.aggregate([
+            {'$match': {'readed': False}},
+            {'$group': {'_id': '$user_id', 'unread': {'$sum': 1}}},
+            {'$merge': {'into': cls.collection, 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ]).to_list(None)
@@ -1,10 +1,27 @@
 from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
 
 from typing import List
 from datetime import datetime
 from app.utils.mongo import MongoDB
+from app.objects.base import Model
+from app.utils.pagination import keyset_filter
+
+class House(Model):
+    collection = 'houses'
+    indexes = [
+        IndexModel([('managers', ASCENDING)], name='managers'),
+        IndexModel([('address', ASCENDING)], name='address'),
+    ]
+    queries = [
+        {'filter': {'managers': ObjectId()}},
+        {'filter': {'address': 'address'}},
+    ]
+    # Page order, cursors are built from these fields
+    order = [('_id', 1)]
+    fields = ('address', 'info', 'start_readings_day', 'end_readings_day', 'managers')
+    __slots__ = ('_id',) + fields
 
-class House:
     _id: ObjectId
     address: str
     info: str
@@ -27,15 +44,6 @@ class House:
         self.start_readings_day = start_readings_day
         self.end_readings_day = end_readings_day
         self.managers = managers
-
-    def __dict__(self):
-        return {
-            'address': self.address,
-            'info': self.info,
-            'start_readings_day': self.start_readings_day,
-            'end_readings_day': self.end_readings_day,
-            'managers': self.managers
-        }
     
     def to_json(self):
         return {
@@ -44,39 +52,25 @@ class House:
             'info': self.info,
             'start_readings_day': self.start_readings_day,
             'end_readings_day': self.end_readings_day,
-            'managers': list(map(str, self.managers))
+            'managers': list(map(str, self.managers or []))
         }
     
-    async def save(self):
-        if self._id is None:
-            inserted = await MongoDB.db.houses.insert_one(self.__dict__())
-            self._id = inserted.inserted_id
-        else:
-            await MongoDB.db.houses.update_one(
-                {'_id': self._id},
-                {'$set': self.__dict__()} 
-            )
-
-    @classmethod
-    async def get_by_id(cls, _id: ObjectId):
-        data = await MongoDB.db.houses.find_one({'_id': ObjectId(_id)})
-        if data is None:
-            return None
-        return cls(**data)
-    
     @classmethod
     async def get_list(
         cls,
         address: str = None,
         manager: ObjectId = None,
         skip: int = 0,
-        limit: int = 20
+        limit: int = 20,
+        fields: List[str] = None,
+        cursor: str = None
     ) -> List:
         filter = {}
         if address is not None: filter['address'] = address
         if manager is not None: filter['managers'] = manager
-        cursor = MongoDB.db.houses.find(filter, skip=skip, limit=limit) 
+        filter = keyset_filter(filter, cls.order, cursor)
+        cursor = MongoDB.db.houses.find(filter, cls.projection(fields), skip=skip, limit=limit, sort=cls.order)
         result = []
         async for data in cursor:
-            result.append(cls(**data))
-        return result
\ No newline at end of file
+            result.append(cls.from_bson(data))
+        return result
@@ -0,0 +1,112 @@
+from bson import ObjectId
+from pymongo import IndexModel, ASCENDING
+
+from datetime import datetime
+from app.utils.mongo import MongoDB
+from app.objects.base import Model
+
+class Job(Model):
+    ''' Background task with progress visible through /api/v1/jobs/get,
+    stored so that any worker can report it and a stopped worker leaves it failed '''
+    collection = 'jobs'
+    indexes = [
+        IndexModel([('active', ASCENDING)], name='active', partialFilterExpression={'active': True}),
+        # Finished jobs are kept for a day, running ones keep updated_at fresh
+        IndexModel([('updated_at', ASCENDING)], name='updated_at_ttl', expireAfterSeconds=24 * 60 * 60),
+    ]
+    queries = [
+        {'filter': {'active': True, 'updated_at': {'$lt': datetime(2024, 1, 1)}}},
+    ]
+    fields = ('kind', 'user_id', 'status', 'active', 'done', 'total', 'result', 'error', 'created_at', 'updated_at')
+    __slots__ = ('_id',) + fields
+
+    _id: ObjectId
+    kind: str
+    user_id: ObjectId
+    # pending, running, done, failed
+    status: str
+    active: bool
+    done: int
+    total: int
+    result: dict | None
+    error: str | None
+    created_at: datetime
+    updated_at: datetime
+
+    def __init__(
+        self,
+        kind: str,
+        user_id: ObjectId,
+        status: str = "pending",
+        active: bool = True,
+        done: int = 0,
+        total: int = 0,
+        result: dict = None,
+        error: str = None,
+        created_at: datetime = None,
+        updated_at: datetime = None,
+        _id: ObjectId = None
+    ) -> None:
+        self._id = _id
+        self.kind = kind
+        self.user_id = user_id
+        self.status = status
+        self.active = active
+        self.done = done
+        self.total = total
+        self.result = result
+        self.error = error
+        self.created_at = created_at if created_at is not None else datetime.now()
+        self.updated_at = updated_at if updated_at is not None else datetime.now()
+
+    def to_json(self):
+        return {
+            'id': str(self._id),
+            'kind': self.kind,
+            'user_id': str(self.user_id),
+            'status': self.status,
+            'done': self.done,
+            'total': self.total,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+    @classmethod
+    async def fail_stale(cls, before: datetime) -> int:
+        ''' Fail active jobs without a heartbeat since before, their process is gone '''
+        updated = await MongoDB.db.jobs.update_many(
+            {'active': True, 'updated_at': {'$lt': before}},
+            {'$set': {'status': 'failed', 'error': 'Server stopped', 'updated_at': datetime.now()}, '$unset': {'active': ''}}
+        )
+        return updated.modified_count
+
+    async def progress(self, done: int = None, total: int = None, result: dict = None) -> None:
+        ''' Store progress, without arguments only the heartbeat '''
+        if done is not None:
+            self.done = done
+        if total is not None:
+            self.total = total
+        self.updated_at = datetime.now()
+        update = {'done': self.done, 'total': self.total, 'updated_at': self.updated_at}
+        if result is not None:
+            self.result = update['result'] = result
+        await MongoDB.db.jobs.update_one({'_id': self._id, 'active': True}, {'$set': update})
+
+    async def heartbeat(self) -> None:
+        await self.progress()
+
+    async def set_status(self, status: str, result: dict = None, error: str = None) -> None:
+        self.status = status
+        self.result = result if result is not None else self.result
+        self.error = error
+        self.updated_at = datetime.now()
+        update = {'$set': {
+            'status': status, 'done': self.done, 'total': self.total,
+            'result': self.result, 'error': error, 'updated_at': self.updated_at
+        }}
+        if status in ("done", "failed"):
+            self.active = None
+            update['$unset'] = {'active': ''}
+        await MongoDB.db.jobs.update_one({'_id': self._id}, update)
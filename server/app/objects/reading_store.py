@@ -0,0 +1,425 @@
+import time
+import asyncio
+import logging
+
+from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING, UpdateOne, InsertOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+
+from typing import List, AsyncIterator
+from app.utils.mongo import MongoDB
+from app.utils.pagination import keyset_filter, decode_cursor
+
+# Storage layouts of readings behind the Reading API:
+#   documents - one document per counter per month in `readings`
+#   buckets   - one document per counter per year in `readings_buckets`,
+#               months are entries of its `readings` array
+
+# Fields of a bucket entry, counter_id and year live on the bucket
+ENTRY_FIELDS = ('_id', 'user_id', 'value', 'created_at', 'month')
+
+def period_of(year: int, month: int) -> int:
+    ''' Months since January of year 0, orders readings with a single integer,
+    divmod(period, 12) gives back (year, month - 1) '''
+    return year * 12 + month - 1
+
+def period_expression(year: str, month: str) -> dict:
+    ''' period_of for aggregation, year and month are field paths like '$year' '''
+    return {'$add': [{'$multiply': [year, 12]}, month, -1]}
+
+def history_filter(counter_id: ObjectId, start_date, end_date) -> dict:
+    ''' Readings of counter from the month of start_date to the month of end_date '''
+    return {
+        'counter_id': counter_id,
+        'period': {
+            '$gte': period_of(start_date.year, start_date.month),
+            '$lte': period_of(end_date.year, end_date.month)
+        }
+    }
+
+def until_filter(year: int, month: int) -> dict:
+    ''' Readings of (year, month) and earlier '''
+    return {'period': {'$lte': period_of(year, month)}}
+
+def legacy_until_filter(year: int, month: int) -> dict:
+    ''' until_filter for documents that may have no period yet '''
+    return {'$or': [{'year': {'$lt': year}}, {'year': year, 'month': {'$lte': month}}]}
+
+async def gather(session, *queries) -> list:
+    ''' Results of queries, one at a time inside a session: it does not take parallel operations '''
+    if session is None:
+        return await asyncio.gather(*queries)
+    return [await query for query in queries]
+
+def before_filter(year: int, month: int) -> dict:
+    ''' Readings earlier than (year, month) '''
+    return {'period': {'$lt': period_of(year, month)}}
+
+def legacy_before_filter(year: int, month: int) -> dict:
+    ''' before_filter for documents that may have no period yet '''
+    return {'$or': [{'year': {'$lt': year}}, {'year': year, 'month': {'$lt': month}}]}
+
+def after_filter(year: int, month: int) -> dict:
+    ''' Readings later than (year, month) '''
+    return {'period': {'$gt': period_of(year, month)}}
+
+def legacy_after_filter(year: int, month: int) -> dict:
+    ''' after_filter for documents that may have no period yet '''
+    return {'$or': [{'year': {'$gt': year}}, {'year': year, 'month': {'$gt': month}}]}
+
+# Bucket entries as flat reading documents, period is derived from the bucket year
+UNWIND = [
+    {'$unwind': '$readings'},
+    {'$addFields': {
+        'readings.counter_id': '$counter_id',
+        'readings.year': '$year',
+        'readings.period': period_expression('$year', '$readings.month')
+    }},
+    {'$replaceRoot': {'newRoot': '$readings'}},
+]
+
+class DocumentStore:
+    collection = 'readings'
+    # While documents without period exist, queries fall back to year and month
+    # and the check is repeated this often, seconds
+    keyed_recheck = 60
+
+    def __init__(self, model) -> None:
+        self.model = model
+        self._keyed = False
+        self._checked_at = None
+
+    @property
+    def db(self):
+        return MongoDB.db[self.collection]
+
+    async def keyed(self) -> bool:
+        ''' Every document has period, once true it stays so for this process,
+        rerun backfill-readings-period after writers without period are gone '''
+        if self._keyed:
+            return True
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.keyed_recheck:
+            self._checked_at = now
+            self._keyed = await self.db.find_one({'period': {'$exists': False}}, {'_id': 1}) is None
+            if not self._keyed:
+                logging.warning(f'{self.collection} has documents without period, run backfill-readings-period')
+        return self._keyed
+
+    async def get_by_id(self, _id: ObjectId):
+        data = await self.db.find_one({'_id': _id})
+        return self.model.from_bson(data) if data is not None else None
+
+    async def get(self, counter_id: ObjectId, year: int, month: int):
+        data = await self.db.find_one({'counter_id': counter_id, 'year': year, 'month': month})
+        return self.model.from_bson(data) if data is not None else None
+
+    async def insert(self, reading) -> None:
+        inserted = await self.db.insert_one(reading.__dict__())
+        reading._id = inserted.inserted_id
+
+    async def insert_many(self, readings: List, session=None) -> None:
+        ''' Unordered, raises BulkWriteError with the readings that were not written '''
+        for reading in readings:
+            reading._id = ObjectId()
+        await self.db.bulk_write(
+            [InsertOne({'_id': r._id, **r.__dict__()}) for r in readings],
+            ordered=False,
+            session=session
+        )
+
+    async def delete(self, reading, session=None) -> None:
+        await self.db.delete_one({'_id': reading._id}, session=session)
+
+    def find_history(self, counter_id: ObjectId, start_date, end_date, skip: int = 0, limit: int = 20, cursor: str = None) -> AsyncIterator:
+        # Cursor is decoded here, so a bad one fails before streaming starts
+        filter = keyset_filter(history_filter(counter_id, start_date, end_date), self.model.order, cursor)
+        after = tuple(decode_cursor(cursor)) if cursor else None
+        return self.history(filter, counter_id, start_date, end_date, skip, limit, after)
+
+    async def history(self, filter: dict, counter_id: ObjectId, start_date, end_date, skip: int, limit: int, after: tuple | None) -> AsyncIterator:
+        if await self.keyed():
+            async for reading in self.iterate(self.db.find(filter, skip=skip, limit=limit, sort=self.model.order)):
+                yield reading
+            return
+        # A counter has a reading a month, so its years of history are filtered and paged here
+        cursor = self.db.find({'counter_id': counter_id, 'year': {'$gte': start_date.year, '$lte': end_date.year}})
+        low, high = period_of(start_date.year, start_date.month), period_of(end_date.year, end_date.month)
+        readings = [
+            reading async for reading in self.iterate(cursor)
+            if low <= reading.period <= high and (after is None or (reading.period, reading._id) < after)
+        ]
+        readings.sort(key=lambda reading: (reading.period, reading._id), reverse=True)
+        for reading in readings[skip:skip + limit] if limit else readings[skip:]:
+            yield reading
+
+    async def iterate(self, cursor) -> AsyncIterator:
+        async for data in cursor:
+            yield self.model.from_bson(data)
+
+    async def get_counter_readings(self, counter_id: ObjectId, fields: List[str] = None) -> List:
+        keyed = await self.keyed()
+        if fields is not None and not keyed:
+            fields = list(set(fields) | {'year', 'month'})
+        sort = [('period', 1)] if keyed else [('year', 1), ('month', 1)]
+        cursor = self.db.find({'counter_id': counter_id}, self.model.projection(fields), sort=sort)
+        return [self.model.from_bson(data) async for data in cursor]
+
+    async def get_latest(self, counter_ids: List[ObjectId], until: tuple = None) -> dict:
+        keyed = await self.keyed()
+        match = {'counter_id': {'$in': counter_ids}}
+        if until is not None: match.update(until_filter(*until) if keyed else legacy_until_filter(*until))
+        cursor = self.db.aggregate([
+            {'$match': match},
+            {'$sort': {'counter_id': 1, 'period': -1} if keyed else {'counter_id': 1, 'year': -1, 'month': -1}},
+            {'$group': {'_id': '$counter_id', 'reading': {'$first': '$$ROOT'}}}
+        ])
+        return {data['_id']: self.model.from_bson(data['reading']) async for data in cursor}
+
+    async def get_around(self, counter_id: ObjectId, year: int, month: int, session=None) -> tuple:
+        keyed = await self.keyed()
+        before = before_filter(year, month) if keyed else legacy_before_filter(year, month)
+        after = after_filter(year, month) if keyed else legacy_after_filter(year, month)
+        newest = [('period', -1)] if keyed else [('year', -1), ('month', -1)]
+        oldest = [('period', 1)] if keyed else [('year', 1), ('month', 1)]
+        documents = await gather(
+            session,
+            self.db.find_one({'counter_id': counter_id, **before}, sort=newest, session=session),
+            self.db.find_one({'counter_id': counter_id, 'year': year, 'month': month}, session=session),
+            self.db.find_one({'counter_id': counter_id, **after}, sort=oldest, session=session)
+        )
+        return tuple(self.model.from_bson(data) if data is not None else None for data in documents)
+
+    async def existing(self, ids: List[ObjectId]) -> set:
+        return set(await self.db.distinct('_id', {'_id': {'$in': ids}}))
+
+    async def get_next(self, counter_ids: List[ObjectId], after: tuple) -> dict:
+        keyed = await self.keyed()
+        match = {'counter_id': {'$in': counter_ids}, **(after_filter(*after) if keyed else legacy_after_filter(*after))}
+        cursor = self.db.aggregate([
+            {'$match': match},
+            {'$sort': {'counter_id': 1, 'period': 1} if keyed else {'counter_id': 1, 'year': 1, 'month': 1}},
+            {'$group': {'_id': '$counter_id', 'reading': {'$first': '$$ROOT'}}}
+        ])
+        return {data['_id']: self.model.from_bson(data['reading']) async for data in cursor}
+
+    async def iterate_all(self) -> AsyncIterator:
+        ''' Every reading, grouped by counter and oldest first within counter '''
+        # Reverse of the readings index, so no in-memory sort
+        sort = [('counter_id', -1), ('period', 1)] if await self.keyed() else [('counter_id', -1), ('year', 1), ('month', 1)]
+        cursor = self.db.find({}, sort=sort)
+        async for data in cursor:
+            yield self.model.from_bson(data)
+
+class BucketStore(DocumentStore):
+    collection = 'readings_buckets'
+
+    async def keyed(self) -> bool:
+        # Period of entries is derived from the bucket year
+        return True
+
+    def entry(self, reading) -> dict:
+        return {field: getattr(reading, field) for field in ENTRY_FIELDS}
+
+    def from_bucket(self, bucket: dict, entry: dict):
+        return self.model.from_bson({**entry, 'counter_id': bucket['counter_id'], 'year': bucket['year']})
+
+    def flatten(self, bucket: dict) -> List:
+        entries = sorted(bucket.get('readings', []), key=lambda entry: entry['month'])
+        return [self.from_bucket(bucket, entry) for entry in entries]
+
+    async def get_by_id(self, _id: ObjectId):
+        bucket = await self.db.find_one({'readings._id': _id}, {'counter_id': 1, 'year': 1, 'readings': {'$elemMatch': {'_id': _id}}})
+        return self.from_bucket(bucket, bucket['readings'][0]) if bucket is not None else None
+
+    async def get(self, counter_id: ObjectId, year: int, month: int):
+        bucket = await self.db.find_one(
+            {'counter_id': counter_id, 'year': year, 'readings.month': month},
+            {'counter_id': 1, 'year': 1, 'readings': {'$elemMatch': {'month': month}}}
+        )
+        return self.from_bucket(bucket, bucket['readings'][0]) if bucket is not None else None
+
+    def push(self, reading) -> tuple:
+        # A bucket that already has this month does not match, the upsert then
+        # fails on the unique (counter_id, year) index just like a duplicate document
+        return (
+            {'counter_id': reading.counter_id, 'year': reading.year, 'readings.month': {'$ne': reading.month}},
+            {'$push': {'readings': self.entry(reading)}}
+        )
+
+    async def insert(self, reading) -> None:
+        reading._id = ObjectId()
+        try:
+            await self.db.update_one(*self.push(reading), upsert=True)
+        except DuplicateKeyError:
+            # Another first write of the year created the bucket meanwhile, the update finds it now.
+            # A duplicate month fails again
+            await self.db.update_one(*self.push(reading), upsert=True)
+
+    async def insert_many(self, readings: List, session=None) -> None:
+        ''' Unordered, raises BulkWriteError with the readings that were not written '''
+        for reading in readings:
+            reading._id = ObjectId()
+        try:
+            await self.db.bulk_write([UpdateOne(*self.push(r), upsert=True) for r in readings], ordered=False, session=session)
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            # Inside a transaction the error has aborted it, the transaction is retried as a whole
+            if session is not None or any(error['code'] != 11000 for error in errors):
+                raise
+            # Lost the race for creating buckets, once more like insert does
+            retry = [readings[error['index']] for error in errors]
+            try:
+                await self.db.bulk_write([UpdateOne(*self.push(r), upsert=True) for r in retry], ordered=False)
+            except BulkWriteError as retried:
+                # Indexes of the readings passed in, callers report them
+                details = dict(retried.details)
+                details['writeErrors'] = [
+                    {**error, 'index': errors[error['index']]['index']} for error in retried.details['writeErrors']
+                ]
+                raise BulkWriteError(details) from None
+
+    async def delete(self, reading, session=None) -> None:
+        await self.db.update_one({'readings._id': reading._id}, {'$pull': {'readings': {'_id': reading._id}}}, session=session)
+
+    def find_history(self, counter_id: ObjectId, start_date, end_date, skip: int = 0, limit: int = 20, cursor: str = None) -> AsyncIterator:
+        filter = keyset_filter(history_filter(counter_id, start_date, end_date), self.model.order, cursor)
+        pipeline = [
+            {'$match': {'counter_id': counter_id, 'year': {'$gte': start_date.year, '$lte': end_date.year}}},
+            *UNWIND,
+            {'$match': filter},
+            {'$sort': dict(self.model.order)},
+            {'$skip': skip},
+        ]
+        if limit:
+            pipeline.append({'$limit': limit})
+        return self.iterate(self.db.aggregate(pipeline))
+
+    async def get_counter_readings(self, counter_id: ObjectId, fields: List[str] = None) -> List:
+        result = []
+        async for bucket in self.db.find({'counter_id': counter_id}, sort=[('year', 1)]):
+            result.extend(self.flatten(bucket))
+        return result
+
+    async def get_latest(self, counter_ids: List[ObjectId], until: tuple = None) -> dict:
+        if until is not None:
+            # Months after until may share the bucket, so compare entries one by one
+            cursor = self.db.aggregate([
+                {'$match': {'counter_id': {'$in': counter_ids}, 'year': {'$lte': until[0]}}},
+                *UNWIND,
+                {'$match': until_filter(*until)},
+                {'$sort': {'counter_id': 1, 'period': -1}},
+                {'$group': {'_id': '$counter_id', 'reading': {'$first': '$$ROOT'}}}
+            ])
+            return {data['_id']: self.model.from_bson(data['reading']) async for data in cursor}
+        cursor = self.db.aggregate([
+            {'$match': {'counter_id': {'$in': counter_ids}, 'readings.0': {'$exists': True}}},
+            {'$sort': {'counter_id': 1, 'year': -1}},
+            {'$group': {'_id': '$counter_id', 'bucket': {'$first': '$$ROOT'}}}
+        ])
+        return {data['_id']: self.flatten(data['bucket'])[-1] async for data in cursor}
+
+    async def get_around(self, counter_id: ObjectId, year: int, month: int, session=None) -> tuple:
+        # The bucket of year and the nearest non-empty buckets before and after it
+        buckets = await gather(
+            session,
+            self.db.find_one({'counter_id': counter_id, 'year': {'$lt': year}, 'readings.0': {'$exists': True}}, sort=[('year', -1)], session=session),
+            self.db.find_one({'counter_id': counter_id, 'year': year}, session=session),
+            self.db.find_one({'counter_id': counter_id, 'year': {'$gt': year}, 'readings.0': {'$exists': True}}, sort=[('year', 1)], session=session)
+        )
+        earlier, same, later = [self.flatten(bucket) if bucket is not None else [] for bucket in buckets]
+        before = earlier + [reading for reading in same if reading.month < month]
+        current = [reading for reading in same if reading.month == month]
+        after = [reading for reading in same if reading.month > month] + later
+        return (
+            before[-1] if before else None,
+            current[0] if current else None,
+            after[0] if after else None
+        )
+
+    async def existing(self, ids: List[ObjectId]) -> set:
+        return set(await self.db.distinct('readings._id', {'readings._id': {'$in': ids}})) & set(ids)
+
+    async def get_next(self, counter_ids: List[ObjectId], after: tuple) -> dict:
+        cursor = self.db.aggregate([
+            {'$match': {'counter_id': {'$in': counter_ids}, 'year': {'$gte': after[0]}}},
+            *UNWIND,
+            {'$match': after_filter(*after)},
+            {'$sort': {'counter_id': 1, 'period': 1}},
+            {'$group': {'_id': '$counter_id', 'reading': {'$first': '$$ROOT'}}}
+        ])
+        return {data['_id']: self.model.from_bson(data['reading']) async for data in cursor}
+
+    async def iterate_all(self) -> AsyncIterator:
+        async for bucket in self.db.find({}, sort=[('counter_id', -1), ('year', 1)]):
+            for reading in self.flatten(bucket):
+                yield reading
+
+class ReadingBucket:
+    ''' Index declarations of the bucket layout '''
+    collection = BucketStore.collection
+    indexes = [
+        IndexModel([('counter_id', ASCENDING), ('year', DESCENDING)], name='counter_id_year', unique=True),
+        IndexModel([('readings._id', ASCENDING)], name='readings_id'),
+    ]
+    queries = [
+        {'filter': {'counter_id': ObjectId(), 'year': 2024, 'readings.month': 1}},
+        {'filter': {'counter_id': {'$in': [ObjectId()]}}, 'sort': [('counter_id', 1), ('year', -1)]},
+        {'filter': {'readings._id': ObjectId()}},
+    ]
+
+async def backfill_periods(batch_size: int = 1000) -> int:
+    ''' Set period on documents written before it existed, batch by batch in _id order.
+    Only documents still missing it are read, so an interrupted run just starts again,
+    and a run after the rollout picks up what workers without period wrote meanwhile '''
+    collection = MongoDB.db[DocumentStore.collection]
+    count = 0
+    last_id = None
+    while True:
+        filter = {'period': {'$exists': False}}
+        if last_id is not None: filter['_id'] = {'$gt': last_id}
+        batch = await collection.find(filter, {'year': 1, 'month': 1}, sort=[('_id', 1)], limit=batch_size).to_list(None)
+        if not batch:
+            break
+        await collection.bulk_write(
+            [UpdateOne({'_id': data['_id']}, {'$set': {'period': period_of(data['year'], data['month'])}}) for data in batch],
+            ordered=False
+        )
+        count += len(batch)
+        last_id = batch[-1]['_id']
+        logging.info(f'Backfilled period of {count} readings')
+    return count
+
+STORES = {
+    'documents': DocumentStore,
+    'buckets': BucketStore,
+}
+
+async def migrate(source: str, target: str) -> int:
+    ''' Copy every reading from one layout to another, existing target data is replaced '''
+    if source == target:
+        return 0
+    if target == 'buckets':
+        await MongoDB.setup_indexes([ReadingBucket])
+        pipeline = [
+            {'$sort': {'counter_id': 1, 'year': 1, 'month': 1}},
+            {'$group': {
+                '_id': {'counter_id': '$counter_id', 'year': '$year'},
+                'readings': {'$push': {field: f'${field}' for field in ENTRY_FIELDS}}
+            }},
+            {'$project': {'_id': 0, 'counter_id': '$_id.counter_id', 'year': '$_id.year', 'readings': 1}},
+            {'$merge': {'into': BucketStore.collection, 'on': ['counter_id', 'year'], 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ]
+        await MongoDB.db[DocumentStore.collection].aggregate(pipeline, allowDiskUse=True).to_list(None)
+    else:
+        pipeline = [
+            *UNWIND,
+            {'$merge': {'into': DocumentStore.collection, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ]
+        await MongoDB.db[BucketStore.collection].aggregate(pipeline, allowDiskUse=True).to_list(None)
+    return await MongoDB.db[STORES[target].collection].count_documents({})
+
+def make_store(name: str, model):
+    if name not in STORES:
+        raise ValueError(f"Unknown readings storage: {name}, expected one of {', '.join(STORES)}")
+    return STORES[name](model)
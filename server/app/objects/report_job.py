@@ -0,0 +1,110 @@
+from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
+
+from datetime import datetime
+from app.utils.mongo import MongoDB
+from app.objects.base import Model
+
+class ReportJob(Model):
+    collection = 'report_jobs'
+    indexes = [
+        # Only one pending or running job per house-month
+        IndexModel(
+            [('house_id', ASCENDING), ('year', ASCENDING), ('month', ASCENDING)],
+            name='house_id_year_month_active',
+            unique=True,
+            partialFilterExpression={'active': True}
+        ),
+        IndexModel([('active', ASCENDING)], name='active', partialFilterExpression={'active': True}),
+    ]
+    queries = [
+        {'filter': {'house_id': ObjectId(), 'year': 2024, 'month': 1, 'active': True}},
+        {'filter': {'active': True, 'updated_at': {'$lt': datetime(2024, 1, 1)}}},
+    ]
+    fields = ('house_id', 'user_id', 'year', 'month', 'status', 'active', 'result', 'error', 'created_at', 'updated_at')
+    __slots__ = ('_id',) + fields
+
+    _id: ObjectId
+    house_id: ObjectId
+    user_id: ObjectId
+    year: int
+    month: int
+    # pending, running, done, failed
+    status: str
+    active: bool
+    result: str | None
+    error: str | None
+    created_at: datetime
+    updated_at: datetime
+
+    def __init__(
+        self,
+        house_id: ObjectId,
+        user_id: ObjectId,
+        year: int,
+        month: int,
+        status: str = "pending",
+        active: bool = True,
+        result: str = None,
+        error: str = None,
+        created_at: datetime = None,
+        updated_at: datetime = None,
+        _id: ObjectId = None
+    ) -> None:
+        self._id = _id
+        self.house_id = house_id
+        self.user_id = user_id
+        self.year = year
+        self.month = month
+        self.status = status
+        self.active = active
+        self.result = result
+        self.error = error
+        self.created_at = created_at if created_at is not None else datetime.now()
+        self.updated_at = updated_at if updated_at is not None else datetime.now()
+
+    def to_json(self):
+        return {
+            'id': str(self._id),
+            'house_id': str(self.house_id),
+            'user_id': str(self.user_id),
+            'year': self.year,
+            'month': self.month,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+    @classmethod
+    async def get_active(cls, house_id: ObjectId, year: int, month: int):
+        data = await MongoDB.db.report_jobs.find_one({'house_id': house_id, 'year': year, 'month': month, 'active': True})
+        if data is None:
+            return None
+        return cls.from_bson(data)
+
+    @classmethod
+    async def fail_stale(cls, before: datetime) -> int:
+        ''' Fail active jobs without a heartbeat since before, their process is gone '''
+        updated = await MongoDB.db.report_jobs.update_many(
+            {'active': True, 'updated_at': {'$lt': before}},
+            {'$set': {'status': 'failed', 'error': 'Server stopped', 'updated_at': datetime.now()}, '$unset': {'active': ''}}
+        )
+        return updated.modified_count
+
+    async def heartbeat(self) -> None:
+        self.updated_at = datetime.now()
+        await MongoDB.db.report_jobs.update_one({'_id': self._id, 'active': True}, {'$set': {'updated_at': self.updated_at}})
+
+    async def set_status(self, status: str, result: str = None, error: str = None) -> None:
+        self.status = status
+        self.result = result
+        self.error = error
+        self.updated_at = datetime.now()
+        update = {'$set': {'status': status, 'result': result, 'error': error, 'updated_at': self.updated_at}}
+        if status in ("done", "failed"):
+            # Finished jobs leave the partial unique index
+            self.active = None
+            update['$unset'] = {'active': ''}
+        await MongoDB.db.report_jobs.update_one({'_id': self._id}, update)
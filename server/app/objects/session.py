@@ -1,9 +1,23 @@
 from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
 
 from datetime import datetime
 from app.utils.mongo import MongoDB
+from app.objects.base import Model
+
+class Session(Model):
+    collection = 'sessions'
+    indexes = [
+        IndexModel([('token', ASCENDING)], name='token', unique=True),
+        IndexModel([('user_id', ASCENDING)], name='user_id'),
+    ]
+    queries = [
+        {'filter': {'token': 'token'}},
+        {'filter': {'user_id': ObjectId()}},
+    ]
+    fields = ('user_id', 'ip', 'token', 'deviceInfo', 'created_at', 'updated_at', 'expires_at')
+    __slots__ = ('_id',) + fields
 
-class Session:
     _id: ObjectId
     user_id: ObjectId
 
@@ -20,31 +34,20 @@ class Session:
         user_id: ObjectId,
         ip: str,
         token: str,
-        deviceInfo: dict = {},
-        created_at: datetime = datetime.now(),
-        updated_at: datetime = datetime.now(),
-        expires_at: datetime = datetime.now(),
+        deviceInfo: dict = None,
+        created_at: datetime = None,
+        updated_at: datetime = None,
+        expires_at: datetime = None,
         _id: ObjectId = None
     ) -> None:
         self._id = _id
         self.user_id = user_id
         self.ip = ip
         self.token = token
-        self.deviceInfo = deviceInfo
-        self.created_at = created_at
-        self.updated_at = updated_at
-        self.expires_at = expires_at
-
-    def __dict__(self):
-        return {
-            'user_id': self.user_id,
-            'ip': self.ip,
-            'token': self.token,
-            'deviceInfo': self.deviceInfo,
-            'created_at': self.created_at,
-            'updated_at': self.updated_at,
-            'expires_at': self.expires_at
-        }
+        self.deviceInfo = deviceInfo if deviceInfo is not None else {}
+        self.created_at = created_at if created_at is not None else datetime.now()
+        self.updated_at = updated_at if updated_at is not None else datetime.now()
+        self.expires_at = expires_at if expires_at is not None else datetime.now()
     
     def to_json(self):
         return {
@@ -57,35 +60,18 @@ class Session:
             'updated_at': self.updated_at,
             'expires_at': self.expires_at
         }
-
-    async def save(self):
-        if self._id is None:
-            inserted = await MongoDB.db.sessions.insert_one(self.__dict__())
-            self._id = inserted.inserted_id
-        else:
-            await MongoDB.db.sessions.update_one(
-                {'_id': self._id},
-                {'$set': self.__dict__()}
-            )
-
-    @classmethod
-    async def get_by_id(cls, _id: ObjectId):
-        data = await MongoDB.db.sessions.find_one({'_id': _id})
-        if data is None:
-            return None
-        return cls(**data)
     
     @classmethod
     async def get_by_token(cls, token: str):
         data = await MongoDB.db.sessions.find_one({'token': token})
         if data is None:
             return None
-        return cls(**data)
+        return cls.from_bson(data)
     
     @classmethod
     async def get_by_user_id(cls, user_id: ObjectId) -> list:
         cursor = MongoDB.db.sessions.find({'user_id': user_id})
         result = []
         async for data in cursor:
-            result.append(cls(**data))
-        return result
\ No newline at end of file
+            result.append(cls.from_bson(data))
+        return result
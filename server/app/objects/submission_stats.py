@@ -0,0 +1,225 @@
+import logging
+
+from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
+
+from typing import List
+from datetime import datetime
+from collections import Counter as Tally
+from app.utils.mongo import MongoDB
+from app.objects.base import Model
+from app.objects.counter import Counter, Reading
+
+class SubmissionStats(Model):
+    ''' Readings progress of a house in a month: per counter type, how many active counters
+    have a reading (submitted) out of all active counters (expected), kept in step with
+    reading and counter writes '''
+    collection = 'submission_stats'
+    indexes = [
+        IndexModel(
+            [('house_id', ASCENDING), ('year', DESCENDING), ('month', DESCENDING)],
+            name='house_id_year_month',
+            unique=True
+        ),
+    ]
+    queries = [
+        {'filter': {'house_id': ObjectId(), 'year': 2024, 'month': 1}},
+    ]
+    fields = ('house_id', 'year', 'month', 'submitted', 'expected', 'version', 'updated_at')
+    __slots__ = ('_id',) + fields
+
+    _id: ObjectId
+    house_id: ObjectId
+    year: int
+    month: int
+    # type -> count
+    submitted: dict
+    expected: dict
+    # Number of increments applied, lets a recount detect concurrent writes
+    version: int
+    updated_at: datetime
+
+    def __init__(
+        self,
+        house_id: ObjectId,
+        year: int,
+        month: int,
+        submitted: dict = None,
+        expected: dict = None,
+        version: int = 0,
+        updated_at: datetime = None,
+        _id: ObjectId = None
+    ) -> None:
+        self._id = _id
+        self.house_id = house_id
+        self.year = year
+        self.month = month
+        self.submitted = submitted if submitted is not None else {}
+        self.expected = expected if expected is not None else {}
+        self.version = version
+        self.updated_at = updated_at if updated_at is not None else datetime.now()
+
+    def to_json(self):
+        types = {}
+        for counter_type in sorted(set(self.expected) | set(self.submitted)):
+            submitted = self.submitted.get(counter_type, 0)
+            expected = self.expected.get(counter_type, 0)
+            types[counter_type] = {
+                'submitted': submitted,
+                'expected': expected,
+                'fraction': round(submitted / expected, 3) if expected else None
+            }
+        submitted = sum(self.submitted.values())
+        expected = sum(self.expected.values())
+        return {
+            'house_id': str(self.house_id),
+            'year': self.year,
+            'month': self.month,
+            'submitted': submitted,
+            'expected': expected,
+            'fraction': round(submitted / expected, 3) if expected else None,
+            'types': types
+        }
+
+    @classmethod
+    async def count(cls, house_id: ObjectId, year: int, month: int, session=None) -> tuple:
+        ''' (submitted, expected) of house for a month counted from counters and the rollup '''
+        apartment_ids = await MongoDB.db.apartments.distinct('_id', {'house_id': house_id}, session=session)
+        cursor = MongoDB.db.counters.find({'apartment_id': {'$in': apartment_ids}, 'active': True}, {'type': 1}, session=session)
+        types = {data['_id']: data['type'] async for data in cursor}
+        cursor = MongoDB.db.consumption_monthly.find(
+            {'counter_id': {'$in': list(types)}, 'year': year, 'month': month},
+            {'counter_id': 1},
+            session=session
+        )
+        submitted = Tally([types[data['counter_id']] async for data in cursor])
+        return dict(submitted), dict(Tally(types.values()))
+
+    @classmethod
+    async def recount(cls, house_id: ObjectId, year: int, month: int, attempts: int = 3, session=None) -> None:
+        ''' Replace counts of the month with a fresh count. Every $inc bumps version,
+        so increments landing while counting make the count start over instead of being lost '''
+        filter = {'house_id': house_id, 'year': year, 'month': month}
+        for _ in range(attempts):
+            data = await MongoDB.db.submission_stats.find_one(filter, {'version': 1}, session=session)
+            submitted, expected = await cls.count(house_id, year, month, session=session)
+            result = await MongoDB.db.submission_stats.update_one(
+                {**filter, 'version': data['version']},
+                {'$set': {'submitted': submitted, 'expected': expected, 'updated_at': datetime.now()}},
+                session=session
+            )
+            if result.matched_count:
+                return
+        logging.warning(f'Submission stats of {house_id} {month:02d}.{year} kept changing while counted, run rebuild-submissions')
+
+    @classmethod
+    async def add(cls, house_id: ObjectId, year: int, month: int, submitted: dict = None, expected: dict = None, session=None) -> None:
+        ''' Apply type -> change of counts after readings or counters were written,
+        with session the change commits or aborts together with those writes '''
+        inc = {f'submitted.{t}': n for t, n in (submitted or {}).items() if n}
+        inc.update({f'expected.{t}': n for t, n in (expected or {}).items() if n})
+        if not inc:
+            return
+        inc['version'] = 1
+        result = await MongoDB.db.submission_stats.update_one(
+            {'house_id': house_id, 'year': year, 'month': month},
+            {'$inc': inc, '$set': {'updated_at': datetime.now()}},
+            upsert=True,
+            session=session
+        )
+        # First write to the month: the count includes this change and replaces the increment
+        if result.upserted_id is not None:
+            await cls.recount(house_id, year, month, session=session)
+
+    @classmethod
+    async def add_readings(cls, house_id: ObjectId, entries: List[tuple], sign: int = 1, session=None) -> None:
+        ''' Readings of (counter, reading) were added (sign 1) or removed (sign -1),
+        only active counters are expected to submit '''
+        months = {}
+        for counter, reading in entries:
+            if counter.active:
+                months.setdefault((reading.year, reading.month), Tally())[counter.type] += sign
+        for (year, month), submitted in months.items():
+            await cls.add(house_id, year, month, submitted=submitted, session=session)
+
+    @classmethod
+    async def set_active(cls, counter: Counter, house_id: ObjectId, active: bool) -> None:
+        ''' Counter was activated or deactivated, this month counts it from now on or not at all '''
+        now = datetime.now()
+        sign = 1 if active else -1
+        reading = await Reading.get(counter._id, now.year, now.month)
+        await cls.add(
+            house_id, now.year, now.month,
+            submitted={counter.type: sign} if reading is not None else None,
+            expected={counter.type: sign}
+        )
+
+    @classmethod
+    async def remove_counters(cls, house_id: ObjectId, counters: List[Counter]) -> None:
+        ''' Counters left the house with their apartment, this month stops counting the active ones '''
+        now = datetime.now()
+        active = [counter for counter in counters if counter.active]
+        if not active:
+            return
+        latest = await Reading.get_latest([counter._id for counter in active])
+        submitted = Tally(
+            counter.type for counter in active
+            if counter._id in latest and (latest[counter._id].year, latest[counter._id].month) == (now.year, now.month)
+        )
+        expected = Tally(counter.type for counter in active)
+        await cls.add(
+            house_id, now.year, now.month,
+            submitted={counter_type: -n for counter_type, n in submitted.items()},
+            expected={counter_type: -n for counter_type, n in expected.items()}
+        )
+
+    @classmethod
+    async def get(cls, house_id: ObjectId, year: int, month: int):
+        filter = {'house_id': house_id, 'year': year, 'month': month}
+        data = await MongoDB.db.submission_stats.find_one(filter)
+        if data is None:
+            # Months nobody has written to yet are counted once
+            created = await MongoDB.db.submission_stats.update_one(
+                filter,
+                {'$setOnInsert': {'submitted': {}, 'expected': {}, 'version': 0, 'updated_at': datetime.now()}},
+                upsert=True
+            )
+            if created.upserted_id is not None:
+                await cls.recount(house_id, year, month)
+            data = await MongoDB.db.submission_stats.find_one(filter)
+        return cls.from_bson(data)
+
+    @classmethod
+    async def rebuild(cls) -> int:
+        ''' Recount every month of the rollup, expected is today's active counters for all of them '''
+        houses = {}
+        async for data in MongoDB.db.apartments.find({}, {'house_id': 1}):
+            houses[data['_id']] = data['house_id']
+        counters = {}
+        expected = {}
+        async for data in MongoDB.db.counters.find({'active': True}, {'apartment_id': 1, 'type': 1}):
+            house_id = houses.get(data['apartment_id'])
+            if house_id is None:
+                continue
+            counters[data['_id']] = (house_id, data['type'])
+            expected.setdefault(house_id, Tally())[data['type']] += 1
+        submitted = {}
+        async for data in MongoDB.db.consumption_monthly.find({}, {'counter_id': 1, 'year': 1, 'month': 1}):
+            counter = counters.get(data['counter_id'])
+            if counter is None:
+                continue
+            house_id, counter_type = counter
+            submitted.setdefault((house_id, data['year'], data['month']), Tally())[counter_type] += 1
+        now = datetime.now()
+        documents = [
+            {
+                'house_id': house_id, 'year': year, 'month': month,
+                'submitted': dict(tally), 'expected': dict(expected.get(house_id, {})), 'version': 0, 'updated_at': now
+            }
+            for (house_id, year, month), tally in submitted.items()
+        ]
+        await MongoDB.db.submission_stats.delete_many({})
+        if documents:
+            await MongoDB.db.submission_stats.insert_many(documents, ordered=False)
+        logging.info(f'Rebuilt {cls.collection}: {len(documents)} documents')
+        return len(documents)
@@ -1,9 +1,22 @@
 from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
 
+from typing import List
 from datetime import datetime
 from app.utils.mongo import MongoDB
+from app.objects.base import Model
+
+class User(Model):
+    collection = 'users'
+    indexes = [
+        IndexModel([('email', ASCENDING)], name='email', unique=True),
+    ]
+    queries = [
+        {'filter': {'email': 'user@example.com'}},
+    ]
+    fields = ('name', 'surname', 'role', 'email', 'password', 'created_at', 'updated_at')
+    __slots__ = ('_id',) + fields
 
-class User:
     _id: ObjectId
     role: str
     email: str
@@ -20,8 +33,8 @@ class User:
             password: str, 
             email: str, 
             role: str = "user",
-            created_at: datetime = datetime.now(),
-            updated_at: datetime = datetime.now(),
+            created_at: datetime = None,
+            updated_at: datetime = None,
             _id: ObjectId = None
         ) -> None:
         self._id = ObjectId(_id) if _id is not None else None
@@ -30,19 +43,8 @@ class User:
         self.role = role
         self.email = email
         self.password = password
-        self.created_at = created_at
-        self.updated_at = updated_at
-    
-    def __dict__(self):
-        return {
-            'name': self.name,
-            'surname': self.surname,
-            'role': self.role,
-            'email': self.email,
-            'password': self.password,
-            'created_at': self.created_at,
-            'updated_at': self.updated_at
-        }
+        self.created_at = created_at if created_at is not None else datetime.now()
+        self.updated_at = updated_at if updated_at is not None else datetime.now()
     
     def to_json(self):
         return {
@@ -53,27 +55,16 @@ class User:
             'role': self.role
             # 'password': self.password
         }
-        
-    async def save(self):
-        if self._id is None:
-            inserted = await MongoDB.db.users.insert_one(self.__dict__())
-            self._id = inserted.inserted_id
-        else:
-            await MongoDB.db.users.update_one(
-                {'_id': self._id},
-                {'$set': self.__dict__()}
-            )
 
     @classmethod
     async def get_by_email(cls, email: str):
         data = await MongoDB.db.users.find_one({'email': email})
         if data is None:
             return None
-        return cls(**data)
-        
+        return cls.from_bson(data)
+
     @classmethod
-    async def get_by_id(cls, _id: ObjectId):
-        data = await MongoDB.db.users.find_one({'_id': _id})
-        if data is None:
-            return None
-        return cls(**data)
\ No newline at end of file
+    async def get_by_emails(cls, emails: List[str], fields: List[str] = None) -> dict:
+        ''' Users with any of emails in one query: email -> User '''
+        cursor = MongoDB.db.users.find({'email': {'$in': list(emails)}}, cls.projection(fields))
+        return {data['email']: cls.from_bson(data) async for data in cursor}
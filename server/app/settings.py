@@ -7,5 +7,38 @@ class Settings(BaseSettings):
     LOGGING_LEVEL: str
     API_PORT: int
     API_HOST: str
+    # Multi-document transactions need a replica set, turn off for a standalone server
+    MONGODB_TRANSACTIONS: bool = True
+    # Drop indexes no model declares on startup, otherwise they are only logged
+    MONGODB_DROP_UNDECLARED_INDEXES: bool = False
+    # Auth cache
+    AUTH_CACHE_SIZE: int = 10000
+    AUTH_CACHE_TTL: int = 60
+    SESSIONS_FLUSH_INTERVAL: int = 10
+    # Access index of a user is reloaded after this many seconds even without changes.
+    # Invalidation only reaches the worker that made the change, other workers see it
+    # after this at the latest, so keep it as short as AUTH_CACHE_TTL (users are cached that long too)
+    ACCESS_CACHE_TTL: int = 60
+    ACCESS_LINKS_SIZE: int = 100000
+    ACCESS_LINKS_TTL: int = 3600
+    # Running background and report jobs touch updated_at this often, jobs silent for 3 intervals are failed
+    JOBS_HEARTBEAT: int = 30
+    # Reports
+    REPORT_WORKERS: int = 2
+    GOOGLE_SERVICE_ACCOUNT_FILE: str = 'smarthouse-424816-53872d0450a9.json'
+    # In-memory Google Sheets for local runs and tests
+    GOOGLE_SHEETS_FAKE: bool = False
+    # Readings layout: documents | buckets
+    READINGS_STORAGE: str = 'documents'
+    # Event push across workers, the change stream needs a replica set (a single-node one is enough).
+    # Off: events reach only connections of the worker that created them
+    EVENTS_CHANGE_STREAM: bool = False
+    EVENTS_QUEUE_SIZE: int = 100
+    EVENTS_HEARTBEAT: int = 25
+    # Anomaly detection, interval in seconds, 0 disables the in-process schedule
+    ANOMALY_SCAN_INTERVAL: int = 24 * 60 * 60
+    ANOMALY_HISTORY_MONTHS: int = 12
+    ANOMALY_SPIKE_FACTOR: float = 3.0
+    ANOMALY_ZERO_MONTHS: int = 3
     
 SETTINGS = Settings(_env_file=".env", _env_file_encoding="utf-8")
\ No newline at end of file
@@ -0,0 +1,111 @@
+import asyncio
+
+from bson import ObjectId
+from typing import Iterable
+
+from app.settings import SETTINGS
+from app.utils.mongo import MongoDB
+from app.utils.cache import TTLCache
+
+class Access:
+    ''' What a user may touch: houses they manage, apartments they live in or own '''
+    user_id: ObjectId
+    admin: bool
+    managed: frozenset
+    resident: frozenset
+    owned: frozenset
+
+    def __init__(self, user_id: ObjectId, admin: bool, managed: Iterable, resident: Iterable, owned: Iterable) -> None:
+        self.user_id = user_id
+        self.admin = admin
+        self.managed = frozenset(managed)
+        self.resident = frozenset(resident)
+        self.owned = frozenset(owned)
+
+    def can_manage(self, house_id: ObjectId) -> bool:
+        ''' Admin or manager of house '''
+        return self.admin or house_id in self.managed
+
+    def can_use(self, apartment_id: ObjectId, house_id: ObjectId) -> bool:
+        ''' Admin, manager of house or resident of apartment '''
+        return self.can_manage(house_id) or apartment_id in self.resident
+
+    def can_own(self, apartment_id: ObjectId, house_id: ObjectId) -> bool:
+        ''' Admin, manager of house or owner of apartment '''
+        return self.can_manage(house_id) or apartment_id in self.owned
+
+class AccessCache:
+    ''' Access of users, loaded once and dropped when memberships change (on this worker,
+    others reload it after ACCESS_CACHE_TTL), plus counter -> apartment -> house links,
+    which only go away on delete '''
+    users: TTLCache = TTLCache(SETTINGS.AUTH_CACHE_SIZE, SETTINGS.ACCESS_CACHE_TTL)
+    apartments: TTLCache = TTLCache(SETTINGS.ACCESS_LINKS_SIZE, SETTINGS.ACCESS_LINKS_TTL)
+    counters: TTLCache = TTLCache(SETTINGS.ACCESS_LINKS_SIZE, SETTINGS.ACCESS_LINKS_TTL)
+
+    @classmethod
+    async def get(cls, user) -> Access:
+        access = cls.users.get(user._id)
+        if access is not None and access.admin == (user.role == "admin"):
+            return access
+        managed, apartments = await asyncio.gather(
+            MongoDB.db.houses.distinct('_id', {'managers': user._id}),
+            MongoDB.db.apartments.find(
+                {'$or': [{'residents': user._id}, {'owner_id': user._id}]},
+                {'house_id': 1, 'residents': 1, 'owner_id': 1}
+            ).to_list(None)
+        )
+        for data in apartments:
+            cls.apartments.set(data['_id'], data['house_id'])
+        access = Access(
+            user_id=user._id,
+            admin=user.role == "admin",
+            managed=managed,
+            resident=[data['_id'] for data in apartments if user._id in data.get('residents', [])],
+            owned=[data['_id'] for data in apartments if data.get('owner_id') == user._id]
+        )
+        cls.users.set(user._id, access)
+        return access
+
+    @classmethod
+    def invalidate(cls, *user_ids: ObjectId) -> None:
+        ''' Call whenever managers, residents or owners change, only this worker's cache is dropped '''
+        for user_id in user_ids:
+            cls.users.pop(user_id)
+
+    @classmethod
+    def forget_apartment(cls, apartment_id: ObjectId) -> None:
+        cls.apartments.pop(apartment_id)
+
+    @classmethod
+    def forget_counter(cls, counter_id: ObjectId) -> None:
+        cls.counters.pop(counter_id)
+
+    @classmethod
+    def remember(cls, apartment=None, counter=None) -> None:
+        ''' Links of objects a handler has loaded anyway '''
+        if apartment is not None:
+            cls.apartments.set(apartment._id, apartment.house_id)
+        if counter is not None:
+            cls.counters.set(counter._id, counter.apartment_id)
+
+    @classmethod
+    async def house_of(cls, apartment_id: ObjectId) -> ObjectId | None:
+        house_id = cls.apartments.get(apartment_id)
+        if house_id is None:
+            data = await MongoDB.db.apartments.find_one({'_id': apartment_id}, {'house_id': 1})
+            if data is None:
+                return None
+            house_id = data['house_id']
+            cls.apartments.set(apartment_id, house_id)
+        return house_id
+
+    @classmethod
+    async def apartment_of(cls, counter_id: ObjectId) -> ObjectId | None:
+        apartment_id = cls.counters.get(counter_id)
+        if apartment_id is None:
+            data = await MongoDB.db.counters.find_one({'_id': counter_id}, {'apartment_id': 1})
+            if data is None:
+                return None
+            apartment_id = data['apartment_id']
+            cls.counters.set(counter_id, apartment_id)
+        return apartment_id
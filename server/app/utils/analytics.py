@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import numpy as np
+
+from typing import List
+from itertools import chain
+
+from app.objects import House, Apartment, Consumption
+from app.utils.reports import COUNTER_TYPES
+
+def _natural(key: str) -> tuple:
+    ''' "2" before "10", non-numeric names after numbers '''
+    return (0, int(key), key) if key.isdigit() else (1, 0, key)
+
+def _rounded(values: np.ndarray) -> list:
+    return np.round(values, 1).tolist()
+
+def _change(current: np.ndarray, previous: np.ndarray) -> list:
+    ''' Percent change, None where there is nothing to compare with '''
+    change = np.full(np.shape(current), np.nan)
+    np.divide((current - previous) * 100, previous, out=change, where=previous > 0)
+    return [None if np.isnan(value) else value for value in np.round(change, 1).tolist()]
+
+def _groups(names: List[str], apartment_cube: np.ndarray, types: List[str], field: str) -> List[dict]:
+    ''' Sum apartments (apartments x types x months) sharing entrance or floor '''
+    keys = sorted(set(names), key=_natural)
+    positions = {key: i for i, key in enumerate(keys)}
+    inverse = np.array([positions[name] for name in names], dtype=np.int64)
+    sums = np.zeros((len(keys),) + apartment_cube.shape[1:])
+    np.add.at(sums, inverse, apartment_cube)
+    counts = np.bincount(inverse, minlength=len(keys))
+    result = []
+    for i, key in enumerate(keys):
+        group = {field: key, "apartments": int(counts[i])}
+        for t, counter_type in enumerate(types):
+            group[counter_type] = {"total": round(float(sums[i, t].sum()), 1), "monthly": _rounded(sums[i, t])}
+        result.append(group)
+    return result
+
+def analyze(apartments: List, series: List[dict], year: int, start_year: int, types: List[str] = COUNTER_TYPES) -> dict:
+    ''' Vectorized consumption of a house for year, series are Consumption.get_series
+    documents covering start_year..year, the years before are used for comparison '''
+    n_apartments, n_types, n_years = len(apartments), len(types), year - start_year + 1
+    apartment_index = {apartment._id: i for i, apartment in enumerate(apartments)}
+    type_index = {counter_type: i for i, counter_type in enumerate(types)}
+
+    # Per counter
+    lengths = np.fromiter((len(doc['periods']) for doc in series), dtype=np.int64, count=len(series))
+    counter_apartment_idx = np.fromiter((apartment_index.get(doc['apartment_id'], -1) for doc in series), dtype=np.int64, count=len(series))
+    counter_type_idx = np.fromiter((type_index.get(doc['type'], -1) for doc in series), dtype=np.int64, count=len(series))
+    # Per rollup month, flattened
+    total = int(lengths.sum())
+    periods = np.fromiter(chain.from_iterable(doc['periods'] for doc in series), dtype=np.int64, count=total)
+    deltas = np.array(list(chain.from_iterable(doc['deltas'] for doc in series)), dtype=np.float64)
+    # First readings have no delta, nothing was consumed as far as we know
+    deltas[np.isnan(deltas)] = 0
+    counter = np.repeat(np.arange(len(series)), lengths)
+    apartment_idx = counter_apartment_idx[counter]
+    type_idx = counter_type_idx[counter]
+    year_idx = periods // 12 - start_year
+    month_idx = periods % 12
+    known = (apartment_idx >= 0) & (type_idx >= 0) & (year_idx >= 0) & (year_idx < n_years)
+
+    # types x years x months
+    cube = np.bincount(
+        ((type_idx * n_years + year_idx) * 12 + month_idx)[known],
+        weights=deltas[known],
+        minlength=n_types * n_years * 12
+    ).reshape(n_types, n_years, 12)
+    # apartments x types x months of the requested year
+    current = known & (year_idx == n_years - 1)
+    apartment_cube = np.bincount(
+        ((apartment_idx * n_types + type_idx) * 12 + month_idx)[current],
+        weights=deltas[current],
+        minlength=n_apartments * n_types * 12
+    ).reshape(n_apartments, n_types, 12)
+    # Apartments having a counter of type
+    valid = (counter_apartment_idx >= 0) & (counter_type_idx >= 0)
+    equipped = np.zeros((n_apartments, n_types), dtype=bool)
+    equipped[counter_apartment_idx[valid], counter_type_idx[valid]] = True
+    equipped_count = equipped.sum(axis=0)
+
+    yearly = cube.sum(axis=2)
+    previous = cube[:, -2] if n_years > 1 else np.zeros((n_types, 12))
+    totals = {}
+    year_over_year = {}
+    for t, counter_type in enumerate(types):
+        totals[counter_type] = {
+            "total": round(float(yearly[t, -1]), 1),
+            "monthly": _rounded(cube[t, -1]),
+            "apartments": int(equipped_count[t]),
+            "average": round(float(yearly[t, -1] / equipped_count[t]), 1) if equipped_count[t] else None
+        }
+        year_over_year[counter_type] = {
+            "years": {str(start_year + i): value for i, value in enumerate(_rounded(yearly[t]))},
+            "previous_monthly": _rounded(previous[t]),
+            "monthly_change": _change(cube[t, -1], previous[t]),
+            "change": _change(yearly[t, -1:], yearly[t, -2:-1])[0] if n_years > 1 else None
+        }
+
+    apartment_totals = apartment_cube.sum(axis=2)
+    apartment_rows = []
+    for i, item in enumerate(apartments):
+        apartment_rows.append({
+            "id": str(item._id),
+            "number": item.number,
+            "entrance": item.entrance,
+            "floor": item.floor,
+            "totals": dict(zip(types, _rounded(apartment_totals[i]))),
+            "monthly": dict(zip(types, _rounded(apartment_cube[i])))
+        })
+
+    return {
+        "year": year,
+        "types": types,
+        "totals": totals,
+        "year_over_year": year_over_year,
+        "entrances": _groups([str(item.entrance) for item in apartments], apartment_cube, types, "entrance"),
+        "floors": _groups([str(item.floor) for item in apartments], apartment_cube, types, "floor"),
+        "apartments": apartment_rows
+    }
+
+async def build_analytics(house: House, year: int, years: int = 5, types: List[str] = COUNTER_TYPES) -> dict:
+    ''' Analytics of house for year compared with years before it: 2 queries however big the house is '''
+    start_year = year - years + 1
+    apartments, series = await asyncio.gather(
+        Apartment.get_list(house_id=house._id, limit=0, fields=['number', 'entrance', 'floor']),
+        Consumption.get_series(start_year, year, house_id=house._id)
+    )
+    logging.info(f"Analytics of {house._id}: {len(apartments)} apartments, {len(series)} counters")
+    return analyze(apartments, series, year, start_year, types)
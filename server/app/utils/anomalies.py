@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import warnings
+import numpy as np
+
+from typing import List
+from datetime import datetime
+from itertools import chain
+
+from app.settings import SETTINGS
+from app.utils.mongo import MongoDB
+from app.objects import Event, Anomaly, Consumption
+from app.objects.reading_store import period_of
+
+EVENTS_CHUNK_SIZE = 500
+# Fewer points than this are not enough to call anything unusual
+MIN_HISTORY = 3
+MIN_PEERS = 3
+
+def _group_medians(values: np.ndarray, groups: np.ndarray, n_groups: int) -> tuple:
+    ''' Median and size of every group, NaN values are skipped '''
+    known = ~np.isnan(values)
+    values, groups = values[known], groups[known]
+    order = np.lexsort((values, groups))
+    values, groups = values[order], groups[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    medians = np.full(n_groups, np.nan)
+    present = counts > 0
+    low = values[(starts + (counts - 1) // 2)[present]]
+    high = values[(starts + counts // 2)[present]]
+    medians[present] = (low + high) / 2
+    return medians, counts
+
+def score(
+    series: List[dict],
+    period: int,
+    history: int = SETTINGS.ANOMALY_HISTORY_MONTHS,
+    factor: float = SETTINGS.ANOMALY_SPIKE_FACTOR,
+    zero_months: int = SETTINGS.ANOMALY_ZERO_MONTHS
+) -> List[tuple]:
+    ''' Anomalies of month period (period_of(year, month)) for Consumption.get_series documents:
+    [(series index, kind, expected)], all counters are scored at once '''
+    n = len(series)
+    if n == 0:
+        return []
+    width = history + 1
+    # counters x months, month period is the last column, NaN where there is no reading
+    lengths = np.fromiter((len(doc['periods']) for doc in series), dtype=np.int64, count=n)
+    total = int(lengths.sum())
+    rows = np.repeat(np.arange(n), lengths)
+    columns = np.fromiter(chain.from_iterable(doc['periods'] for doc in series), dtype=np.int64, count=total) - (period - history)
+    # A first reading has no delta: NaN, neither usage nor its absence
+    deltas = np.array(list(chain.from_iterable(doc['deltas'] for doc in series)), dtype=np.float64)
+    inside = (columns >= 0) & (columns < width)
+    matrix = np.full((n, width), np.nan)
+    matrix[rows[inside], columns[inside]] = deltas[inside]
+    current = matrix[:, -1]
+
+    # Counter went backwards
+    decrease = current < 0
+    # Nothing used for zero_months months in a row
+    zero = np.all(matrix[:, -zero_months:] == 0, axis=1)
+
+    # Against own history, decreases are errors not usage
+    past = matrix[:, :-1].copy()
+    past[past < 0] = np.nan
+    own_count = np.sum(~np.isnan(past), axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        own = np.nanmedian(past, axis=1)
+    own_spike = (own_count >= MIN_HISTORY) & (own > 0) & (current > factor * own)
+
+    # Against counters of the same type in the same house this month
+    group_keys = {}
+    groups = np.fromiter(
+        (group_keys.setdefault((doc['house_id'], doc['type']), len(group_keys)) for doc in series),
+        dtype=np.int64, count=n
+    )
+    peers_current = np.where(current >= 0, current, np.nan)
+    medians, counts = _group_medians(peers_current, groups, len(group_keys))
+    peer = medians[groups]
+    peer_spike = (counts[groups] >= MIN_PEERS) & (peer > 0) & (current > factor * peer)
+
+    expected = np.where(own_spike, own, peer)
+    result = []
+    for i in np.flatnonzero(decrease):
+        result.append((int(i), 'decrease', None))
+    for i in np.flatnonzero(zero):
+        result.append((int(i), 'zero', None))
+    for i in np.flatnonzero(own_spike | peer_spike):
+        result.append((int(i), 'spike', round(float(expected[i]), 3)))
+    return result
+
+def _details(anomaly: Anomaly, apartment: dict, counter: dict, zero_months: int) -> str:
+    where = f"Кв. {apartment.get('number', '?')}, счетчик {counter.get('serial_number', '?')} ({anomaly.type})"
+    if anomaly.kind == 'decrease':
+        return f"{where}: показания за {anomaly.month:02d}.{anomaly.year} меньше предыдущих на {round(-anomaly.delta, 1)}"
+    if anomaly.kind == 'zero':
+        return f"{where}: нет расхода {zero_months} мес. подряд по {anomaly.month:02d}.{anomaly.year}"
+    return f"{where}: расход {round(anomaly.delta, 1)} за {anomaly.month:02d}.{anomaly.year}, обычно около {round(anomaly.expected, 1)}"
+
+async def alert(anomalies: List, zero_months: int = SETTINGS.ANOMALY_ZERO_MONTHS) -> int:
+    ''' One system event per anomaly to every manager of its house, inserted in chunks '''
+    if not anomalies:
+        return 0
+    apartment_ids = list({anomaly.apartment_id for anomaly in anomalies})
+    counter_ids = list({anomaly.counter_id for anomaly in anomalies})
+    house_ids = list({anomaly.house_id for anomaly in anomalies})
+    apartments, counters, houses = await asyncio.gather(
+        MongoDB.db.apartments.find({'_id': {'$in': apartment_ids}}, {'number': 1}).to_list(None),
+        MongoDB.db.counters.find({'_id': {'$in': counter_ids}}, {'serial_number': 1}).to_list(None),
+        MongoDB.db.houses.find({'_id': {'$in': house_ids}}, {'managers': 1}).to_list(None),
+    )
+    apartments = {data['_id']: data for data in apartments}
+    counters = {data['_id']: data for data in counters}
+    managers = {data['_id']: data.get('managers', []) for data in houses}
+    created_at = datetime.now()
+    events = [
+        Event(
+            user_id=manager_id,
+            type="system",
+            title="Подозрительные показания",
+            details=_details(anomaly, apartments.get(anomaly.apartment_id, {}), counters.get(anomaly.counter_id, {}), zero_months),
+            house_id=anomaly.house_id,
+            created_at=created_at
+        )
+        for anomaly in anomalies
+        for manager_id in managers.get(anomaly.house_id, [])
+    ]
+    for i in range(0, len(events), EVENTS_CHUNK_SIZE):
+        await Event.insert_many(events[i:i + EVENTS_CHUNK_SIZE])
+    return len(events)
+
+async def detect_anomalies(now: datetime = None) -> dict:
+    ''' Score every active counter for the current month and alert managers about new anomalies '''
+    now = now if now is not None else datetime.now()
+    period = period_of(now.year, now.month)
+    start_year = (period - SETTINGS.ANOMALY_HISTORY_MONTHS) // 12
+    active, series = await asyncio.gather(
+        MongoDB.db.counters.distinct('_id', {'active': True}),
+        Consumption.get_series(start_year, now.year)
+    )
+    active = set(active)
+    series = [doc for doc in series if doc['_id'] in active]
+    found = []
+    for i, kind, expected in score(series, period):
+        doc = series[i]
+        found.append(Anomaly(
+            house_id=doc['house_id'],
+            apartment_id=doc['apartment_id'],
+            counter_id=doc['_id'],
+            type=doc['type'],
+            year=now.year,
+            month=now.month,
+            kind=kind,
+            delta=doc['deltas'][doc['periods'].index(period)] if period in doc['periods'] else 0,
+            expected=expected
+        ))
+    # Anomalies seen by an earlier run or another worker are not alerted again
+    new = await Anomaly.insert_new(found)
+    events = await alert(new)
+    logging.info(f"Anomalies: {len(series)} counters scored, {len(found)} found, {len(new)} new, {events} events")
+    return {"counters": len(series), "anomalies": len(found), "new": len(new), "events": events}
+
+async def run_detector(interval: float = SETTINGS.ANOMALY_SCAN_INTERVAL) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await detect_anomalies()
+        except Exception:
+            logging.exception('Anomaly detection failed')
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+
+from bson import ObjectId
+from datetime import datetime
+from pymongo import UpdateOne
+
+from app.settings import SETTINGS
+from app.utils.mongo import MongoDB
+from app.utils.cache import TTLCache
+
+class AuthCache:
+    ''' token -> (session, user) cache with write-behind sliding expiry '''
+    sessions: TTLCache = TTLCache(SETTINGS.AUTH_CACHE_SIZE, SETTINGS.AUTH_CACHE_TTL)
+    # session _id -> (updated_at, expires_at) waiting to be written
+    touches: dict = {}
+
+    @classmethod
+    def get(cls, token: str):
+        return cls.sessions.get(token)
+
+    @classmethod
+    def put(cls, session, user) -> None:
+        cls.sessions.set(session.token, (session, user))
+
+    @classmethod
+    def drop(cls, token: str) -> None:
+        cls.sessions.pop(token)
+
+    @classmethod
+    def invalidate_user(cls, user_id: ObjectId) -> None:
+        ''' Forget cached sessions of user (profile or password changed) '''
+        cls.sessions.pop_if(lambda item: item[1]._id == user_id)
+
+    @classmethod
+    def touch(cls, session) -> None:
+        ''' Remember new sliding expiry, it is written by flush() '''
+        cls.touches[session._id] = (session.updated_at, session.expires_at)
+
+    @classmethod
+    async def flush(cls) -> int:
+        if not cls.touches:
+            return 0
+        touches, cls.touches = cls.touches, {}
+        operations = [
+            UpdateOne(
+                {'_id': _id},
+                {'$set': {'updated_at': updated_at, 'expires_at': expires_at}}
+            )
+            for _id, (updated_at, expires_at) in touches.items()
+        ]
+        try:
+            await MongoDB.db.sessions.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logging.error(f'Exception while flushing sessions: {e}')
+            # Put back everything that was not overwritten by newer touches
+            for _id, value in touches.items():
+                cls.touches.setdefault(_id, value)
+            return 0
+        logging.debug(f'Flushed {len(operations)} sessions')
+        return len(operations)
+
+    @classmethod
+    async def run_flusher(cls, interval: float = SETTINGS.SESSIONS_FLUSH_INTERVAL) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await cls.flush()
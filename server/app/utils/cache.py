@@ -0,0 +1,50 @@
+import time
+
+from collections import OrderedDict
+
+class TTLCache:
+    ''' Bounded LRU cache with time to live for every entry '''
+    maxsize: int
+    ttl: float
+    data: OrderedDict
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value) -> None:
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        if item is None:
+            return default
+        return item[1]
+
+    def pop_if(self, predicate) -> int:
+        ''' Remove all entries whose value matches predicate '''
+        keys = [key for key, (_, value) in self.data.items() if predicate(value)]
+        for key in keys:
+            del self.data[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        self.data.clear()
@@ -0,0 +1,75 @@
+from bson import ObjectId
+
+from app.utils.mongo import MongoDB
+from app.utils.pagination import keyset_filter, encode_cursor, page
+from app.objects import Apartment
+
+DASHBOARD_MAX_LIMIT = 2000
+
+def _counter_json(counter: dict, current: dict | None) -> dict:
+    return {
+        "id": str(counter['_id']),
+        "name": counter.get('name'),
+        "type": counter.get('type'),
+        "serial_number": counter.get('serial_number'),
+        "active": counter.get('active'),
+        "has_reading": current is not None,
+        "value": current['value'] if current is not None else None,
+        "delta": current.get('delta') if current is not None else None
+    }
+
+async def build_dashboard(house_id: ObjectId, year: int, month: int, limit: int = 1000, cursor: str = None) -> dict:
+    ''' Page of apartments of house with their counters and whether each counter has a reading
+    for year/month: one aggregation for apartments and counters, one rollup query for readings '''
+    filter = keyset_filter({'house_id': house_id}, Apartment.order, cursor)
+    pipeline = [
+        {'$match': filter},
+        {'$sort': dict(Apartment.order)},
+        {'$limit': limit},
+        {'$project': {'number': 1, 'entrance': 1, 'floor': 1, 'owner_id': 1}},
+        {'$lookup': {'from': 'counters', 'localField': '_id', 'foreignField': 'apartment_id', 'as': 'counters'}},
+        {'$project': {
+            'number': 1, 'entrance': 1, 'floor': 1, 'owner_id': 1,
+            'counters._id': 1, 'counters.name': 1, 'counters.type': 1, 'counters.serial_number': 1, 'counters.active': 1
+        }},
+    ]
+    apartments = await MongoDB.db.apartments.aggregate(pipeline).to_list(None)
+    # A rollup document exists exactly when the counter has a reading of that month
+    counter_ids = [counter['_id'] for apartment in apartments for counter in apartment['counters']]
+    current = {}
+    if counter_ids:
+        rollup = MongoDB.db.consumption_monthly.find(
+            {'counter_id': {'$in': counter_ids}, 'year': year, 'month': month},
+            {'counter_id': 1, 'value': 1, 'delta': 1}
+        )
+        current = {data['counter_id']: data async for data in rollup}
+
+    items = []
+    submitted = expected = 0
+    for apartment in apartments:
+        counters = [_counter_json(counter, current.get(counter['_id'])) for counter in apartment['counters']]
+        active = [counter for counter in counters if counter['active']]
+        done = sum(1 for counter in active if counter['has_reading'])
+        submitted += done
+        expected += len(active)
+        items.append({
+            "id": str(apartment['_id']),
+            "number": apartment.get('number'),
+            "entrance": apartment.get('entrance'),
+            "floor": apartment.get('floor'),
+            "owner_id": str(apartment.get('owner_id')),
+            "counters": counters,
+            "submitted": done,
+            "expected": len(active)
+        })
+    next_cursor = None
+    if limit and len(apartments) == limit:
+        last = apartments[-1]
+        next_cursor = encode_cursor([last.get(field) for field, _ in Apartment.order])
+    return {
+        "year": year,
+        "month": month,
+        "submitted": submitted,
+        "expected": expected,
+        **page(items, next_cursor)
+    }
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+from app.settings import SETTINGS
+from app.utils.mongo import MongoDB
+from app.utils.cache import TTLCache
+
+# $changeStream only supported on replica sets / not supported by this storage engine
+CHANGE_STREAM_UNSUPPORTED = (40573, 40324)
+
+class EventHub:
+    ''' In-process pub/sub of new events to connected users,
+    other workers' events arrive through a Mongo change stream '''
+    # user_id -> queues of open connections
+    subscribers: dict = {}
+    # Events already delivered by this worker, the change stream skips them
+    published: TTLCache = TTLCache(maxsize=100000, ttl=5 * 60)
+
+    @classmethod
+    def subscribe(cls, user_id: ObjectId) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SETTINGS.EVENTS_QUEUE_SIZE)
+        cls.subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    @classmethod
+    def unsubscribe(cls, user_id: ObjectId, queue: asyncio.Queue) -> None:
+        queues = cls.subscribers.get(user_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del cls.subscribers[user_id]
+
+    @classmethod
+    def publish(cls, user_id: ObjectId, _id: ObjectId, payload: dict) -> None:
+        ''' Deliver to open connections of user, never blocks '''
+        queues = cls.subscribers.get(user_id)
+        if not queues:
+            return
+        if _id is not None:
+            if cls.published.get(_id) is not None:
+                return
+            cls.published.set(_id, True)
+        for queue in queues:
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                # A stuck client loses events, it reloads /events/my on reconnect
+                logging.debug(f'Event queue of {user_id} is full')
+
+    @classmethod
+    async def run_feeder(cls, model, retry: float = 5) -> None:
+        ''' Publish events inserted by any worker, resumes after errors.
+        Stops for good when the server has no change streams (standalone mongod) '''
+        resume_after = None
+        pipeline = [{'$match': {'operationType': 'insert'}}]
+        while True:
+            try:
+                async with MongoDB.db[model.collection].watch(pipeline, resume_after=resume_after) as stream:
+                    logging.info(f'Watching {model.collection} for new events')
+                    async for change in stream:
+                        resume_after = stream.resume_token
+                        document = change['fullDocument']
+                        # Only users connected to this worker matter, the rest read /events/my later
+                        if document.get('user_id') in cls.subscribers:
+                            event = model.from_bson(document)
+                            cls.publish(event.user_id, event._id, event.to_json())
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code not in CHANGE_STREAM_UNSUPPORTED:
+                    logging.error(f'Exception in events change stream: {e}')
+                    await asyncio.sleep(retry)
+                    continue
+                logging.warning(
+                    f'MongoDB has no change streams ({e}), events reach only connections of the worker '
+                    'that created them. Run a replica set or set EVENTS_CHANGE_STREAM=false'
+                )
+                return
+            except Exception as e:
+                logging.error(f'Exception in events change stream: {e}')
+                await asyncio.sleep(retry)
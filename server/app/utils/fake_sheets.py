@@ -0,0 +1,144 @@
+import copy
+import secrets
+import gspread
+
+from json import dumps, loads
+from requests import Response
+from gspread.urls import DRIVE_FILES_API_V3_URL, SPREADSHEETS_API_V4_BASE_URL, SPREADSHEET_DRIVE_URL
+
+# In-memory Google Drive and Sheets REST endpoints behind a real gspread.Client:
+# requests go through gspread's HTTP layer and are recorded as sent,
+# enabled by GOOGLE_SHEETS_FAKE=true
+
+class FakeSpreadsheet:
+    def __init__(self, title: str) -> None:
+        self.id = secrets.token_urlsafe(16)
+        self.title = title
+        self.url = SPREADSHEET_DRIVE_URL % self.id
+        self.permissions = []
+        # sheetId -> {"title", "cells": {(row, column): value}, "merges": [], "formats": []}
+        self.sheets = {0: self._sheet("Sheet1")}
+
+    def _sheet(self, title: str) -> dict:
+        return {"title": title, "cells": {}, "merges": [], "formats": []}
+
+    def metadata(self) -> dict:
+        ''' spreadsheets.get without grid data '''
+        return {
+            "spreadsheetId": self.id,
+            "properties": {"title": self.title, "locale": "ru_RU", "timeZone": "Europe/Moscow"},
+            "sheets": [
+                {"properties": {"sheetId": sheet_id, "title": sheet["title"], "index": index}}
+                for index, (sheet_id, sheet) in enumerate(self.sheets.items())
+            ],
+            "spreadsheetUrl": self.url
+        }
+
+    def batch_update(self, body: dict) -> dict:
+        ''' spreadsheets.batchUpdate, atomic: a failing request leaves the spreadsheet as it was '''
+        sheets = copy.deepcopy(self.sheets)
+        try:
+            replies = []
+            for request in body["requests"]:
+                (kind, params), = request.items()
+                handler = getattr(self, f"_{kind}", None)
+                if handler is None:
+                    raise ValueError(f"Unsupported request: {kind}")
+                replies.append(handler(params) or {})
+        except Exception:
+            self.sheets = sheets
+            raise
+        return {"spreadsheetId": self.id, "replies": replies}
+
+    def worksheet_values(self, title: str) -> list:
+        ''' Values of worksheet as list of rows '''
+        sheet = next(sheet for sheet in self.sheets.values() if sheet["title"] == title)
+        if not sheet["cells"]:
+            return []
+        rows = max(row for row, _ in sheet["cells"]) + 1
+        columns = max(column for _, column in sheet["cells"]) + 1
+        return [[sheet["cells"].get((r, c), "") for c in range(columns)] for r in range(rows)]
+
+    def _get(self, sheet_id: int) -> dict:
+        if sheet_id not in self.sheets:
+            raise ValueError(f"No grid with id: {sheet_id}")
+        return self.sheets[sheet_id]
+
+    def _addSheet(self, params: dict) -> dict:
+        properties = params["properties"]
+        sheet_id = properties["sheetId"]
+        if sheet_id in self.sheets:
+            raise ValueError(f"Sheet with id {sheet_id} already exists")
+        self.sheets[sheet_id] = self._sheet(properties["title"])
+        return {"addSheet": {"properties": properties}}
+
+    def _deleteSheet(self, params: dict) -> None:
+        self._get(params["sheetId"])
+        del self.sheets[params["sheetId"]]
+
+    def _mergeCells(self, params: dict) -> None:
+        self._get(params["range"]["sheetId"])["merges"].append(params["range"])
+
+    def _repeatCell(self, params: dict) -> None:
+        self._get(params["range"]["sheetId"])["formats"].append(params)
+
+    def _updateCells(self, params: dict) -> None:
+        start = params["start"]
+        sheet = self._get(start["sheetId"])
+        for r, row in enumerate(params["rows"], start=start["rowIndex"]):
+            for c, cell in enumerate(row.get("values", []), start=start["columnIndex"]):
+                value = cell.get("userEnteredValue")
+                if value is not None:
+                    (_, sheet["cells"][(r, c)]), = value.items()
+
+class FakeSheetsSession:
+    ''' Takes the place of the authorized requests session of gspread's HTTPClient '''
+    def __init__(self) -> None:
+        self.headers = {}
+        self.spreadsheets = {}
+        # {"method", "url", "params", "json"} of every request
+        self.requests = []
+
+    def request(self, method: str, url: str, json=None, params=None, data=None, files=None, headers=None, timeout=None) -> Response:
+        # Through JSON like on the wire, values the API cannot take fail here too
+        body = loads(dumps(json)) if json is not None else None
+        self.requests.append({"method": method.upper(), "url": url, "params": params, "json": body})
+        try:
+            return _response(200, self._serve(method.upper(), url, body))
+        except KeyError as e:
+            return _response(404, _error(404, "NOT_FOUND", f"Requested entity was not found: {e}"))
+        except ValueError as e:
+            return _response(400, _error(400, "INVALID_ARGUMENT", str(e)))
+
+    def _serve(self, method: str, url: str, body: dict | None) -> dict:
+        if url.startswith(DRIVE_FILES_API_V3_URL):
+            path = url[len(DRIVE_FILES_API_V3_URL):].strip("/").split("/")
+            if method == "POST" and path == [""]:
+                spreadsheet = FakeSpreadsheet(body["name"])
+                self.spreadsheets[spreadsheet.id] = spreadsheet
+                return {"kind": "drive#file", "id": spreadsheet.id, "name": spreadsheet.title, "mimeType": body["mimeType"]}
+            if method == "POST" and len(path) == 2 and path[1] == "permissions":
+                permission = {"kind": "drive#permission", "id": secrets.token_hex(8), **body}
+                self.spreadsheets[path[0]].permissions.append(permission)
+                return permission
+        elif url.startswith(SPREADSHEETS_API_V4_BASE_URL + "/"):
+            path = url[len(SPREADSHEETS_API_V4_BASE_URL) + 1:]
+            if method == "POST" and path.endswith(":batchUpdate"):
+                return self.spreadsheets[path[:-len(":batchUpdate")]].batch_update(body)
+            if method == "GET" and "/" not in path:
+                return self.spreadsheets[path].metadata()
+        raise KeyError(f"{method} {url}")
+
+def _response(status_code: int, body: dict) -> Response:
+    response = Response()
+    response.status_code = status_code
+    response.headers["Content-Type"] = "application/json; charset=UTF-8"
+    response._content = dumps(body).encode("utf-8")
+    return response
+
+def _error(code: int, status: str, message: str) -> dict:
+    return {"error": {"code": code, "message": message, "status": status}}
+
+def fake_client() -> gspread.Client:
+    ''' gspread client over FakeSheetsSession, the session is client.http_client.session '''
+    return gspread.Client(None, session=FakeSheetsSession())
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+
+from bson import ObjectId
+from datetime import datetime, timedelta
+
+from app.settings import SETTINGS
+from app.objects.job import Job
+
+class Jobs:
+    ''' Background tasks of this worker, their state is stored in the jobs collection '''
+    # Strong references so running tasks are not garbage collected
+    tasks: set = set()
+
+    @classmethod
+    def stale_before(cls) -> datetime:
+        ''' Active jobs not touched since then belong to a stopped worker '''
+        return datetime.now() - timedelta(seconds=3 * SETTINGS.JOBS_HEARTBEAT)
+
+    @classmethod
+    async def setup(cls) -> None:
+        ''' Jobs left active by a stopped process will never finish '''
+        failed = await Job.fail_stale(cls.stale_before())
+        if failed:
+            logging.info(f'Failed {failed} jobs of stopped workers')
+
+    @classmethod
+    async def start(cls, kind: str, user_id: ObjectId, func, *args) -> Job:
+        ''' Run `await func(job, *args)` in background, its return value becomes job result '''
+        job = Job(kind=kind, user_id=user_id)
+        await job.save()
+        task = asyncio.get_running_loop().create_task(cls._run(job, func, *args))
+        cls.tasks.add(task)
+        task.add_done_callback(cls.tasks.discard)
+        return job
+
+    @classmethod
+    async def get(cls, job_id: str) -> Job | None:
+        if not ObjectId.is_valid(job_id):
+            return None
+        return await Job.get_by_id(ObjectId(job_id))
+
+    @classmethod
+    async def heartbeat(cls, job) -> None:
+        ''' Keep touching job (Job or ReportJob) while it runs '''
+        while True:
+            await asyncio.sleep(SETTINGS.JOBS_HEARTBEAT)
+            try:
+                await job.heartbeat()
+            except Exception as e:
+                logging.error(f'Exception in heartbeat of job {job._id}: {e}')
+
+    @classmethod
+    async def _run(cls, job: Job, func, *args) -> None:
+        heartbeat = asyncio.get_running_loop().create_task(cls.heartbeat(job))
+        try:
+            await job.set_status("running")
+            result = await func(job, *args)
+            await job.set_status("done", result=result)
+        except Exception as e:
+            logging.exception(f'Job {job.kind} {job._id} failed')
+            await job.set_status("failed", error=str(e))
+        finally:
+            heartbeat.cancel()
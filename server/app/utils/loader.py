@@ -0,0 +1,74 @@
+import asyncio
+
+from bson import ObjectId
+from typing import List
+from contextvars import ContextVar
+
+from app.utils.mongo import MongoDB
+
+# model -> DataLoader of the current request
+_loaders: ContextVar[dict | None] = ContextVar('loaders', default=None)
+
+class DataLoader:
+    ''' Batches get-by-id lookups of one model made in the same loop tick '''
+    model: type
+    cache: dict
+    queue: dict
+
+    def __init__(self, model: type) -> None:
+        self.model = model
+        self.cache = {}
+        self.queue = {}
+
+    def load(self, _id: ObjectId) -> asyncio.Future:
+        _id = ObjectId(_id)
+        if _id in self.cache:
+            return self.cache[_id]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.cache[_id] = future
+        if not self.queue:
+            # Runs after everything requested in this tick is queued
+            loop.create_task(self.dispatch())
+        self.queue[_id] = future
+        return future
+
+    async def load_many(self, ids: List[ObjectId]) -> List:
+        return list(await asyncio.gather(*[self.load(_id) for _id in ids]))
+
+    async def dispatch(self) -> None:
+        queue, self.queue = self.queue, {}
+        try:
+            cursor = MongoDB.db[self.model.collection].find({'_id': {'$in': list(queue)}})
+            async for data in cursor:
+                future = queue.pop(data['_id'], None)
+                if future is not None:
+                    future.set_result(self.model.from_bson(data))
+        except Exception as e:
+            for _id, future in queue.items():
+                # Don't memoize failures
+                self.cache.pop(_id, None)
+                future.set_exception(e)
+            return
+        # Not found
+        for future in queue.values():
+            future.set_result(None)
+
+def start_request() -> None:
+    ''' Give the current request its own set of loaders '''
+    _loaders.set({})
+
+def loader(model: type) -> DataLoader:
+    ''' Loader of model for current request, one-off loader outside requests '''
+    loaders = _loaders.get()
+    if loaders is None:
+        return DataLoader(model)
+    if model not in loaders:
+        loaders[model] = DataLoader(model)
+    return loaders[model]
+
+async def load(model: type, _id: ObjectId):
+    return await loader(model).load(_id)
+
+async def load_many(model: type, ids: List[ObjectId]) -> List:
+    return await loader(model).load_many(ids)
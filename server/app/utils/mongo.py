@@ -1,5 +1,6 @@
 import logging
 
+from typing import List
 from pymongo.database import Database
 from motor.motor_asyncio import AsyncIOMotorClient
 
@@ -21,4 +22,97 @@ class MongoDB:
             cls.client.admin.command('ping')
             logging.info('Connected to MongoDB')
         except Exception as e:
-            logging.error(f'Exception while connecting to MongoDB: {e}')
\ No newline at end of file
+            logging.error(f'Exception while connecting to MongoDB: {e}')
+
+    @classmethod
+    async def transaction(cls, func):
+        ''' Await func(session) inside a transaction, retried on transient errors.
+        With MONGODB_TRANSACTIONS off func gets session None and writes are not atomic '''
+        if not SETTINGS.MONGODB_TRANSACTIONS:
+            return await func(None)
+        async with await cls.client.start_session() as session:
+            return await session.with_transaction(func)
+
+    @classmethod
+    async def setup_indexes(cls, models: List) -> List[str]:
+        ''' Reconcile collection indexes with `indexes` declared by models, return the declared
+        ones that could not be created. The server keeps running without them, check-indexes fails '''
+        failed = []
+        for model in models:
+            collection = cls.db[model.collection]
+            existing = await collection.index_information()
+            declared = {index.document['name']: index for index in model.indexes}
+            for name, info in existing.items():
+                if name == '_id_':
+                    continue
+                index = declared.get(name)
+                if index is None:
+                    # Could be created by hand or by a newer version still rolling out
+                    if not SETTINGS.MONGODB_DROP_UNDECLARED_INDEXES:
+                        logging.warning(f'Index {model.collection}.{name} is not declared by any model')
+                        continue
+                elif cls._same_index(info, index.document):
+                    continue
+                # Declared differently: recreated below
+                logging.info(f'Dropping index {model.collection}.{name}')
+                await collection.drop_index(name)
+                existing[name] = None
+            for name, index in declared.items():
+                if existing.get(name) is not None:
+                    continue
+                try:
+                    await collection.create_indexes([index])
+                    logging.info(f'Created index {model.collection}.{name}')
+                except Exception as e:
+                    logging.error(f'Exception while creating index {model.collection}.{name}: {e}')
+                    failed.append(f'{model.collection}.{name}')
+                    if index.document.get('unique'):
+                        # Existing duplicates, uniqueness is not enforced until they are gone
+                        logging.critical(
+                            f'Unique index {model.collection}.{name} is missing, '
+                            'run `python -m app find-duplicates` to list and remove duplicates'
+                        )
+        return failed
+
+    @classmethod
+    async def find_duplicates(cls, model, index) -> List[dict]:
+        ''' Groups of documents breaking unique index of model: {'key': {...}, 'ids': [oldest first]} '''
+        fields = list(index.document['key'])
+        pipeline = [
+            {'$match': index.document.get('partialFilterExpression', {})},
+            {'$sort': {'_id': 1}},
+            {'$group': {'_id': {field.replace('.', '_'): f'${field}' for field in fields}, 'ids': {'$push': '$_id'}}},
+            {'$match': {'ids.1': {'$exists': True}}},
+        ]
+        cursor = cls.db[model.collection].aggregate(pipeline, allowDiskUse=True)
+        return [{'key': data['_id'], 'ids': data['ids']} async for data in cursor]
+
+    @classmethod
+    def _same_index(cls, info: dict, document: dict) -> bool:
+        return list(info['key']) == list(document['key'].items()) and \
+            bool(info.get('unique', False)) == bool(document.get('unique', False))
+
+    @classmethod
+    async def check_indexes(cls, models: List) -> List[str]:
+        ''' Explain `queries` declared by models, return the ones that scan a collection '''
+        failed = []
+        for model in models:
+            for query in getattr(model, 'queries', []):
+                cursor = cls.db[model.collection].find(query['filter'])
+                if query.get('sort'):
+                    cursor = cursor.sort(query['sort'])
+                plan = await cursor.explain()
+                if cls._has_stage(plan.get('queryPlanner', plan), 'COLLSCAN'):
+                    failed.append(f"{model.collection}: {query}")
+        return failed
+
+    @classmethod
+    def _has_stage(cls, plan, stage: str) -> bool:
+        if isinstance(plan, dict):
+            if plan.get('stage') == stage:
+                return True
+            # Rejected plans were not chosen by the planner
+            return any(cls._has_stage(v, stage) for k, v in plan.items() if k != 'rejectedPlans')
+        if isinstance(plan, list):
+            return any(cls._has_stage(v, stage) for v in plan)
+        return False
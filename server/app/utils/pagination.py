@@ -0,0 +1,50 @@
+import base64
+
+from typing import List
+from bson import json_util
+from starlette.responses import JSONResponse
+
+# Sort is a list of (field, direction) which must end with _id,
+# a cursor holds values of these fields for the last item of a page
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        return json_util.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def keyset_filter(filter: dict, sort: List[tuple], cursor: str | None) -> dict:
+    ''' Extend filter to items that go after cursor in sort order '''
+    if not cursor:
+        return filter
+    values = decode_cursor(cursor)
+    if len(values) != len(sort):
+        raise ValueError("Invalid cursor")
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        branch = {sort[j][0]: values[j] for j in range(i)}
+        branch[field] = {'$lt' if direction < 0 else '$gt': values[i]}
+        branches.append(branch)
+    return {'$and': [filter, {'$or': branches}]}
+
+def next_cursor(items: List, sort: List[tuple], limit: int) -> str | None:
+    ''' Cursor of the next page, None when this page is the last one '''
+    if not items or not limit or len(items) < limit:
+        return None
+    last = items[-1]
+    return encode_cursor([getattr(last, field) for field, _ in sort])
+
+def page(items: List, next_cursor: str | None) -> dict:
+    ''' Envelope of every keyset paged response '''
+    return {"items": items, "next_cursor": next_cursor}
+
+def page_response(items: List, sort: List[tuple], limit: int, paged: bool, cursor: str | None = None) -> JSONResponse:
+    ''' Plain list for skip/limit clients, page envelope when client asks for paged=true.
+    A cursor can only come from a paged response, so it implies paged '''
+    content = [item.to_json() for item in items]
+    if not paged and not cursor:
+        return JSONResponse(content, status_code=200)
+    return JSONResponse(page(content, next_cursor(items, sort, limit)), status_code=200)
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from concurrent.futures import ThreadPoolExecutor
+
+from app.settings import SETTINGS
+from app.utils.mongo import MongoDB
+from app.utils.reports import build_report
+from app.utils.tables import SINKS
+from app.utils.jobs import Jobs
+from app.objects import House, ReportJob
+
+class ReportJobs:
+    ''' Report generation off the event loop, one job per house-month at a time '''
+    # Bounded pool for blocking Google Sheets calls
+    executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=SETTINGS.REPORT_WORKERS, thread_name_prefix='reports')
+    tasks: set = set()
+
+    @classmethod
+    async def setup(cls) -> None:
+        ''' Jobs left active by a stopped process will never finish, jobs of other
+        running workers keep their heartbeat and are left alone '''
+        failed = await ReportJob.fail_stale(Jobs.stale_before())
+        if failed:
+            logging.info(f'Failed {failed} report jobs of stopped workers')
+
+    @classmethod
+    async def submit(cls, house: House, year: int, month: int, user_id: ObjectId) -> ReportJob:
+        ''' Start report job or return the one already running for this house-month '''
+        job = ReportJob(house_id=house._id, user_id=user_id, year=year, month=month)
+        try:
+            await job.save()
+        except DuplicateKeyError:
+            # A job of a stopped worker must not block the house-month
+            await ReportJob.fail_stale(Jobs.stale_before())
+            existing = await ReportJob.get_active(house._id, year, month)
+            if existing is not None:
+                return existing
+            # Finished between insert and lookup
+            return await cls.submit(house, year, month, user_id)
+        task = asyncio.get_running_loop().create_task(cls._run(job, house))
+        cls.tasks.add(task)
+        task.add_done_callback(cls.tasks.discard)
+        return job
+
+    @classmethod
+    async def _run(cls, job: ReportJob, house: House) -> None:
+        heartbeat = asyncio.get_running_loop().create_task(Jobs.heartbeat(job))
+        try:
+            await job.set_status("running")
+            report = await build_report(house, job.year, job.month)
+            loop = asyncio.get_running_loop()
+            url = await loop.run_in_executor(
+                cls.executor, SINKS["sheets"].write, house.address, job.year, job.month, report["tables"]
+            )
+            await job.set_status("done", result=url)
+        except Exception as e:
+            logging.exception(f'Report job {job._id} failed')
+            await job.set_status("failed", error=str(e))
+        finally:
+            heartbeat.cancel()
+
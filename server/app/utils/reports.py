@@ -0,0 +1,93 @@
+import logging
+
+from typing import List
+
+from app.utils.mongo import MongoDB
+from app.objects import House, Apartment, Counter, Consumption
+
+COUNTER_TYPES = ["electricity", "hot_water", "cold_water"]
+
+def previous_month(year: int, month: int) -> tuple:
+    if month == 1:
+        return year - 1, 12
+    return year, month - 1
+
+def form_tables(address: str, apartments: List, counters: List, readings: dict, old_readings: dict, types: List[str] = COUNTER_TYPES) -> dict:
+    ''' One pass over apartments, readings are counter_id -> value
+    Returns {"tables": {type: rows}, "totals": {type: {...}}} '''
+    apartment_to_counters = {}
+    for counter in counters:
+        apartment_to_counters.setdefault((counter.apartment_id, counter.type), []).append(counter)
+
+    tables = {counter_type: [] for counter_type in types}
+    totals = {counter_type: {"apartments": 0, "counters": 0, "readings": 0, "consumed": 0} for counter_type in types}
+    numbers = {counter_type: 1 for counter_type in types}
+    for apartment in apartments:
+        apartment_name = f"{address}, кв. {apartment.number}"
+        for counter_type in types:
+            table = tables[counter_type]
+            total = totals[counter_type]
+            i = numbers[counter_type]
+            numbers[counter_type] += 1
+            total["apartments"] += 1
+            # if apartment doesn't have counters
+            apartment_counters = apartment_to_counters.get((apartment._id, counter_type))
+            if apartment_counters is None:
+                table.append([str(i), apartment_name, "нет приборов учета", "", "", "огульно"])
+                continue
+            # if apartment has counters
+            firstRow = True
+            for counter in apartment_counters:
+                prev_value = old_readings.get(counter._id)
+                new_value = readings.get(counter._id)
+                number = str(i) if firstRow else ""
+                total["counters"] += 1
+                if new_value is not None:
+                    total["readings"] += 1
+
+                if prev_value is not None and new_value is not None:
+                    consumed = new_value - prev_value
+                    table.append([number, apartment_name, counter.serial_number, prev_value, new_value, consumed])
+                elif prev_value is None and new_value is None:
+                    consumed = 0
+                    table.append([number, apartment_name, counter.serial_number, "", "", consumed])
+                elif prev_value is None:
+                    consumed = new_value
+                    table.append([number, apartment_name, counter.serial_number, "", new_value, consumed])
+                else:
+                    consumed = 0
+                    table.append([number, apartment_name, counter.serial_number, prev_value, "", consumed])
+                total["consumed"] += consumed
+                firstRow = False
+    return {"tables": tables, "totals": totals}
+
+async def build_report(house: House, year: int, month: int, types: List[str] = COUNTER_TYPES) -> dict:
+    ''' Report of every counter type for house-month: 3 queries however big the house is,
+    previous values are the last readings before the month '''
+    # All apartments of the house
+    apartments = await Apartment.get_list(house_id=house._id, limit=0, fields=['number'])
+    logging.info(f"Found {len(apartments)} apartments")
+    # Counters of all types at once
+    cursor = MongoDB.db.counters.find(
+        {"apartment_id": {"$in": [apartment._id for apartment in apartments]}, "type": {"$in": types}},
+        Counter.projection(['apartment_id', 'serial_number', 'type'])
+    )
+    counters = [Counter.from_bson(data) async for data in cursor]
+    logging.info(f"Found {len(counters)} counters")
+    # This and previous month from the consumption rollup
+    prev_year, prev_month = previous_month(year, month)
+    rollup = await Consumption.get_house_months(
+        house._id, [(year, month), (prev_year, prev_month)],
+        fields=['counter_id', 'year', 'month', 'prev_value', 'value']
+    )
+    readings = {}
+    old_readings = {}
+    for item in rollup:
+        if item.year == year and item.month == month:
+            readings[item.counter_id] = item.value
+            if item.prev_value is not None:
+                old_readings[item.counter_id] = item.prev_value
+        elif item.counter_id not in old_readings:
+            old_readings[item.counter_id] = item.value
+    logging.info(f"Found {len(readings)} readings this month, {len(old_readings)} previous month")
+    return form_tables(house.address, apartments, counters, readings, old_readings, types)
@@ -0,0 +1,61 @@
+import re
+import csv
+import json
+import codecs
+
+from starlette.responses import StreamingResponse
+
+# Response formats of list endpoints: json collects a list, ndjson and stream write
+# documents as the cursor yields them (ndjson - one per line, stream - chunked JSON array)
+FORMATS = ["json", "ndjson", "stream"]
+
+async def _ndjson(cursor, serialize):
+    async for data in cursor:
+        yield json.dumps(serialize(data), ensure_ascii=False) + "\n"
+
+async def _json_array(cursor, serialize):
+    yield "["
+    first = True
+    async for data in cursor:
+        yield ("" if first else ",") + json.dumps(serialize(data), ensure_ascii=False)
+        first = False
+    yield "]"
+
+def stream_response(cursor, serialize, format: str) -> StreamingResponse:
+    ''' Stream async iterator, serialize turns each item into JSON-able dict '''
+    if format == "ndjson":
+        return StreamingResponse(_ndjson(cursor, serialize), media_type="application/x-ndjson")
+    return StreamingResponse(_json_array(cursor, serialize), media_type="application/json")
+
+# A line with its terminator, \r\n counts as one
+LINE = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)')
+
+async def csv_rows(chunks, delimiter: str = ","):
+    ''' Parse CSV from an async iterator of byte chunks (request.stream()) as it arrives,
+    yields (row number, row), a UTF-8 BOM is skipped. A quoted field may span lines and chunks:
+    lines are collected until its quotes are balanced, then parsed as one row '''
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    record = ""
+    number = 0
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        end = 0
+        for match in LINE.finditer(buffer):
+            # \r at the end of a chunk may be the first half of \r\n
+            if match.end() == len(buffer) and buffer.endswith("\r"):
+                break
+            end = match.end()
+            record += match.group()
+            if record.count('"') % 2:
+                continue
+            for row in csv.reader([record], delimiter=delimiter):
+                number += 1
+                yield number, row
+            record = ""
+        buffer = buffer[end:]
+    record += buffer + decoder.decode(b"", final=True)
+    if record:
+        for row in csv.reader([record], delimiter=delimiter):
+            number += 1
+            yield number, row
@@ -1,40 +1,272 @@
+import io
+import re
+import csv
+import threading
+import zipfile
 import gspread
-from gspread_formatting import *
+
+from abc import ABC, abstractmethod
+from typing import Iterator
+from xml.sax.saxutils import escape
+
+from app.settings import SETTINGS
+
+# Worksheet titles and units of counter types
+TITLES = {"electricity": "ЭЭ", "hot_water": "ГВС", "cold_water": "ХВС"}
+UNITS = {"electricity": "кВт - ч", "hot_water": "куб.м.", "cold_water": "куб.м."}
+# Cells merged on every worksheet
+MERGES = ["B1:F1", "A3:F3"]
+
+def table_rows(house, counter_type, table_data):
+    ''' Report table with its header rows '''
+    consumed_text = UNITS.get(counter_type, "единиц")
+    title = TITLES.get(counter_type, counter_type)
+    return [
+        ["Дом:", house],
+        [],
+        [f"Журнал учета показаний {title}"],
+        [f"№\nп/п", "Адрес", "Серийный номер счетчика", f"Пред. показания\n{consumed_text}", f"Тек. показания\n{consumed_text}", f"Количество потреблен.\n{consumed_text}"],
+    ] + table_data
+
+class ReportSink:
+    ''' Destination of report tables, tables are {counter_type: rows} '''
+    name: str
+
+class GoogleSheetsSink(ReportSink):
+    ''' Blocking: shared spreadsheet with a worksheet per counter type
+    Sheets, merges, formats and values go in one batch_update '''
+    name = "sheets"
+
+    def write(self, house, year, month, tables) -> str:
+        client = get_service_account()
+        sh = client.create(f"{house} - {year}.{month}")
+        sh.share(None, role='writer', perm_type='anyone')
+        sh.batch_update({"requests": self.requests(house, tables)})
+        return sh.url
+
+    def requests(self, house, tables) -> list:
+        requests = []
+        for sheet_id, (counter_type, table_data) in enumerate(tables.items(), start=1):
+            rows = table_rows(house, counter_type, table_data)
+            requests.append({"addSheet": {"properties": {
+                "sheetId": sheet_id,
+                "title": TITLES.get(counter_type, counter_type),
+                "gridProperties": {"rowCount": len(rows) + 10, "columnCount": 20}
+            }}})
+            for cells in MERGES:
+                requests.append({"mergeCells": {"range": _grid_range(sheet_id, cells), "mergeType": "MERGE_ALL"}})
+            requests.append({"repeatCell": {
+                "range": _grid_range(sheet_id, "A3:F3"),
+                "cell": {"userEnteredFormat": {"textFormat": {"bold": True, "fontSize": 14}, "horizontalAlignment": "CENTER"}},
+                "fields": "userEnteredFormat(textFormat,horizontalAlignment)"
+            }})
+            requests.append({"updateCells": {
+                "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                "rows": [{"values": [_sheets_value(value) for value in row]} for row in rows],
+                "fields": "userEnteredValue"
+            }})
+        # New spreadsheets come with an empty sheet 0
+        requests.append({"deleteSheet": {"sheetId": 0}})
+        return requests
+
+def _sheets_value(value) -> dict:
+    if value is None or value == "":
+        return {}
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+def _grid_range(sheet_id: int, cells: str) -> dict:
+    ''' "B1:F1" -> GridRange, end indexes are exclusive '''
+    start, end = [re.match(r"([A-Z]+)(\d+)", ref).groups() for ref in cells.split(":")]
+    return {
+        "sheetId": sheet_id,
+        "startRowIndex": int(start[1]) - 1,
+        "endRowIndex": int(end[1]),
+        "startColumnIndex": _column_index(start[0]),
+        "endColumnIndex": _column_index(end[0]) + 1
+    }
+
+def _column_index(name: str) -> int:
+    index = 0
+    for char in name:
+        index = index * 26 + ord(char) - ord("A") + 1
+    return index - 1
+
+class StreamSink(ReportSink, ABC):
+    ''' File generated in process and streamed to the client '''
+    media_type: str
+    extension: str
+
+    def filename(self, house, year, month) -> str:
+        return f"{house} - {year}.{month:02d}.{self.extension}"
+
+    @abstractmethod
+    def stream(self, house, tables) -> Iterator[bytes]:
+        ''' Chunks of the file '''
+
+class CsvSink(StreamSink):
+    name = "csv"
+    media_type = "text/csv; charset=utf-8"
+    extension = "csv"
+
+    def stream(self, house, tables) -> Iterator[bytes]:
+        # BOM makes Excel read the file as UTF-8
+        yield "﻿".encode("utf-8")
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for i, (counter_type, table_data) in enumerate(tables.items()):
+            if i > 0:
+                writer.writerow([])
+            for row in table_rows(house, counter_type, table_data):
+                writer.writerow(row)
+                if buffer.tell() > 64 * 1024:
+                    yield buffer.getvalue().encode("utf-8")
+                    buffer.seek(0)
+                    buffer.truncate()
+        yield buffer.getvalue().encode("utf-8")
+
+class _Pipe:
+    ''' Unseekable file for zipfile, written bytes are taken by the generator '''
+    def __init__(self) -> None:
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def _column(index: int) -> str:
+    name = ""
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        name = chr(ord("A") + rest) + name
+    return name
+
+def _cell(ref: str, value, style: str = "") -> str:
+    if value is None or value == "":
+        return ""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c r="{ref}"{style}><v>{value}</v></c>'
+    return f'<c r="{ref}"{style} t="inlineStr"><is><t xml:space="preserve">{escape(str(value))}</t></is></c>'
+
+class XlsxSink(StreamSink):
+    ''' Minimal Office Open XML workbook written row by row '''
+    name = "xlsx"
+    media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    extension = "xlsx"
+
+    def stream(self, house, tables) -> Iterator[bytes]:
+        pipe = _Pipe()
+        titles = [TITLES.get(counter_type, counter_type) for counter_type in tables]
+        with zipfile.ZipFile(pipe, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("[Content_Types].xml", self._content_types(len(titles)))
+            zf.writestr("_rels/.rels", _RELS)
+            zf.writestr("xl/workbook.xml", self._workbook(titles))
+            zf.writestr("xl/_rels/workbook.xml.rels", self._workbook_rels(len(titles)))
+            zf.writestr("xl/styles.xml", _STYLES)
+            yield pipe.take()
+            for i, (counter_type, table_data) in enumerate(tables.items(), start=1):
+                with zf.open(f"xl/worksheets/sheet{i}.xml", "w", force_zip64=True) as sheet:
+                    sheet.write(_SHEET_HEAD.encode("utf-8"))
+                    for r, row in enumerate(table_rows(house, counter_type, table_data), start=1):
+                        # Bold title row
+                        style = ' s="1"' if r == 3 else ''
+                        cells = "".join(_cell(f"{_column(c)}{r}", value, style) for c, value in enumerate(row))
+                        sheet.write(f'<row r="{r}">{cells}</row>'.encode("utf-8"))
+                        if r % 500 == 0:
+                            yield pipe.take()
+                    merges = "".join(f'<mergeCell ref="{ref}"/>' for ref in MERGES)
+                    sheet.write(f'</sheetData><mergeCells count="{len(MERGES)}">{merges}</mergeCells></worksheet>'.encode("utf-8"))
+                yield pipe.take()
+        yield pipe.take()
+
+    def _content_types(self, count: int) -> str:
+        sheets = "".join(
+            f'<Override PartName="/xl/worksheets/sheet{i}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for i in range(1, count + 1)
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            f'{sheets}</Types>'
+        )
+
+    def _workbook(self, titles) -> str:
+        sheets = "".join(
+            f'<sheet name="{escape(title)}" sheetId="{i}" r:id="rId{i}"/>'
+            for i, title in enumerate(titles, start=1)
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets>{sheets}</sheets></workbook>'
+        )
+
+    def _workbook_rels(self, count: int) -> str:
+        rels = "".join(
+            f'<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet{i}.xml"/>'
+            for i in range(1, count + 1)
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'{rels}<Relationship Id="rId{count + 1}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+            '</Relationships>'
+        )
+
+_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="14"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1" applyAlignment="1"><alignment horizontal="center"/></xf></cellXfs>'
+    '</styleSheet>'
+)
+
+_SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<cols><col min="2" max="2" width="45" customWidth="1"/><col min="3" max="6" width="20" customWidth="1"/></cols>'
+    '<sheetData>'
+)
+
+SINKS = {sink.name: sink for sink in [GoogleSheetsSink(), CsvSink(), XlsxSink()]}
+
+_client = None
+_client_lock = threading.Lock()
 
 def get_service_account():
-    gc = gspread.service_account(
-        filename = 'smarthouse-424816-53872d0450a9.json'
-    )
-    return gc
-
-def create_spreadsheet(house, year, month):
-    gc = gspread.service_account(
-        filename = 'smarthouse-424816-53872d0450a9.json'
-    )
-    sh = gc.create(f"{house} - {year}.{month}")
-    sh.share(None, role='writer', perm_type='anyone')
-    return sh
-
-def write_table(spreadsheet, house, counter_type, table_data):    
-    consumed_text = "единиц"
-    if counter_type == "electricity": consumed_text = "кВт - ч"
-    if counter_type == "hot_water": consumed_text = "куб.м." 
-    if counter_type == "cold_water": consumed_text = "куб.м."
-
-    if counter_type == "electricity": counter_type = "ЭЭ"
-    if counter_type == "hot_water": counter_type = "ГВС" 
-    if counter_type == "cold_water": counter_type = "ХВС"
-
-    ws = spreadsheet.add_worksheet(title=f"{counter_type}", rows=f"{len(table_data) + 10}", cols="20")
-
-    ws.merge_cells("B1:F1", merge_type='MERGE_ALL')
-    ws.merge_cells("A3:F3", merge_type='MERGE_ALL')
-
-    table_data.insert(0, ["Дом:", house])
-    table_data.insert(1, [])
-    table_data.insert(2, [f"Журнал учета показаний {counter_type}"])
-    table_data.insert(3, [f"№\nп/п", "Адрес", "Серийный номер счетчика", f"Пред. показания\n{consumed_text}", f"Тек. показания\n{consumed_text}", f"Количество потреблен.\n{consumed_text}"])
-
-    ws.format('A3:F3', {"textFormat": {"bold": True, "fontSize": 14}, "horizontalAlignment": "CENTER"})
-    # ws.format('A:A', {'width': 40})
-    ws.update(table_data)
\ No newline at end of file
+    ''' One authenticated client shared by all report workers '''
+    global _client
+    with _client_lock:
+        if _client is None:
+            if SETTINGS.GOOGLE_SHEETS_FAKE:
+                from app.utils.fake_sheets import fake_client
+                _client = fake_client()
+            else:
+                _client = gspread.service_account(filename=SETTINGS.GOOGLE_SERVICE_ACCOUNT_FILE)
+        return _client
@@ -0,0 +1,105 @@
+''' House analytics: python -m benchmarks.analytics [apartments] [years] [--mongo]
+
+Without --mongo only the NumPy pass is timed, with --mongo a temporary
+database "<MONGODB_DB>_benchmark" is seeded and the whole build_analytics is timed '''
+import sys
+import time
+import random
+import asyncio
+
+from bson import ObjectId
+from datetime import datetime
+
+from app.settings import SETTINGS
+from app.utils.mongo import MongoDB
+from app.utils.reports import COUNTER_TYPES
+from app.utils.analytics import analyze, build_analytics
+from app.objects.reading_store import period_of
+from app.objects import House, Apartment, Counter, Reading, ReadingBucket, Consumption
+
+YEAR = 2024
+
+def generate(count: int, years: int):
+    house = House(address="Benchmark, 1", info="", managers=[], _id=ObjectId())
+    apartments, counters, readings = [], [], []
+    for number in range(1, count + 1):
+        apartment = Apartment(
+            house_id=house._id,
+            owner_id=ObjectId(),
+            entrance=str(number % 8 + 1),
+            floor=str(number % 20 + 1),
+            number=str(number),
+            _id=ObjectId()
+        )
+        apartments.append(apartment)
+        for counter_type in COUNTER_TYPES:
+            counter = Counter(
+                apartment_id=apartment._id,
+                active=True,
+                name=counter_type,
+                type=counter_type,
+                serial_number=f"{counter_type}-{number}",
+                _id=ObjectId()
+            )
+            counters.append(counter)
+            value = random.uniform(100, 1000)
+            for year in range(YEAR - years + 1, YEAR + 1):
+                for month in range(1, 13):
+                    value += random.uniform(0, 50)
+                    readings.append(Reading(
+                        user_id=apartment.owner_id,
+                        value=round(value, 1),
+                        counter_id=counter._id,
+                        year=year,
+                        month=month,
+                        created_at=datetime(year, month, 15)
+                    ))
+    return house, apartments, counters, readings
+
+def series(counters, readings) -> list:
+    ''' What Consumption.get_series returns for the generated data '''
+    result = {
+        counter._id: {'_id': counter._id, 'apartment_id': counter.apartment_id, 'type': counter.type, 'periods': [], 'deltas': []}
+        for counter in counters
+    }
+    previous = {}
+    for reading in readings:
+        doc = result[reading.counter_id]
+        doc['periods'].append(period_of(reading.year, reading.month))
+        doc['deltas'].append(reading.value - previous.get(reading.counter_id, reading.value))
+        previous[reading.counter_id] = reading.value
+    return list(result.values())
+
+def bench_memory(count: int, years: int) -> None:
+    house, apartments, counters, readings = generate(count, years)
+    docs = series(counters, readings)
+    started = time.perf_counter()
+    result = analyze(apartments, docs, YEAR, YEAR - years + 1)
+    elapsed = time.perf_counter() - started
+    print(f"analyze: {count} apartments, {years} years, {len(readings)} readings in {elapsed * 1000:.1f} ms")
+    print({counter_type: totals["total"] for counter_type, totals in result["totals"].items()})
+
+async def bench_mongo(count: int, years: int) -> None:
+    MongoDB.setup(SETTINGS.MONGODB_URL.get_secret_value(), SETTINGS.MONGODB_DB.get_secret_value() + "_benchmark")
+    house, apartments, counters, readings = generate(count, years)
+    try:
+        await MongoDB.setup_indexes([Apartment, Counter, Reading, ReadingBucket, Consumption])
+        await MongoDB.db.houses.insert_one({'_id': house._id, **house.__dict__()})
+        await MongoDB.db.apartments.insert_many([{'_id': a._id, **a.__dict__()} for a in apartments])
+        await MongoDB.db.counters.insert_many([{'_id': c._id, **c.__dict__()} for c in counters])
+        await Reading.insert_many(readings)
+        await Consumption.rebuild()
+        started = time.perf_counter()
+        await build_analytics(house, YEAR, years)
+        elapsed = time.perf_counter() - started
+        print(f"build_analytics: {count} apartments, {years} years in {elapsed * 1000:.1f} ms")
+    finally:
+        await MongoDB.client.drop_database(MongoDB.db.name)
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    count = int(args[0]) if args else 1000
+    years = int(args[1]) if len(args) > 1 else 5
+    bench_memory(count, years)
+    if '--mongo' in sys.argv:
+        asyncio.new_event_loop().run_until_complete(bench_mongo(count, years))
@@ -0,0 +1,41 @@
+''' Cost of materializing readings: python -m benchmarks.models [count] '''
+import sys
+import time
+import tracemalloc
+
+from bson import ObjectId
+from datetime import datetime
+
+from app.objects import Reading
+
+def documents(count: int):
+    counter_id = ObjectId()
+    user_id = ObjectId()
+    created_at = datetime.now()
+    return [
+        {
+            '_id': ObjectId(),
+            'user_id': user_id,
+            'value': float(i),
+            'created_at': created_at,
+            'counter_id': counter_id,
+            'year': 2024,
+            'month': i % 12 + 1
+        }
+        for i in range(count)
+    ]
+
+def measure(name: str, build, docs) -> None:
+    tracemalloc.start()
+    started = time.perf_counter()
+    objects = [build(doc) for doc in docs]
+    elapsed = time.perf_counter() - started
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<12} {elapsed * 1000:8.1f} ms {size / len(objects):8.1f} B/object")
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    docs = documents(count)
+    measure("__init__", lambda doc: Reading(**doc), docs)
+    measure("from_bson", Reading.from_bson, docs)
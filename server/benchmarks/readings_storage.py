@@ -0,0 +1,80 @@
+''' Readings layouts side by side: python -m benchmarks.readings_storage [counters] [years]
+
+Seeds a temporary database "<MONGODB_DB>_benchmark" with monthly readings,
+stores them in every layout and compares document counts, index size and
+latency of history queries '''
+import sys
+import time
+import random
+import asyncio
+
+from bson import ObjectId
+from datetime import datetime
+
+from app.settings import SETTINGS
+from app.utils.mongo import MongoDB
+from app.objects import Reading, ReadingBucket
+from app.objects.reading_store import STORES
+
+QUERIES = 200
+
+def generate(counters: int, years: int):
+    readings = []
+    counter_ids = [ObjectId() for _ in range(counters)]
+    for counter_id in counter_ids:
+        user_id = ObjectId()
+        value = random.uniform(100, 1000)
+        for year in range(2024 - years + 1, 2025):
+            for month in range(1, 13):
+                value += random.uniform(0, 50)
+                readings.append(Reading(
+                    user_id=user_id,
+                    value=round(value, 1),
+                    counter_id=counter_id,
+                    year=year,
+                    month=month,
+                    created_at=datetime(year, month, 15)
+                ))
+    return counter_ids, readings
+
+async def bench_store(name: str, counter_ids, readings) -> None:
+    store = STORES[name](Reading)
+    await store.insert_many(readings)
+    stats = await MongoDB.db.command('collStats', store.collection)
+
+    sample = random.sample(counter_ids, min(QUERIES, len(counter_ids)))
+    timings = {}
+    for label, start_date, end_date, limit in [
+        ('last page', datetime(2000, 1, 1), datetime(2100, 12, 1), 20),
+        ('one year', datetime(2024, 1, 1), datetime(2024, 12, 1), 0),
+    ]:
+        started = time.perf_counter()
+        for counter_id in sample:
+            [reading async for reading in store.find_history(counter_id, start_date, end_date, limit=limit)]
+        timings[label] = (time.perf_counter() - started) / len(sample) * 1000
+    started = time.perf_counter()
+    await store.get_latest(counter_ids[:1000])
+    timings['latest of 1000'] = (time.perf_counter() - started) * 1000
+
+    print(
+        f"{name:>9}: {stats['count']} documents, "
+        f"data {stats['size'] / 1024 / 1024:.1f} MB, "
+        f"indexes {stats['totalIndexSize'] / 1024 / 1024:.1f} MB, "
+        + ", ".join(f"{label} {ms:.2f} ms" for label, ms in timings.items())
+    )
+
+async def bench(counters: int, years: int) -> None:
+    MongoDB.setup(SETTINGS.MONGODB_URL.get_secret_value(), SETTINGS.MONGODB_DB.get_secret_value() + "_benchmark")
+    counter_ids, readings = generate(counters, years)
+    print(f"{counters} counters, {years} years, {len(readings)} readings")
+    try:
+        await MongoDB.setup_indexes([Reading, ReadingBucket])
+        for name in STORES:
+            await bench_store(name, counter_ids, readings)
+    finally:
+        await MongoDB.client.drop_database(MongoDB.db.name)
+
+if __name__ == '__main__':
+    counters = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    years = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    asyncio.new_event_loop().run_until_complete(bench(counters, years))
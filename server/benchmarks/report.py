@@ -0,0 +1,88 @@
+''' Monthly report of a big house: python -m benchmarks.report [apartments] [--mongo]
+
+Without --mongo only the in-memory pass is timed, with --mongo a temporary
+database "<MONGODB_DB>_benchmark" is seeded and the whole build_report is timed '''
+import sys
+import time
+import random
+import asyncio
+
+from bson import ObjectId
+from datetime import datetime
+
+from app.settings import SETTINGS
+from app.utils.mongo import MongoDB
+from app.utils.reports import COUNTER_TYPES, build_report, form_tables
+from app.objects import House, Apartment, Counter, Reading, ReadingBucket, Consumption
+
+YEAR, MONTH = 2024, 3
+
+def generate(count: int):
+    house = House(address="Benchmark, 1", info="", managers=[], _id=ObjectId())
+    apartments, counters, readings = [], [], []
+    for number in range(1, count + 1):
+        apartment = Apartment(
+            house_id=house._id,
+            owner_id=ObjectId(),
+            entrance=str(number % 8 + 1),
+            floor=str(number % 20 + 1),
+            number=str(number),
+            _id=ObjectId()
+        )
+        apartments.append(apartment)
+        for counter_type in COUNTER_TYPES:
+            counter = Counter(
+                apartment_id=apartment._id,
+                active=True,
+                name=counter_type,
+                type=counter_type,
+                serial_number=f"{counter_type}-{number}",
+                _id=ObjectId()
+            )
+            counters.append(counter)
+            value = random.uniform(100, 1000)
+            for year, month in [(YEAR, MONTH - 1), (YEAR, MONTH)]:
+                value += random.uniform(0, 50)
+                readings.append(Reading(
+                    user_id=apartment.owner_id,
+                    value=round(value, 1),
+                    counter_id=counter._id,
+                    year=year,
+                    month=month,
+                    created_at=datetime(year, month, 15)
+                ))
+    return house, apartments, counters, readings
+
+def bench_memory(count: int) -> None:
+    house, apartments, counters, readings = generate(count)
+    current = {r.counter_id: r.value for r in readings if r.month == MONTH}
+    previous = {r.counter_id: r.value for r in readings if r.month != MONTH}
+    started = time.perf_counter()
+    report = form_tables(house.address, apartments, counters, current, previous)
+    elapsed = time.perf_counter() - started
+    rows = sum(len(table) for table in report["tables"].values())
+    print(f"form_tables: {count} apartments, {rows} rows in {elapsed * 1000:.1f} ms")
+
+async def bench_mongo(count: int) -> None:
+    MongoDB.setup(SETTINGS.MONGODB_URL.get_secret_value(), SETTINGS.MONGODB_DB.get_secret_value() + "_benchmark")
+    house, apartments, counters, readings = generate(count)
+    try:
+        await MongoDB.setup_indexes([Apartment, Counter, Reading, ReadingBucket, Consumption])
+        await MongoDB.db.houses.insert_one({'_id': house._id, **house.__dict__()})
+        await MongoDB.db.apartments.insert_many([{'_id': a._id, **a.__dict__()} for a in apartments])
+        await MongoDB.db.counters.insert_many([{'_id': c._id, **c.__dict__()} for c in counters])
+        await Reading.insert_many(readings)
+        await Consumption.rebuild()
+        started = time.perf_counter()
+        report = await build_report(house, YEAR, MONTH)
+        elapsed = time.perf_counter() - started
+        print(f"build_report: {count} apartments, totals {report['totals']} in {elapsed * 1000:.1f} ms")
+    finally:
+        await MongoDB.client.drop_database(MongoDB.db.name)
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    count = int(args[0]) if args else 1000
+    bench_memory(count)
+    if '--mongo' in sys.argv:
+        asyncio.new_event_loop().run_until_complete(bench_mongo(count))
@@ -0,0 +1,41 @@
+''' Tests run against a real MongoDB given by TEST_MONGODB_URL and are skipped without it.
+Change stream tests need a replica set, a single node one is enough:
+    mongod --replSet rs0 && mongosh --eval 'rs.initiate()'
+    TEST_MONGODB_URL=mongodb://localhost:27017/?directConnection=true python -m pytest tests
+Every test gets its own database, dropped afterwards '''
+import os
+import asyncio
+import pytest
+
+from bson import ObjectId
+
+TEST_MONGODB_URL = os.environ.get('TEST_MONGODB_URL')
+
+# Settings are read on import of app, only the connection matters here
+os.environ.setdefault('MONGODB_URL', TEST_MONGODB_URL or 'mongodb://localhost:27017')
+os.environ.setdefault('MONGODB_DB', 'smarthouse_test')
+os.environ.setdefault('LOGGING_LEVEL', 'INFO')
+os.environ.setdefault('API_PORT', '8000')
+os.environ.setdefault('API_HOST', '127.0.0.1')
+
+from app.utils.mongo import MongoDB
+from app.utils.event_hub import EventHub
+
+@pytest.fixture
+def mongo():
+    ''' Runner of async test scenarios against a fresh database '''
+    if not TEST_MONGODB_URL:
+        pytest.skip('TEST_MONGODB_URL is not set')
+
+    def run(scenario):
+        async def main():
+            MongoDB.setup(TEST_MONGODB_URL, f'test_{ObjectId()}')
+            EventHub.subscribers.clear()
+            EventHub.published.clear()
+            try:
+                await scenario()
+            finally:
+                await MongoDB.client.drop_database(MongoDB.db.name)
+                MongoDB.client.close()
+        asyncio.run(main())
+    return run
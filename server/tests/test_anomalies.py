@@ -0,0 +1,55 @@
+from bson import ObjectId
+
+from app.utils.mongo import MongoDB
+from app.objects import Consumption
+from app.objects.reading_store import period_of
+from app.utils.anomalies import score
+
+PERIOD = period_of(2024, 6)
+HOUSE = ObjectId()
+
+def series(deltas: list, counter_type: str = 'electricity') -> dict:
+    ''' get_series document of a counter with a reading every month up to PERIOD '''
+    return {
+        '_id': ObjectId(),
+        'house_id': HOUSE,
+        'apartment_id': ObjectId(),
+        'type': counter_type,
+        'periods': list(range(PERIOD - len(deltas) + 1, PERIOD + 1)),
+        'deltas': deltas,
+    }
+
+def kinds(docs: list) -> list:
+    return sorted((i, kind) for i, kind, _ in score(docs, PERIOD))
+
+def test_first_reading_is_not_history():
+    # Two months of usage after the first reading are too few to compare against
+    assert kinds([series([None, 10, 10, 50])]) == []
+    assert kinds([series([10, 10, 10, 50])]) == [(0, 'spike')]
+
+def test_first_reading_is_not_zero_usage():
+    assert kinds([series([None, 0, 0])]) == []
+    assert kinds([series([5, 0, 0, 0])]) == [(0, 'zero')]
+
+def test_first_reading_this_month_is_not_scored():
+    docs = [series([10, 10, 10, 10]) for _ in range(3)] + [series([None])]
+    assert kinds(docs) == []
+
+def test_expected_is_the_median_of_usage():
+    (_, kind, expected), = score([series([None, 10, 12, 14, 60])], PERIOD)
+    assert (kind, expected) == ('spike', 12.0)
+
+def test_series_keep_first_reading_without_delta(mongo):
+    async def scenario():
+        counter_id = ObjectId()
+        documents = [
+            {'counter_id': counter_id, 'house_id': HOUSE, 'apartment_id': ObjectId(), 'type': 'cold_water',
+             'year': 2024, 'month': month, 'delta': delta}
+            for month, delta in [(4, None), (5, 0), (6, 0)]
+        ]
+        await MongoDB.db.consumption_monthly.insert_many(documents)
+        doc, = await Consumption.get_series(2024, 2024)
+        assert sorted(zip(doc['periods'], doc['deltas'])) == [(period_of(2024, 4), None), (period_of(2024, 5), 0), (period_of(2024, 6), 0)]
+        # Two months without usage after the first reading, not three
+        assert kinds([doc]) == []
+    mongo(scenario)
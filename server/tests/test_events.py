@@ -0,0 +1,100 @@
+import json
+import asyncio
+import pytest
+
+from bson import ObjectId
+
+from app.utils.mongo import MongoDB
+from app.utils.event_hub import EventHub
+from app.objects import Event
+from app.api.routes.events import event_stream, CATCH_UP_PAGE_SIZE
+
+def new_event(user_id: ObjectId, title: str = 'Test') -> Event:
+    return Event(user_id=user_id, type='info', title=title, details='')
+
+async def insert_elsewhere(event: Event) -> ObjectId:
+    ''' Insert like another worker does, no local publish on this one '''
+    inserted = await MongoDB.db.events.insert_one(event.__dict__())
+    event._id = inserted.inserted_id
+    return event._id
+
+async def start_feeder() -> asyncio.Task:
+    ''' Run the feeder and wait until its change stream delivers '''
+    feeder = asyncio.get_running_loop().create_task(EventHub.run_feeder(Event, retry=0.1))
+    probe_user = ObjectId()
+    queue = EventHub.subscribe(probe_user)
+    try:
+        for _ in range(50):
+            await insert_elsewhere(new_event(probe_user, 'probe'))
+            try:
+                await asyncio.wait_for(queue.get(), 0.2)
+                return feeder
+            except asyncio.TimeoutError:
+                if feeder.done():
+                    break
+        feeder.cancel()
+        pytest.skip('No change streams, TEST_MONGODB_URL must point to a replica set')
+    finally:
+        EventHub.unsubscribe(probe_user, queue)
+
+async def drain(queue: asyncio.Queue, timeout: float = 0.5) -> list:
+    items = []
+    while True:
+        try:
+            items.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            return items
+
+def read_ids(messages: list) -> list:
+    return [json.loads(message.split('data: ', 1)[1])['id'] for message in messages]
+
+def test_event_of_other_worker_reaches_subscriber(mongo):
+    async def scenario():
+        feeder = await start_feeder()
+        user_id = ObjectId()
+        queue = EventHub.subscribe(user_id)
+        other = EventHub.subscribe(ObjectId())
+        try:
+            _id = await insert_elsewhere(new_event(user_id))
+            payload = await asyncio.wait_for(queue.get(), 5)
+            assert payload['id'] == str(_id)
+            assert other.empty()
+        finally:
+            feeder.cancel()
+    mongo(scenario)
+
+def test_own_event_is_delivered_once(mongo):
+    async def scenario():
+        feeder = await start_feeder()
+        user_id = ObjectId()
+        queue = EventHub.subscribe(user_id)
+        try:
+            event = new_event(user_id)
+            await event.save()
+            # The change stream is ordered, once the marker arrives the saved event went through it too
+            marker = await insert_elsewhere(new_event(user_id, 'marker'))
+            ids = [payload['id'] for payload in await drain(queue)]
+            assert ids == [str(event._id), str(marker)]
+        finally:
+            feeder.cancel()
+    mongo(scenario)
+
+def test_catch_up_replays_everything_after_last_event_id(mongo):
+    async def scenario():
+        user_id = ObjectId()
+        events = [new_event(user_id, str(i)) for i in range(CATCH_UP_PAGE_SIZE * 2 + 50)]
+        await Event.insert_many(events)
+        await Event.insert_many([new_event(ObjectId())])
+        queue = EventHub.subscribe(user_id)
+        # Already delivered live while catching up, must not be sent twice
+        queue.put_nowait(events[-1].to_json())
+        stream = event_stream(user_id, queue, events[0]._id)
+        expected = [str(event._id) for event in events[1:]]
+        messages = [await stream.__anext__() for _ in expected]
+        assert read_ids(messages) == expected
+        live = new_event(user_id, 'live')
+        await live.save()
+        assert read_ids([await asyncio.wait_for(stream.__anext__(), 5)]) == [str(live._id)]
+        await stream.aclose()
+        assert user_id not in EventHub.subscribers
+    mongo(scenario)
@@ -0,0 +1,41 @@
+import json
+
+from bson import ObjectId
+
+from app.utils.pagination import page_response, decode_cursor, keyset_filter
+
+ORDER = [('number', 1), ('_id', 1)]
+
+class Item:
+    def __init__(self, number: int) -> None:
+        self._id = ObjectId()
+        self.number = number
+
+    def to_json(self):
+        return {'id': str(self._id), 'number': self.number}
+
+def body(response) -> object:
+    return json.loads(response.body)
+
+def test_plain_list_unless_paged():
+    items = [Item(1), Item(2)]
+    assert body(page_response(items, ORDER, 2, False)) == [item.to_json() for item in items]
+
+def test_paged_first_page_has_cursor_of_last_item():
+    items = [Item(1), Item(2)]
+    result = body(page_response(items, ORDER, 2, True))
+    assert result['items'] == [item.to_json() for item in items]
+    assert decode_cursor(result['next_cursor']) == [2, items[-1]._id]
+
+def test_cursor_implies_paged_and_last_page_has_no_cursor():
+    items = [Item(3)]
+    result = body(page_response(items, ORDER, 2, False, cursor='x'))
+    assert result == {'items': [items[0].to_json()], 'next_cursor': None}
+
+def test_keyset_filter_continues_after_cursor():
+    item = Item(2)
+    cursor = body(page_response([item], ORDER, 1, True))['next_cursor']
+    assert keyset_filter({'house_id': 1}, ORDER, cursor) == {'$and': [
+        {'house_id': 1},
+        {'$or': [{'number': {'$gt': 2}}, {'number': 2, '_id': {'$gt': item._id}}]}
+    ]}
@@ -0,0 +1,61 @@
+import asyncio
+import pytest
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+
+from app.utils.mongo import MongoDB
+from app.objects import Reading, ReadingBucket
+from app.objects.reading_store import BucketStore
+
+# Counters raced on, each gets its bucket created by two writers at once
+RACES = 20
+
+def reading(counter_id: ObjectId, month: int, value: float = 1.0) -> Reading:
+    return Reading(value=value, user_id=ObjectId(), counter_id=counter_id, year=2024, month=month)
+
+async def months(store: BucketStore, counter_id: ObjectId) -> list:
+    return [reading.month for reading in await store.get_counter_readings(counter_id)]
+
+def test_concurrent_first_writes_share_the_bucket(mongo):
+    async def scenario():
+        await MongoDB.setup_indexes([ReadingBucket])
+        store = BucketStore(Reading)
+        counter_ids = [ObjectId() for _ in range(RACES)]
+        await asyncio.gather(*[
+            store.insert(reading(counter_id, month))
+            for counter_id in counter_ids for month in (1, 2)
+        ])
+        for counter_id in counter_ids:
+            assert await months(store, counter_id) == [1, 2]
+        assert await store.db.count_documents({}) == RACES
+    mongo(scenario)
+
+def test_concurrent_first_batches_share_the_bucket(mongo):
+    async def scenario():
+        await MongoDB.setup_indexes([ReadingBucket])
+        store = BucketStore(Reading)
+        counter_ids = [ObjectId() for _ in range(RACES)]
+        await asyncio.gather(*[
+            store.insert_many([reading(counter_id, month) for counter_id in counter_ids])
+            for month in (1, 2)
+        ])
+        for counter_id in counter_ids:
+            assert await months(store, counter_id) == [1, 2]
+    mongo(scenario)
+
+def test_duplicate_month_still_fails(mongo):
+    async def scenario():
+        await MongoDB.setup_indexes([ReadingBucket])
+        store = BucketStore(Reading)
+        counter_id, other = ObjectId(), ObjectId()
+        await store.insert(reading(counter_id, 1))
+        with pytest.raises(DuplicateKeyError):
+            await store.insert(reading(counter_id, 1, 2.0))
+        with pytest.raises(BulkWriteError) as e:
+            await store.insert_many([reading(other, 1), reading(counter_id, 1, 3.0)])
+        # Index of the reading passed in, not of the retried batch
+        assert [error['index'] for error in e.value.details['writeErrors']] == [1]
+        assert await months(store, counter_id) == [1]
+        assert await months(store, other) == [1]
+    mongo(scenario)
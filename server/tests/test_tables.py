@@ -0,0 +1,110 @@
+import pytest
+import gspread
+
+from app.utils import tables
+from app.utils.tables import GoogleSheetsSink, table_rows, MERGES, TITLES
+from app.utils.fake_sheets import fake_client
+
+HOUSE = 'ул. Ленина, 1'
+TABLES = {
+    'electricity': [[1, 'кв. 1', 'SN-1', 100, 150.5, 50.5], [2, 'кв. 2', 'SN-2', None, 20, '']],
+    'cold_water': [[1, 'кв. 1', 'SN-3', 3, 4, 1]],
+}
+DRIVE = 'https://www.googleapis.com/drive/v3/files'
+SHEETS = 'https://sheets.googleapis.com/v4/spreadsheets'
+
+@pytest.fixture
+def session(monkeypatch):
+    client = fake_client()
+    monkeypatch.setattr(tables, '_client', client)
+    return client.http_client.session
+
+def grid(rows: list) -> list:
+    ''' Rows as the sheet holds them: padded to the widest row, empty cells are "" '''
+    columns = max(len(row) for row in rows)
+    return [[value if value is not None else '' for value in row] + [''] * (columns - len(row)) for row in rows]
+
+def string(value: str) -> dict:
+    return {'userEnteredValue': {'stringValue': value}}
+
+def number(value) -> dict:
+    return {'userEnteredValue': {'numberValue': value}}
+
+def test_write_requests_as_sent(session):
+    url = GoogleSheetsSink().write(HOUSE, 2024, 3, {'cold_water': TABLES['cold_water']})
+
+    spreadsheet, = session.spreadsheets.values()
+    assert url == f'https://docs.google.com/spreadsheets/d/{spreadsheet.id}'
+    assert [(request['method'], request['url']) for request in session.requests] == [
+        ('POST', DRIVE),
+        ('GET', f'{SHEETS}/{spreadsheet.id}'),
+        ('POST', f'{DRIVE}/{spreadsheet.id}/permissions'),
+        ('POST', f'{SHEETS}/{spreadsheet.id}:batchUpdate'),
+    ]
+    create, _, share, batch_update = [request['json'] for request in session.requests]
+    assert create == {'name': f'{HOUSE} - 2024.3', 'mimeType': 'application/vnd.google-apps.spreadsheet'}
+    assert share == {'type': 'anyone', 'role': 'writer', 'withLink': False}
+    units = 'куб.м.'
+    assert batch_update == {'requests': [
+        {'addSheet': {'properties': {'sheetId': 1, 'title': 'ХВС', 'gridProperties': {'rowCount': 15, 'columnCount': 20}}}},
+        {'mergeCells': {'range': {'sheetId': 1, 'startRowIndex': 0, 'endRowIndex': 1, 'startColumnIndex': 1, 'endColumnIndex': 6}, 'mergeType': 'MERGE_ALL'}},
+        {'mergeCells': {'range': {'sheetId': 1, 'startRowIndex': 2, 'endRowIndex': 3, 'startColumnIndex': 0, 'endColumnIndex': 6}, 'mergeType': 'MERGE_ALL'}},
+        {'repeatCell': {
+            'range': {'sheetId': 1, 'startRowIndex': 2, 'endRowIndex': 3, 'startColumnIndex': 0, 'endColumnIndex': 6},
+            'cell': {'userEnteredFormat': {'textFormat': {'bold': True, 'fontSize': 14}, 'horizontalAlignment': 'CENTER'}},
+            'fields': 'userEnteredFormat(textFormat,horizontalAlignment)'
+        }},
+        {'updateCells': {
+            'start': {'sheetId': 1, 'rowIndex': 0, 'columnIndex': 0},
+            'rows': [
+                {'values': [string('Дом:'), string(HOUSE)]},
+                {'values': []},
+                {'values': [string('Журнал учета показаний ХВС')]},
+                {'values': [
+                    string('№\nп/п'), string('Адрес'), string('Серийный номер счетчика'),
+                    string(f'Пред. показания\n{units}'), string(f'Тек. показания\n{units}'),
+                    string(f'Количество потреблен.\n{units}')
+                ]},
+                {'values': [number(1), string('кв. 1'), string('SN-3'), number(3), number(4), number(1)]},
+            ],
+            'fields': 'userEnteredValue'
+        }},
+        {'deleteSheet': {'sheetId': 0}},
+    ]}
+
+def test_write_fills_every_sheet(session):
+    GoogleSheetsSink().write(HOUSE, 2024, 3, TABLES)
+
+    spreadsheet, = session.spreadsheets.values()
+    # One batchUpdate whatever the number of tables
+    assert [request['url'].rsplit(':', 1)[-1] for request in session.requests].count('batchUpdate') == 1
+    # The empty default sheet is gone, one sheet per counter type is left
+    assert sorted(spreadsheet.sheets) == [1, 2]
+    assert [sheet['title'] for sheet in spreadsheet.sheets.values()] == [TITLES['electricity'], TITLES['cold_water']]
+    for sheet_id, (counter_type, table_data) in enumerate(TABLES.items(), start=1):
+        sheet = spreadsheet.sheets[sheet_id]
+        assert len(sheet['merges']) == len(MERGES)
+        assert spreadsheet.worksheet_values(sheet['title']) == grid(table_rows(HOUSE, counter_type, table_data))
+
+def test_values_keep_numbers_and_skip_empty_cells(session):
+    GoogleSheetsSink().write(HOUSE, 2024, 3, TABLES)
+
+    spreadsheet, = session.spreadsheets.values()
+    cells = spreadsheet.sheets[1]['cells']
+    # Header rows are 4, data starts at row index 4
+    assert cells[(4, 0)] == 1 and cells[(4, 4)] == 150.5
+    assert cells[(4, 1)] == 'кв. 1'
+    assert (5, 3) not in cells and (5, 5) not in cells
+    assert (1, 0) not in cells
+
+def test_rejected_batch_update_changes_nothing(session, monkeypatch):
+    sink = GoogleSheetsSink()
+    requests = sink.requests
+    # The last request deletes sheet 0 a second time, everything before it was valid
+    monkeypatch.setattr(sink, 'requests', lambda house, tables: requests(house, tables) + [{'deleteSheet': {'sheetId': 0}}])
+    with pytest.raises(gspread.exceptions.APIError):
+        sink.write(HOUSE, 2024, 3, TABLES)
+
+    spreadsheet, = session.spreadsheets.values()
+    assert list(spreadsheet.sheets) == [0]
+    assert session.requests[-1]['url'].endswith(':batchUpdate')